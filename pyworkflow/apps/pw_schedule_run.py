@@ -26,14 +26,18 @@
 # **************************************************************************
 
 import os
+import sys
 import time
-import json
+import fcntl
 import argparse
 
 from pyworkflow.em import *
 from pyworkflow.config import *
 from pyworkflow.protocol import (getProtocolFromDb,
                                  STATUS_FINISHED, STATUS_ABORTED, STATUS_FAILED)
+from pyworkflow.protocol.launch import (getSchedulerPath, getSchedulerPid,
+                                        readScheduleRequests,
+                                        SCHEDULER_PID, SCHEDULER_LOCK)
 
 
 # Add callback for remote debugging if available.
@@ -45,8 +49,17 @@ except ImportError:
     pass
 
 
-class RunScheduler():
-    """ Check that all dependencies are met before launching a run. """
+STOP_STATUSES = [STATUS_FINISHED, STATUS_ABORTED, STATUS_FAILED]
+
+
+class ProjectScheduler():
+    """ Launch the scheduled runs of a project when all their
+    dependencies are met. A single scheduler runs per project, new
+    runs are added through the requests queue written by
+    pyworkflow.protocol.launch.schedule. The runs are only checked
+    again when the run.db of any of their dependencies (or their own)
+    has been modified, and the scheduler exits when no runs are left.
+    """
 
     def _parseArgs(self):
         parser = argparse.ArgumentParser()
@@ -55,111 +68,206 @@ class RunScheduler():
         _addArg("projPath", metavar='PROJECT_NAME',
                 help="Project database path.")
 
-        _addArg("dbPath", metavar='DATABASE_PATH',
-                help="Protocol database path.")
-
-        _addArg("protId", type=int, metavar='PROTOCOL_ID',
-                help="Protocol ID.")
-
-        _addArg("--sleep_time", type=int, default=15,
+        _addArg("--sleep_time", type=int, default=5,
                 dest='sleepTime', metavar='SECONDS',
                 help="Sleeping time (in seconds) between updates.")
 
-        _addArg("--wait_for", nargs='*', type=int, default=[],
-                dest='waitProtIds', metavar='PROTOCOL_ID',
-                help="List of protocol ids that should be not running "
-                     "(i.e, finished, aborted or failed) before this "
-                     "run will be executed.")
-
         self._args = parser.parse_args()
 
-    def _loadProtocol(self):
-        return getProtocolFromDb(self._args.projPath,
-                                 self._args.dbPath,
-                                 self._args.protId, chdir=True)
+    def _log(self, msg, protocol=None):
+        line = "%s: %s" % (pwutils.prettyTimestamp(), msg)
+        print >> self._logFile, line
+        self._logFile.flush()
 
-    def main(self):
-        self._parseArgs()
+        if protocol is not None:
+            with open(protocol._getLogsPath('schedule.log'), 'a') as f:
+                print >> f, line
 
-        stopStatuses = [STATUS_FINISHED, STATUS_ABORTED, STATUS_FAILED]
+    def _getPath(self, *paths):
+        return getSchedulerPath(self._projPath, *paths)
 
-        # Enter to the project directory and load protocol from db
-        protocol = self._loadProtocol()
-        mapper = protocol.getMapper()
+    def _writePid(self):
+        with open(self._getPath(SCHEDULER_PID), 'w') as f:
+            f.write(str(os.getpid()))
 
-        log = open(protocol._getLogsPath('schedule.log'), 'w')
-        pid = os.getpid()
-        protocol.setPid(pid)
+    def _acquireLock(self):
+        """ Take the scheduler lock of the project. Return False if
+        there is another scheduler running, in which case it will
+        process the pending requests.
+        """
+        self._lockFile = open(self._getPath(SCHEDULER_LOCK), 'w')
 
+        while True:
+            try:
+                fcntl.flock(self._lockFile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return True
+            except IOError:
+                # If there is no pid file, the other scheduler is exiting
+                # so we wait for it to release the lock
+                if getSchedulerPid(self._projPath) is not None:
+                    return False
+                time.sleep(1)
+
+    def _loadProtocol(self, protId, dbPath):
+        return getProtocolFromDb(self._projPath, dbPath, protId, chdir=True)
+
+    def _readRequests(self):
+        """ Add the runs from the pending requests, return True if
+        there was any request.
+        """
+        requests = readScheduleRequests(self._projPath)
+
+        for protId, dbPath in requests:
+            try:
+                self._addRun(protId, dbPath)
+            except Exception as e:
+                self._log("ERROR: Could not schedule protocol %s: %s"
+                          % (protId, e))
+
+        return bool(requests)
+
+    def _addRun(self, protId, dbPath):
+        """ Register a new scheduled run and its dependencies, that are
+        taken from the runs graph of the project (input runs) and the
+        prerequisites of the protocol.
+        """
+        protocol = self._loadProtocol(protId, dbPath)
+        project = protocol.getProject()
         prerequisites = map(int, protocol.getPrerequisites())
 
-        def _log(msg):
-            print >> log, "%s: %s" % (pwutils.prettyTimestamp(), msg)
-            log.flush()
+        graph = project.getRunsGraph(refresh=False)
+        node = graph.getNode(protocol.strId())
+        depRuns = [n.run for n in node.getParents() if n.run is not None]
+        depRuns += [p for p in map(project.getProtocol, prerequisites)
+                    if p is not None]
+
+        self._log("Scheduling protocol %s, scheduler pid: %s, "
+                  "prerequisites: %s" % (protId, os.getpid(), prerequisites),
+                  protocol)
+        project.mapper.close()
+
+        watched = [dbPath] + [r.getDbPath() for r in depRuns]
+        self._runs[protId] = {'dbPath': dbPath,
+                              'prerequisites': prerequisites,
+                              'watched': dict((fn, None) for fn in watched)}
+
+    def _hasChanged(self, run):
+        """ Check if any of the run.db files watched for this run
+        was modified since the last check.
+        """
+        for fn, lastModified in run['watched'].iteritems():
+            if os.path.exists(fn) and os.path.getmtime(fn) != lastModified:
+                return True
+        return False
+
+    def _updateWatched(self, run):
+        """ Take the modification times of the watched files, so the run
+        is only checked again when any of them is modified. """
+        for fn in run['watched']:
+            if os.path.exists(fn):
+                run['watched'][fn] = os.path.getmtime(fn)
+
+    def _checkRun(self, protId, run):
+        """ Check if the scheduled run is ready and launch it.
+        Return True if the run is not longer scheduled.
+        """
+        if not os.path.exists(run['dbPath']):
+            self._log("Protocol %s was deleted" % protId)
+            return True
+
+        protocol = self._loadProtocol(protId, run['dbPath'])
+        project = protocol.getProject()
+
+        if not protocol.isScheduled():
+            self._log("Protocol %s is not longer scheduled (status: %s)"
+                      % (protId, protocol.getStatus()), protocol)
+            project.mapper.close()
+            return True
+
+        # Check if there are missing inputs
+        missing = False
+        for key, attr in protocol.iterInputAttributes():
+            if attr.hasValue() and attr.get() is None:
+                missing = True
+                project._updateProtocol(attr.getObjValue(),
+                                        skipUpdatedProtocols=False)
+
+        wait = False  # Check if we need to wait for required protocols
+        for prereqId in run['prerequisites']:
+            prot = project.getProtocol(prereqId)
+            if prot is not None:
+                project._updateProtocol(prot, skipUpdatedProtocols=False)
+                if prot.getStatus() not in STOP_STATUSES:
+                    wait = True
+
+        if not missing and not wait:
+            self._log("Launching the protocol %s >>>>" % protId, protocol)
+            project.launchProtocol(protocol, scheduled=True)
+            project.mapper.close()
+            return True
+
+        project.mapper.commit()
+        project.mapper.close()
+        self._log("Protocol %s still missing input" % protId, protocol)
+
+        # Take the timestamps after our own changes to the run.db
+        self._updateWatched(run)
 
-        _log("Scheduling protocol %s, pid: %s, prerequisites: %s"
-             % (protocol.getObjId(), pid, prerequisites))
+        return False
 
-        mapper.store(protocol)
-        mapper.commit()
-        mapper.close()
+    def _canExit(self):
+        """ Remove the pid file and check the queue once more, since
+        some client could have written a request when the scheduler
+        was still seen as running.
+        """
+        pwutils.cleanPath(self._getPath(SCHEDULER_PID))
 
-        # Keep track of the last time the protocol was checked and
-        # its modification date to avoid unnecessary db opening
-        lastCheckedDict = {}
+        if self._readRequests():
+            self._writePid()
+            return False
 
-        def _updateProtocol(protocol, project):
-            protDb = protocol.getDbPath()
+        return True
 
-            if os.path.exists(protDb):
-                protId = protocol.getObjId()
-                lastChecked = lastCheckedDict.get(protId, None)
-                lastModified = pwutils.getFileLastModificationDate(protDb)
+    def main(self):
+        self._parseArgs()
+        self._projPath = os.path.abspath(self._args.projPath)
+        self._runs = {}  # Scheduled runs by protocol id
+        # Run db paths are relative to the project folder
+        os.chdir(self._projPath)
+        pwutils.makePath(self._getPath())
 
-                if lastChecked is None or (lastModified > lastChecked):
-                    project._updateProtocol(protocol,
-                                            skipUpdatedProtocols=False)
-                    _log("Updated protocol %s" % protId)
+        if not self._acquireLock():
+            sys.exit(0)
+
+        self._logFile = open(self._getPath('scheduler.log'), 'a')
+        self._writePid()
+        self._log("Started project scheduler, pid: %s" % os.getpid())
 
         while True:
-            protocol = self._loadProtocol()
-            project = protocol.getProject()
-
-            # Check if there are missing inputs
-            missing = False
-
-            _log("Checking input data...")
-            for key, attr in protocol.iterInputAttributes():
-                if attr.hasValue() and attr.get() is None:
-                    missing = True
-                    inputProt = attr.getObjValue()
-                    _updateProtocol(inputProt, project)
-
-            _log("Checking prerequisited...")
-            wait = False  # Check if we need to wait for required protocols
-            for protId in prerequisites:
-                prot = project.getProtocol(protId)
-                if prot is not None:
-                    _updateProtocol(prot, project)
-                    if prot.getStatus() not in stopStatuses:
-                        wait = True
-
-            if not missing and not wait:
+            self._readRequests()
+
+            for protId, run in self._runs.items():
+                if self._hasChanged(run):
+                    try:
+                        done = self._checkRun(protId, run)
+                    except Exception as e:
+                        # Do not retry until the watched files change
+                        self._log("ERROR: checking protocol %s: %s"
+                                  % (protId, e))
+                        self._updateWatched(run)
+                        done = False
+                    if done:
+                        del self._runs[protId]
+
+            if not self._runs and self._canExit():
                 break
 
-            project.mapper.commit()
-            project.mapper.close()
-
-            _log("Still missing input, sleeping %s seconds..."
-                 % self._args.sleepTime)
             time.sleep(self._args.sleepTime)
 
-        _log("Launching the protocol >>>>")
-        log.close()
-        project.launchProtocol(protocol, scheduled=True)
+        self._log("No more scheduled runs, exiting.")
+        self._logFile.close()
 
 
 if __name__ == '__main__':
-    scheduler = RunScheduler()
+    scheduler = ProjectScheduler()
     scheduler.main()
-
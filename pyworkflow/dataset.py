@@ -385,7 +385,8 @@ class SqliteDataSet(DataSet):
                     if index:
                         rowDict[k] = '%06d@%s' % (index, filename)
             table.addRow(row['id'], **rowDict)
-            
+        db.close()
+
         return table
         
         
@@ -33,6 +33,7 @@ import xmipp
 import pyworkflow.utils as pwutils
 
 from constants import *
+import mrc
 
 
 
@@ -216,6 +217,14 @@ class ImageHandler(object):
         #     else:
         #         raise Exception("Conversion from tif to %s is not "
         #                         "implemented yet. " % pwutils.getExt(outputFn))
+        elif mrc.isMrcFile(inputFn) and mrc.isMrcFile(outputFn):
+            # Copy the images directly from the memory-mapped input stack
+            n = mrc.MrcFile(inputFn, isStack=True).getSize()
+            if firstImg is None:
+                firstImg = 1
+            if lastImg is None:
+                lastImg = n
+            mrc.extractSubset(inputFn, outputFn, range(firstImg, lastImg + 1))
         else:
             # get input dim
             (x, y, z, n) = xmipp.getImageSize(inputFn)
@@ -248,7 +257,10 @@ class ImageHandler(object):
             fn = location[1]
             ext = pwutils.getExt(fn).lower()
             
-            if ext == '.png' or ext == '.jpg':
+            if mrc.isMrcFile(fn) and location[0] == NO_INDEX:
+                # Only the header is read, without using Xmipp
+                return mrc.MrcFile(fn).getDimensions()
+            elif ext == '.png' or ext == '.jpg':
                 im = PIL.Image.open(fn)
                 x, y = im.size # (width,height) tuple
                 return x, y, 1, 1
@@ -303,7 +315,11 @@ class ImageHandler(object):
         If inputSet is a SetOfImages subclass, we will iterate
         and compute the average from all images.
         """
-        if isinstance(inputSet, basestring):
+        if isinstance(inputSet, basestring) and mrc.isMrcStack(inputSet):
+            avgImage = self.createImage()
+            avgImage.setData(mrc.computeAverage(inputSet))
+            return avgImage
+        elif isinstance(inputSet, basestring):
             _, _, _, n = self.getDimensions(inputSet)
             if n:
                 avgImage = self.read((1, inputSet))
@@ -331,6 +347,9 @@ class ImageHandler(object):
         return None
     
     def invertStack(self, inputFn, outputFn):
+        if mrc.isMrcFile(inputFn) and mrc.isMrcFile(outputFn):
+            mrc.invertStack(inputFn, outputFn)
+            return
         #get input dim
         (x,y,z,n) = xmipp.getImageSize(inputFn)
         #Create empty output stack for efficiency
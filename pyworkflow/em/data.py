@@ -34,6 +34,7 @@ import json
 from pyworkflow.object import *
 from constants import *
 from convert import ImageHandler
+from pyworkflow.mapper.query import Attr, Expr
 import numpy as np
 
 
@@ -760,6 +761,16 @@ class EMSet(Set, EMObject):
         """
         pass
 
+    def getMatrices(self, label='_transform._matrix', orderBy='id',
+                    direction='ASC', where='1'):
+        """ Return the matrices of all items (by default the ones of the
+        alignment transform) as a numpy array of shape (N, 4, 4),
+        without creating the items. Items without the matrix get nan values.
+        """
+        values = self.getColumnArrays([label], orderBy=orderBy,
+                                      direction=direction, where=where)[label]
+        return Matrix.valuesToMatrices(values)
+
     def copyItems(self, otherSet,
                   updateItemCallback=None,
                   itemDataIterator=None,
@@ -771,21 +782,9 @@ class EMSet(Set, EMObject):
         This is useful to set new attributes or update values
         for each item.
         """
-        for item in otherSet:
-            # copy items if enabled or copyDisabled=True
-            if copyDisabled or item.isEnabled():
-                newItem = item.clone()
-                if updateItemCallback:
-                    row = None if itemDataIterator is None \
-                        else next(itemDataIterator)
-                    updateItemCallback(newItem, row)
-                # If updateCallBack function returns attribute
-                # _appendItem to False do not append the item
-                if getattr(newItem, "_appendItem", True):
-                    self.append(newItem)
-            else:
-                if itemDataIterator is not None:
-                    next(itemDataIterator)  # just skip disabled data row
+        self._appendClones(otherSet, updateItemCallback=updateItemCallback,
+                           itemDataIterator=itemDataIterator,
+                           copyDisabled=copyDisabled)
 
     def getFiles(self):
         return Set.getFiles(self)
@@ -862,8 +861,9 @@ class SetOfImages(EMSet):
     def setIsAmplitudeCorrected(self, value):
         self._isAmplitudeCorrected.set(value)
 
-    def append(self, image):
-        """ Add a image to the set. """
+    def _prepareItem(self, image):
+        """ Set the values from the set that are shared by all images
+        before adding an image to the set. """
         # If the sampling rate was set before, the same value
         # will be set for each image added to the set
         if self.getSamplingRate() or not image.getSamplingRate():
@@ -881,7 +881,21 @@ class SetOfImages(EMSet):
         if self.isEmpty():
             self._setFirstDim(image)
 
-        EMSet.append(self, image)
+        EMSet._prepareItem(self, image)
+
+    def _getPreparedColumns(self):
+        """ Sampling rate and acquisition set by _prepareItem. """
+        columns = []
+        if self.getSamplingRate():
+            columns.append(('1', {'_samplingRate': self.getSamplingRate()}))
+        if self.hasAcquisition():
+            acqDict = self.getAcquisition().getObjDict()
+            noAcquisition = (Attr('_acquisition._voltage').isNull() |
+                             Attr('_acquisition._magnification').isNull())
+            columns.append((noAcquisition,
+                            dict(('_acquisition.%s' % k, v)
+                                 for k, v in acqDict.iteritems())))
+        return columns
 
     def _setFirstDim(self, image):
         """ Store dimensions when the first image is found.
@@ -890,6 +904,29 @@ class SetOfImages(EMSet):
         if self._firstDim.isEmpty():
             self._firstDim.set(image.getDim())
 
+    def appendFromSets(self, sets, **kwargs):
+        """ Add the items of other sets directly in the database.
+        Since the images are not iterated, the dimensions are taken
+        from the first input set with them.
+        """
+        for imgSet in sets:
+            if self._firstDim.isEmpty() and imgSet.getDim() is not None:
+                self._copyFirstDim(imgSet)
+        EMSet.appendFromSets(self, sets, **kwargs)
+
+    def copyItemsFrom(self, other, **kwargs):
+        """ Copy the items of other set, see Set.copyItemsFrom.
+        The items may not be iterated, so the dimensions are taken
+        from the other set.
+        """
+        if self._firstDim.isEmpty() and other.getDim() is not None:
+            self._copyFirstDim(other)
+        EMSet.copyItemsFrom(self, other, **kwargs)
+
+    def _copyFirstDim(self, other):
+        """ Use the dimensions stored in other set. """
+        self.setDim(other.getDim())
+
     def copyInfo(self, other):
         """ Copy basic information (sampling rate and ctf)
         from other set of images to current one"""
@@ -980,10 +1017,12 @@ class SetOfImages(EMSet):
         """ Return the string representing the dimensions. """
         return str(self._firstDim)
 
-    def iterItems(self, orderBy='id', direction='ASC', where='1'):
+    def iterItems(self, orderBy='id', direction='ASC', where='1',
+                  sinceId=None, prefetch=0):
         """ Redefine iteration to set the acquisition to images. """
         for img in Set.iterItems(self, orderBy=orderBy, direction=direction,
-                                 where=where):
+                                 where=where, sinceId=sinceId,
+                                 prefetch=prefetch):
             # Sometimes the images items in the set could
             # have the acquisition info per data row and we
             # don't want to override with the set acquisition for this case
@@ -1061,6 +1100,7 @@ class SetOfParticles(SetOfImages):
     """
     ITEM_TYPE = Particle
     REP_TYPE = Particle
+    INDEXES = ['_micId', '_classId']
 
     def __init__(self, **kwargs):
         SetOfImages.__init__(self, **kwargs)
@@ -1249,6 +1289,7 @@ class SetOfCoordinates(EMSet):
     The SetOfCoordinates can also have information about TiltPairs.
     """
     ITEM_TYPE = Coordinate
+    INDEXES = ['_micId']
 
     def __init__(self, **kwargs):
         EMSet.__init__(self, **kwargs)
@@ -1330,20 +1371,64 @@ class SetOfCoordinates(EMSet):
 
 
 class Matrix(Scalar):
+    """ 4x4 matrix stored in the databases as the binary data of its
+    16 values (little-endian doubles). Values stored as JSON text,
+    as done in previous versions, can also be read.
+    """
+    DTYPE = np.dtype('<f8')
+
     def __init__(self, **kwargs):
         Scalar.__init__(self, **kwargs)
         self._matrix = np.eye(4)
 
     def _convertValue(self, value):
-        """Value should be a str with comman separated values
-        or a list.
+        """Value can be the binary data, a JSON string or a numpy array.
         """
-        self._matrix = np.array(json.loads(value))
+        self._matrix = Matrix.valueToMatrix(value)
 
     def getObjValue(self):
-        self._objValue = json.dumps(self._matrix.tolist())
+        self._objValue = buffer(self._matrix.astype(self.DTYPE).tostring())
         return self._objValue
 
+    @staticmethod
+    def _isBinary(value):
+        return (isinstance(value, buffer) or
+                (isinstance(value, str) and not value.startswith('[')))
+
+    @staticmethod
+    def valueToMatrix(value):
+        """ Return a 4x4 numpy array from a stored value. """
+        if isinstance(value, np.ndarray):
+            return value
+        if Matrix._isBinary(value):
+            return np.frombuffer(value, dtype=Matrix.DTYPE).reshape(4, 4)\
+                .astype(float)
+        return np.array(json.loads(value))
+
+    @staticmethod
+    def valuesToMatrices(values):
+        """ Convert a list (or array) of stored values to a numpy array
+        of shape (N, 4, 4). The binary values are converted at once,
+        None values are returned as matrices of nan.
+        """
+        n = len(values)
+        matrices = np.empty((n, 4, 4))
+        isBinary = np.array([Matrix._isBinary(v) for v in values],
+                            dtype=bool).reshape(n)
+
+        if isBinary.any():
+            data = ''.join(str(v) for v, b in zip(values, isBinary) if b)
+            matrices[isBinary] = np.frombuffer(data, dtype=Matrix.DTYPE)\
+                .reshape(-1, 4, 4)
+
+        for i in np.flatnonzero(~isBinary):
+            if values[i] is None:
+                matrices[i] = np.nan
+            else:
+                matrices[i] = json.loads(values[i])
+
+        return matrices
+
     def setValue(self, i, j, value):
         self._matrix[i, j] = value
 
@@ -1462,22 +1547,90 @@ class SetOfClasses(EMSet):
     """ Store results from a classification. """
     ITEM_TYPE = None  # type of classes stored in the set
     REP_TYPE = None  # type of the representatives of each class
+    # Prefix of the tables with the items of all classes
+    # when they are stored with the single table layout
+    ITEMS_PREFIX = 'Items'
 
     def __init__(self, **kwargs):
+        """
+        Params:
+            singleTable: if True, the items of all classes are stored in
+                a single table indexed by the class id, instead of using
+                a table for each class. Existing sets are read with the
+                layout used to store them.
+        """
+        # Set before loading, since the layout of the file is checked then
+        Object.__setattr__(self, '_singleTable',
+                           kwargs.pop('singleTable', False))
         EMSet.__init__(self, **kwargs)
         # Store the average images of each class(SetOfParticles)
         self._representatives = Boolean(False)
         self._imagesPointer = Pointer()
 
+    def _isFlat(self):
+        """ Classes also store their items, so they can not be
+        copied directly in the database as other sets. """
+        return False
+
+    def load(self):
+        EMSet.load(self)
+        itemsTable = '%s_Objects' % self.ITEMS_PREFIX
+        if not self._singleTable and self._mapper.db.hasTable(itemsTable):
+            self._singleTable = True
+
+    def hasSingleTable(self):
+        """ Return True if the items of all classes are stored
+        in a single table. """
+        return self._singleTable
+
     def iterClassItems(self, iterDisabled=False):
         """ Iterate over the images of a class.
         Params:
             iterDisabled: If True, also include the disabled items. """
-        for cls in self.iterItems():
-            if iterDisabled or cls.isEnabled():
-                for img in cls:
-                    if iterDisabled or img.isEnabled():
-                        yield img
+        for _, items in self.iterClassesWithItems(iterDisabled):
+            for img in items:
+                yield img
+
+    def iterClassesWithItems(self, iterDisabled=False):
+        """ Iterate over the classes together with their items.
+        Yield (classItem, items) pairs, where items is an iterator over
+        the items of the class, that should be used before moving to the
+        next class. With the single table layout, the items of all
+        classes are read in one pass instead of a query per class.
+        Params:
+            iterDisabled: If True, also include the disabled classes
+                and items.
+        """
+        if not self._singleTable:
+            for cls in self.iterItems():
+                if iterDisabled or cls.isEnabled():
+                    yield cls, (img for img in cls
+                                if iterDisabled or img.isEnabled())
+            return
+
+        mapper = self._MapperClass(self.getFileName(),
+                                   self._loadClassesDict(), self.ITEMS_PREFIX)
+        try:
+            rows = mapper.selectAllByClass(
+                where='1' if iterDisabled else 'enabled=1')
+            # Keep the next (classId, item) pair to be read
+            nextRow = [next(rows, None)]
+            for cls in self.iterItems():
+                if iterDisabled or cls.isEnabled():
+                    yield cls, self.__iterClassRows(rows, nextRow,
+                                                    cls.getObjId())
+        finally:
+            mapper.close()
+
+    @staticmethod
+    def __iterClassRows(rows, nextRow, classId):
+        """ Yield the items of a class from the (classId, item) pairs
+        ordered by class, skipping the ones of previous classes.
+        """
+        while nextRow[0] is not None and nextRow[0][0] <= classId:
+            if nextRow[0][0] == classId:
+                yield nextRow[0][1]
+            nextRow[0] = next(rows, None)
 
     def hasRepresentatives(self):
         return self._representatives.get()
@@ -1499,7 +1652,15 @@ class SetOfClasses(EMSet):
         """ Set the mapper path of this class according to the mapper
         path of the SetOfClasses and also the prefix according to class id
         """
-        classPrefix = 'Class%03d' % classItem.getObjId()
+        # The same item is reused while iterating, so release
+        # the mapper of the previous class
+        classItem.close()
+        if self._singleTable:
+            from pyworkflow.mapper.sqlite import SqliteFlatDb
+            classPrefix = SqliteFlatDb.getClassPrefix(self.ITEMS_PREFIX,
+                                                      classItem.getObjId())
+        else:
+            classPrefix = 'Class%03d' % classItem.getObjId()
         classItem._mapperPath.set('%s,%s' % (self.getFileName(), classPrefix))
         classItem._mapperPath.setStore(False)
         classItem.load()
@@ -1515,6 +1676,13 @@ class SetOfClasses(EMSet):
         EMSet._insertItem(self, classItem)
         classItem.write(properties=False)  # Set.write(self)
 
+    def appendMany(self, items, batchSize=1000):
+        """ Classes can not be inserted in bulk since each one
+        needs to create the table for its own items.
+        """
+        for classItem in items:
+            self.append(classItem)
+
     def __getitem__(self, itemId):
         """ Setup the mapper classes before returning the item. """
         classItem = EMSet.__getitem__(self, itemId)
@@ -1526,9 +1694,12 @@ class SetOfClasses(EMSet):
         self._setItemMapperPath(classItem)
         return classItem
 
-    def iterItems(self, orderBy='id', direction='ASC'):
+    def iterItems(self, orderBy='id', direction='ASC', sinceId=None,
+                  prefetch=0):
         for classItem in EMSet.iterItems(self, orderBy=orderBy,
-                                         direction=direction):
+                                         direction=direction,
+                                         sinceId=sinceId,
+                                         prefetch=prefetch):
             self._setItemMapperPath(classItem)
             yield classItem
 
@@ -1598,10 +1769,21 @@ class SetOfClasses(EMSet):
         the iterator in itemDataIterator. The callback function should
         set the classId of the image that will be used to classify it.
         It is also possible to pass a callback to update the class properties.
+        If no updateItemCallback is passed, the classId already stored in
+        the items is used and, if the images are a flat set, the items of
+        each class are copied in the database (see Set.copyItemsFrom).
         """
-        clsDict = {}  # Dictionary to store the (classId, classSet) pairs
         inputSet = self.getImages()
         iterParams = iterParams or {}
+        where = iterParams.get('where', '1')
+
+        if (updateItemCallback is None and inputSet._isFlat() and
+                (isinstance(where, Expr) or where == '1')):
+            self._classifyItemsFrom(inputSet, where, updateClassCallback,
+                                    classifyDisabled)
+            return
+
+        clsDict = {}  # Dictionary to store the (classId, classSet) pairs
 
         for item in inputSet.iterItems(**iterParams):
             # copy items if enabled or copyDisabled=True
@@ -1622,18 +1804,9 @@ class SetOfClasses(EMSet):
                 # Register a new class set if the ref was not found.
                 # if not ref in clsDict:
                 if ref not in clsDict:
-                    classItem = self.ITEM_TYPE(objId=ref)
-                    rep = self.REP_TYPE()
-                    classItem.setRepresentative(rep)
-                    clsDict[ref] = classItem
-                    classItem.copyInfo(inputSet)
-                    classItem.setAcquisition(inputSet.getAcquisition())
-                    if updateClassCallback is not None:
-                        updateClassCallback(classItem)
-                    self.append(classItem)
-                else:
-                    classItem = clsDict[ref]
-                classItem.append(newItem)
+                    clsDict[ref] = self._createClassItem(ref, inputSet,
+                                                         updateClassCallback)
+                clsDict[ref].append(newItem)
             else:
                 if itemDataIterator is not None:
                     next(itemDataIterator)  # just skip disabled data row
@@ -1641,6 +1814,42 @@ class SetOfClasses(EMSet):
         for classItem in clsDict.values():
             self.update(classItem)
 
+    def _classifyItemsFrom(self, inputSet, where, updateClassCallback,
+                           classifyDisabled):
+        """ Classify the items by the classId stored in them, copying
+        the items of each class from the flat inputSet in the database.
+        """
+        arrays = inputSet.getColumnArrays(['_classId', 'enabled'],
+                                          where=where)
+        classIds = arrays['_classId']
+        if not classifyDisabled:
+            classIds = classIds[arrays['enabled'] == 1]
+        if np.isnan(classIds).any():
+            raise Exception('Particle classId is None!!!')
+
+        for ref in np.unique(classIds).astype(int).tolist():
+            classItem = self._createClassItem(ref, inputSet,
+                                              updateClassCallback)
+            classWhere = Attr('_classId') == ref
+            if isinstance(where, Expr):
+                classWhere = where & classWhere
+            classItem.copyItemsFrom(inputSet, where=classWhere,
+                                    copyDisabled=classifyDisabled)
+            self.update(classItem)
+
+    def _createClassItem(self, classId, inputSet, updateClassCallback=None):
+        """ Create a new class with the info of the inputSet
+        and append it to this set. """
+        classItem = self.ITEM_TYPE(objId=classId)
+        rep = self.REP_TYPE()
+        classItem.setRepresentative(rep)
+        classItem.copyInfo(inputSet)
+        classItem.setAcquisition(inputSet.getAcquisition())
+        if updateClassCallback is not None:
+            updateClassCallback(classItem)
+        self.append(classItem)
+        return classItem
+
 
 class SetOfClasses2D(SetOfClasses):
     """ Store results from a 2D classification of Particles. """
@@ -1897,6 +2106,10 @@ class SetOfMovies(SetOfMicrographsBase):
             self._firstDim.set(image.getDim())
             self._firstFramesRange.set(image.getFramesRange())
 
+    def _copyFirstDim(self, other):
+        SetOfMicrographsBase._copyFirstDim(self, other)
+        self._firstFramesRange.set(other.getFramesRange())
+
     def _dimStr(self):
         """ Return the string representing the dimensions. """
         if self._firstDim.isEmpty():
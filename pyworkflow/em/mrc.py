@@ -0,0 +1,334 @@
+# **************************************************************************
+# *
+# * Authors:     agent (agent@local)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+This module provides access to MRC files (.mrc and .mrcs) using only
+numpy. The data is exposed as numpy.memmap arrays, so images of big
+stacks can be read and written in place without loading the whole file
+in memory.
+
+Following the Xmipp convention, .mrcs files (or filenames ending with the
+:mrcs suffix) are considered stacks of 2D images, while .mrc files
+(or the :mrc suffix) are considered volumes.
+"""
+
+import os
+
+import numpy as np
+
+
+MRC_HEADER_SIZE = 1024
+
+# MRC modes supported
+MODE_INT8 = 0
+MODE_INT16 = 1
+MODE_FLOAT32 = 2
+MODE_UINT16 = 6
+MODE_FLOAT16 = 12
+
+MODE_DTYPES = {MODE_INT8: 'i1',
+               MODE_INT16: 'i2',
+               MODE_FLOAT32: 'f4',
+               MODE_UINT16: 'u2',
+               MODE_FLOAT16: 'f2'
+               }
+
+# Number of images processed at once when computing over stacks
+CHUNK_SIZE = 64
+
+HEADER_DTYPE = np.dtype([('nx', 'i4'), ('ny', 'i4'), ('nz', 'i4'),
+                         ('mode', 'i4'),
+                         ('nxstart', 'i4'), ('nystart', 'i4'),
+                         ('nzstart', 'i4'),
+                         ('mx', 'i4'), ('my', 'i4'), ('mz', 'i4'),
+                         ('cella', 'f4', 3), ('cellb', 'f4', 3),
+                         ('mapc', 'i4'), ('mapr', 'i4'), ('maps', 'i4'),
+                         ('dmin', 'f4'), ('dmax', 'f4'), ('dmean', 'f4'),
+                         ('ispg', 'i4'), ('nsymbt', 'i4'),
+                         ('extra1', 'S8'), ('exttyp', 'S4'),
+                         ('nversion', 'i4'), ('extra2', 'S84'),
+                         ('origin', 'f4', 3), ('map', 'S4'),
+                         ('machst', 'u1', 4), ('rms', 'f4'),
+                         ('nlabl', 'i4'), ('label', 'S80', 10)])
+
+
+def splitFileName(filename):
+    """ Remove the :mrc or :mrcs suffix from the filename.
+    Return a tuple (filename, isStack), isStack is None if
+    it can not be inferred from the filename.
+    """
+    if filename.endswith(':mrcs'):
+        return filename[:-5], True
+    if filename.endswith(':mrc'):
+        return filename[:-4], False
+
+    ext = os.path.splitext(filename)[1].lower()
+    if ext == '.mrcs':
+        return filename, True
+    if ext == '.mrc':
+        return filename, False
+
+    return filename, None
+
+
+def isMrcFile(filename):
+    """ Return True if the filename is a .mrc or .mrcs file. """
+    return splitFileName(filename)[1] is not None
+
+
+def isMrcStack(filename):
+    """ Return True if the filename is a .mrcs file or has
+    the :mrcs suffix.
+    """
+    return splitFileName(filename)[1] is True
+
+
+def readHeader(filename):
+    """ Read the 1024 bytes header of an MRC file.
+    Return it as a numpy record with the proper byte order.
+    """
+    with open(filename, 'rb') as f:
+        buf = f.read(MRC_HEADER_SIZE)
+
+    if len(buf) < MRC_HEADER_SIZE:
+        raise Exception("Invalid MRC file '%s': header too short" % filename)
+
+    header = np.frombuffer(buf, dtype=HEADER_DTYPE)[0]
+
+    # Machine stamp 0x11 0x11 is used for big-endian files, use also
+    # the mode value for old files without a proper machine stamp
+    if header['machst'][0] == 0x11 or header['mode'] not in MODE_DTYPES:
+        header = np.frombuffer(buf, dtype=HEADER_DTYPE.newbyteorder('>'))[0]
+
+    if header['mode'] not in MODE_DTYPES:
+        raise Exception("Unsupported MRC mode %d in file '%s'"
+                        % (header['mode'], filename))
+
+    return header
+
+
+class MrcFile(object):
+    """ Give access to the data of an MRC file as a numpy memmap
+    of shape (nz, ny, nx). For stacks, nz is the number of images.
+    Params:
+        filename: the file, it can contain :mrc or :mrcs suffix.
+        mode: 'r' for read only access and 'r+' to modify the data.
+        isStack: force the file to be treated as stack or volume,
+            by default it is inferred from the filename.
+    """
+    def __init__(self, filename, mode='r', isStack=None):
+        fn, fnIsStack = splitFileName(filename)
+        self._filename = fn
+        self._mode = mode
+        self._isStack = fnIsStack if isStack is None else isStack
+        self._header = readHeader(fn)
+        h = self._header
+        dtype = np.dtype(MODE_DTYPES[int(h['mode'])])
+        dtype = dtype.newbyteorder(h.dtype['nx'].byteorder)
+        self._data = np.memmap(fn, dtype=dtype, mode=mode,
+                               offset=MRC_HEADER_SIZE + int(h['nsymbt']),
+                               shape=(int(h['nz']), int(h['ny']),
+                                      int(h['nx'])))
+
+    def getFileName(self):
+        return self._filename
+
+    def getHeader(self):
+        return self._header
+
+    def getMode(self):
+        """ Return the MRC mode of the data. """
+        return int(self._header['mode'])
+
+    def isStack(self):
+        return bool(self._isStack)
+
+    def getDimensions(self):
+        """ Return the dimensions as (x, y, z, n), the same as
+        ImageHandler.getDimensions.
+        """
+        z, y, x = self._data.shape
+        if self.isStack():
+            return x, y, 1, z
+        return x, y, z, 1
+
+    def getSize(self):
+        """ Return the number of images in the stack (1 for volumes). """
+        return self.getDimensions()[3]
+
+    def getExtendedHeader(self):
+        """ Return the bytes of the extended header (if any). """
+        nsymbt = int(self._header['nsymbt'])
+        if not nsymbt:
+            return ''
+        with open(self._filename, 'rb') as f:
+            f.seek(MRC_HEADER_SIZE)
+            return f.read(nsymbt)
+
+    def getData(self):
+        """ Return the memmap with all the data. """
+        return self._data
+
+    def getImage(self, index):
+        """ Return a view of the image in the given position
+        of the stack (starting at 1).
+        """
+        return self._data[index - 1]
+
+    def setImage(self, index, data):
+        """ Write the data of the image in the given position
+        of the stack (starting at 1).
+        """
+        self._data[index - 1] = data
+
+    def iterChunks(self, chunkSize=CHUNK_SIZE):
+        """ Iterate over the data in blocks of chunkSize slices. """
+        for i in range(0, self._data.shape[0], chunkSize):
+            yield self._data[i:i + chunkSize]
+
+    def computeStats(self):
+        """ Compute min, max, mean and rms (standard deviation) of the
+        data processing the stack by chunks.
+        """
+        n = self._data.size
+        dmin, dmax = np.inf, -np.inf
+        dsum, dsum2 = 0., 0.
+
+        for chunk in self.iterChunks():
+            chunk = chunk.astype(np.float64)
+            dmin = min(dmin, chunk.min())
+            dmax = max(dmax, chunk.max())
+            dsum += chunk.sum()
+            dsum2 += np.square(chunk).sum()
+
+        mean = dsum / n
+        rms = np.sqrt(max(dsum2 / n - mean * mean, 0.))
+
+        return dmin, dmax, mean, rms
+
+    def updateStats(self):
+        """ Compute the statistics of the data and store them
+        in the header. The file should be opened with mode 'r+'.
+        """
+        h = self._header.copy()
+        h['dmin'], h['dmax'], h['dmean'], h['rms'] = self.computeStats()
+        self._writeHeader(h)
+
+    def _writeHeader(self, header):
+        self._data.flush()
+        with open(self._filename, 'r+b') as f:
+            f.write(header.tostring())
+        self._header = header
+
+    def flush(self):
+        self._data.flush()
+
+    def close(self):
+        """ Flush the data (if writable) and release the memmap. """
+        if self._mode != 'r':
+            self.flush()
+        self._data = None
+
+
+def createMrcFile(filename, dims, mode=MODE_FLOAT32, samplingRate=1.0):
+    """ Create a new MRC file with the given dimensions (x, y, z, n)
+    reserving the space for the data. Return an MrcFile opened
+    for writing so the images can be filled in place.
+    """
+    fn, isStack = splitFileName(filename)
+    x, y, z, n = dims
+
+    if z > 1 and n > 1:
+        raise Exception("Stacks of volumes are not supported")
+
+    nz = max(z, n)
+    isStack = n > 1 if isStack is None else isStack
+
+    h = np.zeros(1, dtype=HEADER_DTYPE)[0]
+    h['nx'], h['ny'], h['nz'] = x, y, nz
+    h['mode'] = mode
+    h['mx'], h['my'] = x, y
+    h['mz'] = 1 if isStack else nz
+    h['cella'] = (x * samplingRate, y * samplingRate,
+                  (1 if isStack else nz) * samplingRate)
+    h['cellb'] = (90., 90., 90.)
+    h['mapc'], h['mapr'], h['maps'] = 1, 2, 3
+    h['ispg'] = 0 if isStack else 1
+    h['exttyp'] = 'MRCO'
+    h['nversion'] = 20140
+    h['map'] = 'MAP '
+    h['machst'] = (0x44, 0x44, 0, 0) if np.little_endian else (0x11, 0x11, 0, 0)
+    size = x * y * nz * np.dtype(MODE_DTYPES[mode]).itemsize
+
+    with open(fn, 'wb') as f:
+        f.write(h.tostring())
+        f.truncate(MRC_HEADER_SIZE + size)
+
+    return MrcFile(fn, mode='r+', isStack=isStack)
+
+
+def computeAverage(filename):
+    """ Compute the average image of an MRC stack. """
+    mrc = MrcFile(filename, isStack=True)
+    avg = np.zeros(mrc.getData().shape[1:], dtype=np.float64)
+
+    for chunk in mrc.iterChunks():
+        avg += chunk.sum(axis=0, dtype=np.float64)
+
+    return (avg / mrc.getSize()).astype(np.float32)
+
+
+def extractSubset(inputFn, outputFn, indexes):
+    """ Write in outputFn the images of the input stack in the given
+    positions (starting at 1), keeping the same MRC mode.
+    """
+    mrcIn = MrcFile(inputFn, isStack=True)
+    x, y, _, _ = mrcIn.getDimensions()
+    mrcOut = createMrcFile(outputFn, (x, y, 1, len(indexes)),
+                           mode=mrcIn.getMode())
+
+    for i, index in enumerate(indexes):
+        mrcOut.setImage(i + 1, mrcIn.getImage(index))
+
+    mrcOut.updateStats()
+    mrcOut.close()
+
+
+def invertStack(inputFn, outputFn):
+    """ Write in outputFn the images of the input stack with the
+    contrast inverted (multiplied by -1).
+    """
+    mrcIn = MrcFile(inputFn, isStack=True)
+    mode = mrcIn.getMode()
+    if mode == MODE_UINT16:  # inverted values need a signed type
+        mode = MODE_FLOAT32
+    mrcOut = createMrcFile(outputFn, mrcIn.getDimensions(), mode=mode)
+    dataOut = mrcOut.getData()
+    i = 0
+
+    for chunk in mrcIn.iterChunks():
+        dataOut[i:i + len(chunk)] = -chunk.astype(dataOut.dtype)
+        i += len(chunk)
+
+    mrcOut.updateStats()
+    mrcOut.close()
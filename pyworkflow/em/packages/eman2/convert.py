@@ -185,7 +185,10 @@ def writeSetOfParticles(partSet, path, **kwargs):
     for i, part in iterParticlesByMic(partSet):
         micId = part.getMicId()
         objDict = part.getObjDict()
-        
+        # The matrix is stored as binary data that can not be encoded
+        # in json, the alignment is passed as shifts and angles
+        objDict.pop('_transform._matrix', None)
+
         if not micId:
             micId = 0
         
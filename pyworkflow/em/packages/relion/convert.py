@@ -39,6 +39,7 @@ from pyworkflow.utils.path import (createLink, cleanPath, copyFile,
 import pyworkflow.em as em
 import pyworkflow.em.metadata as md
 from pyworkflow.em.packages.relion.constants import V1_3, V1_4, V2_0, V2_1
+import star
 
 # This dictionary will be used to map
 # between CTFModel properties and Xmipp labels
@@ -347,6 +348,61 @@ def matrixFromGeometry(shifts, angles, inverseTransform):
     return M
 
 
+def geometryFromMatrices(matrices, inverseTransform):
+    """ Same as geometryFromMatrix, but for an array of matrices with
+    shape (N, 4, 4). Return the shifts and angles as arrays of shape
+    (N, 3), computed for all matrices at once.
+    """
+    if inverseTransform:
+        matrices = numpy.linalg.inv(matrices)
+        shifts = -matrices[:, :3, 3]
+    else:
+        shifts = matrices[:, :3, 3].copy()
+
+    # Same as euler_from_matrix with axes 'szyz'
+    M = matrices
+    sy = numpy.sqrt(M[:, 2, 1] ** 2 + M[:, 2, 0] ** 2)
+    valid = sy > numpy.finfo(float).eps * 4.0
+    ax = numpy.where(valid, numpy.arctan2(M[:, 2, 1], M[:, 2, 0]),
+                     numpy.arctan2(-M[:, 1, 0], M[:, 1, 1]))
+    ay = numpy.arctan2(sy, M[:, 2, 2])
+    az = numpy.where(valid, numpy.arctan2(M[:, 1, 2], -M[:, 0, 2]), 0.)
+    angles = numpy.rad2deg(numpy.column_stack((ax, ay, az)))
+
+    return shifts, angles
+
+
+def matricesFromGeometry(shifts, angles, inverseTransform):
+    """ Same as matrixFromGeometry, but for arrays of shifts and angles
+    with shape (N, 3). Return an array of matrices of shape (N, 4, 4).
+    """
+    # Same as euler_matrix with axes 'szyz'
+    ai, aj, ak = numpy.deg2rad(angles).T
+    si, sj, sk = numpy.sin(ai), numpy.sin(aj), numpy.sin(ak)
+    ci, cj, ck = numpy.cos(ai), numpy.cos(aj), numpy.cos(ak)
+    cc, cs = ci * ck, ci * sk
+    sc, ss = si * ck, si * sk
+
+    M = numpy.tile(numpy.identity(4), (len(angles), 1, 1))
+    M[:, 2, 2] = cj
+    M[:, 2, 1] = sj * si
+    M[:, 2, 0] = sj * ci
+    M[:, 1, 2] = sj * sk
+    M[:, 1, 1] = -cj * ss + cc
+    M[:, 1, 0] = -cj * cs - sc
+    M[:, 0, 2] = -sj * ck
+    M[:, 0, 1] = cj * sc + cs
+    M[:, 0, 0] = cj * cc - ss
+
+    if inverseTransform:
+        M[:, :3, 3] = -shifts[:, :3]
+        M = numpy.linalg.inv(M)
+    else:
+        M[:, :3, 3] = shifts[:, :3]
+
+    return M
+
+
 def alignmentToRow(alignment, alignmentRow, alignType):
     """
     is2D == True-> matrix is 2D (2D images alignment)
@@ -572,24 +628,245 @@ def rowToParticle(partRow, **kwargs):
     return img
 
 
+def readStarTable(filename, removeDisabled=True):
+    """ Read a block of a STAR file with the numpy STAR reader.
+    The filename can be in the form block@file.star, otherwise the
+    first block of the file is read (as done by Xmipp MetaData).
+    """
+    if '@' in filename:
+        blockName, starFile = filename.split('@', 1)
+        table = star.readStar(starFile, blockName)
+    else:
+        tables = star.readStar(filename)
+        table = tables.values()[0] if tables else star.Table()
+
+    # Xmipp marks disabled items with enabled = -1
+    if removeDisabled and table.hasColumn('enabled'):
+        table.filterRows(table.getColumn('enabled') != -1)
+
+    return table
+
+
+def iterStarRows(filename, removeDisabled=True):
+    """ Iterate over the rows of a STAR file block as md.Row objects,
+    so they can be used by functions like rowToParticle.
+    The whole block is parsed at once and each column is converted
+    to the Python type of its metadata label.
+    Columns that are not valid metadata labels are ignored.
+    """
+    table = readStarTable(filename, removeDisabled)
+    labels = []
+    columns = []
+
+    for colName in table.getColumnNames():
+        if md.isValidLabel(colName):
+            label = md.str2Label(colName)
+            labelType = md.label2Python(label)
+            labels.append(label)
+            columns.append(table.getColumn(colName).astype(labelType).tolist())
+
+    for values in izip(*columns):
+        row = md.Row()
+        for label, value in izip(labels, values):
+            row.setValue(label, value)
+        yield row
+
+
 def readSetOfParticles(filename, partSet, **kwargs):
     """read from Relion image meta
         filename: The metadata filename where the image are.
         imgSet: the SetOfParticles that will be populated.
         rowToParticle: this function will be used to convert the row to Object
-    """    
-    imgMd = md.MetaData(filename)
+    """
     # By default remove disabled items from metadata
     # be careful if you need to preserve the original number of items
-    if kwargs.get('removeDisabled', True):
-        imgMd.removeDisabled()
-    
-    for imgRow in md.iterRows(imgMd):
-        img = rowToParticle(imgRow, **kwargs)
-        partSet.append(img)
-        
+    removeDisabled = kwargs.get('removeDisabled', True)
+
+    if filename.endswith('.star') and not _hasRowHooks(kwargs):
+        table = readStarTable(filename, removeDisabled)
+        img = _tableToParticles(table, partSet, **kwargs)
+    else:
+        if filename.endswith('.star'):
+            rows = iterStarRows(filename, removeDisabled)
+        else:
+            imgMd = md.MetaData(filename)
+            if removeDisabled:
+                imgMd.removeDisabled()
+            rows = md.iterRows(imgMd)
+
+        for imgRow in rows:
+            img = rowToParticle(imgRow, **kwargs)
+            partSet.append(img)
+
     partSet.setHasCTF(img.hasCTF())
     partSet.setAlignment(kwargs['alignType'])
+
+
+def _hasRowHooks(kwargs):
+    """ Return True if the functions to pre/post-process each row
+    are passed, so the particles should be converted row by row.
+    """
+    return bool(kwargs.get('preprocessImageRow') or
+                kwargs.get('postprocessImageRow'))
+
+
+def _tableToParticles(table, partSet, **kwargs):
+    """ Same as appending to partSet the rowToParticle of each row of
+    the table, but the values of each column are converted at once.
+    All rows have the same labels, so a single particle with the
+    attributes for these labels is filled with the values of each row
+    and stored with partSet.appendMany. Return this particle.
+    """
+    n = len(table)
+    img = em.Particle()
+    setters = []
+
+    def _hasLabel(label):
+        return table.hasColumn(md.label2Str(label))
+
+    def _getColumn(label, default=None):
+        if _hasLabel(label):
+            return table.getColumn(md.label2Str(label)).astype(
+                md.label2Python(label))
+        return numpy.repeat(default, n)
+
+    def _addSetter(setFunc, values):
+        setters.append((setFunc, list(values)))
+
+    def _addAttributes(obj, attrDict, extraLabels=[]):
+        """ Same as rowToObject, adding the setters of the columns. """
+        _addSetter(obj.setEnabled,
+                   (_getColumn(md.RLN_IMAGE_ENABLED, 1) > 0).tolist())
+
+        for attr, label in attrDict.iteritems():
+            _addSetter(getattr(obj, attr).set, _getColumn(label).tolist())
+
+        attrLabels = attrDict.values()
+
+        for label in extraLabels:
+            if label not in attrLabels and _hasLabel(label):
+                attrObj = ObjectWrap(md.label2Python(label)())
+                setattr(obj, '_' + md.label2Str(label), attrObj)
+                _addSetter(attrObj.set, _getColumn(label).tolist())
+
+    if n:
+        # Decompose Relion filenames
+        imgNames = _getColumn(md.RLN_IMAGE_NAME).astype(str)
+        parts = numpy.char.partition(imgNames, '@')
+        hasIndex = parts[:, 1] == '@'
+        indexes = numpy.repeat(em.NO_INDEX, n)
+        indexes[hasIndex] = parts[hasIndex, 0].astype(int)
+        filenames = numpy.where(hasIndex, parts[:, 2], parts[:, 0])
+        _addSetter(img.setLocation, zip(indexes.tolist(), filenames.tolist()))
+
+    if _hasLabel(md.RLN_PARTICLE_CLASS):
+        _addSetter(img.setClassId, _getColumn(md.RLN_PARTICLE_CLASS).tolist())
+
+    if (kwargs.get('readCtf', True) and
+            all(_hasLabel(label) for label in CTF_DICT.values())):
+        ctfModel = em.CTFModel()
+        img.setCTF(ctfModel)
+        _addAttributes(ctfModel, {}, CTF_EXTRA_LABELS)
+        if _hasLabel(md.RLN_CTF_PHASESHIFT):
+            ctfModel.setPhaseShift(0.)
+            _addSetter(ctfModel._phaseShift.set,
+                       _getColumn(md.RLN_CTF_PHASESHIFT).tolist())
+        # Same as CTFModel.standardize for all rows
+        defocusU, defocusV, defocusAngle = [_getColumn(label)
+                                            for label in CTF_DICT.values()]
+        swap = defocusV > defocusU
+        defocusU, defocusV = (numpy.where(swap, defocusV, defocusU),
+                              numpy.where(swap, defocusU, defocusV))
+        defocusAngle = numpy.where(swap, defocusAngle + 90., defocusAngle)
+        defocusAngle = numpy.where(defocusAngle >= 180., defocusAngle - 180.,
+                                   numpy.where(defocusAngle < 0.,
+                                               defocusAngle + 180.,
+                                               defocusAngle))
+        for attr, values in [('_defocusU', defocusU),
+                             ('_defocusV', defocusV),
+                             ('_defocusAngle', defocusAngle),
+                             ('_defocusRatio', defocusU / defocusV)]:
+            _addSetter(getattr(ctfModel, attr).set, values.tolist())
+        for attr, label in CTF_PSD_DICT.iteritems():
+            if _hasLabel(label):
+                setattr(ctfModel, attr, String())
+                _addSetter(getattr(ctfModel, attr).set,
+                           _getColumn(label).tolist())
+
+    alignType = kwargs.get('alignType')
+
+    if alignType != em.ALIGN_NONE:
+        if alignType == em.ALIGN_3D:
+            raise Exception("3D alignment conversion for Relion not "
+                            "implemented.")
+        if any(_hasLabel(label) for label in ALIGNMENT_DICT.values()):
+            angles = numpy.zeros((n, 3))
+            shifts = numpy.zeros((n, 3))
+            shifts[:, 0] = _getColumn(md.RLN_ORIENT_ORIGIN_X, 0.)
+            shifts[:, 1] = _getColumn(md.RLN_ORIENT_ORIGIN_Y, 0.)
+            if alignType != em.ALIGN_2D:
+                angles[:, 0] = _getColumn(md.RLN_ORIENT_ROT, 0.)
+                angles[:, 1] = _getColumn(md.RLN_ORIENT_TILT, 0.)
+                angles[:, 2] = _getColumn(md.RLN_ORIENT_PSI, 0.)
+                shifts[:, 2] = _getColumn(md.RLN_ORIENT_ORIGIN_Z, 0.)
+            else:
+                angles[:, 2] = - _getColumn(md.RLN_ORIENT_PSI, 0.)
+            transform = em.Transform()
+            img.setTransform(transform)
+            _addSetter(transform.setMatrix,
+                       matricesFromGeometry(shifts, angles,
+                                            alignType == em.ALIGN_PROJ))
+
+    if (kwargs.get('readAcquisition', True) and
+            all(_hasLabel(label) for label in ACQUISITION_DICT.values())):
+        acquisition = em.Acquisition()
+        img.setAcquisition(acquisition)
+        _addAttributes(acquisition, ACQUISITION_DICT)
+
+    if kwargs.get('magnification', None):
+        # Set after the setters, so the acquisition values are replaced
+        magnification = kwargs.get("magnification")
+        _addSetter(img.getAcquisition().setMagnification,
+                   numpy.repeat(magnification, n))
+
+    _addSetter(img.setObjId, _getColumn(md.RLN_IMAGE_ID).tolist())
+    # Read some extra labels
+    _addAttributes(img, {},
+                   IMAGE_EXTRA_LABELS + kwargs.get('extraLabels', []))
+
+    if all(_hasLabel(label) for label in COOR_DICT.values()):
+        coord = em.Coordinate()
+        img.setCoordinate(coord)
+        _addAttributes(coord, COOR_DICT, COOR_EXTRA_LABELS)
+        micNames = numpy.repeat(None, n)
+        if _hasLabel(md.RLN_MICROGRAPH_ID):
+            micIds = _getColumn(md.RLN_MICROGRAPH_ID).astype(int)
+            _addSetter(coord.setMicId, micIds.tolist())
+            # If RLN_MICROGRAPH_NAME is not present, use the id as a name
+            micNames = micIds
+        if _hasLabel(md.RLN_MICROGRAPH_NAME):
+            micNames = _getColumn(md.RLN_MICROGRAPH_NAME)
+        _addSetter(coord.setMicName, micNames.tolist())
+
+    # copy micId if available from row to particle
+    if _hasLabel(md.RLN_MICROGRAPH_ID):
+        _addSetter(img.setMicId, _getColumn(md.RLN_MICROGRAPH_ID).tolist())
+
+    # copy particleId if available from row to particle
+    if _hasLabel(md.RLN_PARTICLE_ID):
+        img._rlnParticleId = Integer()
+        _addSetter(img._rlnParticleId.set,
+                   _getColumn(md.RLN_PARTICLE_ID).tolist())
+
+    def _iterParticles():
+        for i in xrange(n):
+            for setFunc, values in setters:
+                setFunc(values[i])
+            yield img
+
+    partSet.appendMany(_iterParticles())
+
+    return img
     
 
 def setOfImagesToMd(imgSet, imgMd, imgToFunc, **kwargs):
@@ -611,6 +888,281 @@ def setOfImagesToMd(imgSet, imgMd, imgToFunc, **kwargs):
         imgRow.writeToMd(imgMd, objId)
 
 
+def setOfImagesToTable(imgSet, imgToFunc, blockName, **kwargs):
+    """ Same as setOfImagesToMd, but the rows are stored by columns
+    in a star.Table that can be written at once.
+    Missing values in some rows are filled with the label default.
+    Particles are converted reading the columns of the set, without
+    creating the rows, unless the row hooks are passed.
+    """
+    if 'alignType' not in kwargs:
+        kwargs['alignType'] = imgSet.getAlignment()
+
+    if (imgToFunc is particleToRow and not _hasRowHooks(kwargs) and
+            kwargs['alignType'] != em.ALIGN_3D):
+        return _particlesToTable(imgSet, blockName, **kwargs)
+
+    columns = OrderedDict()
+    n = 0
+
+    for img in imgSet:
+        imgRow = md.Row()
+        imgToFunc(img, imgRow, **kwargs)
+        for label, value in imgRow:
+            if label not in columns:
+                columns[label] = [None] * n
+            columns[label].append(value)
+        n += 1
+        for values in columns.itervalues():
+            if len(values) < n:
+                values.append(None)
+
+    table = star.Table(blockName)
+
+    for label, values in columns.iteritems():
+        labelType = md.label2Python(label)
+        default = labelType()
+        table.setColumn(md.label2Str(label),
+                        [default if v is None else labelType(v)
+                         for v in values])
+
+    return table
+
+
+def _hasValues(values):
+    """ Return a mask with the values of the array that are not
+    missing (None or nan).
+    """
+    if values.dtype.kind == 'f':
+        return ~numpy.isnan(values)
+    if values.dtype.kind == 'O':
+        return ~numpy.equal(values, None)
+    return numpy.ones(len(values), dtype=bool)
+
+
+def _labelColumn(label, values, valid=None):
+    """ Convert an array of values to the type of the label. Missing
+    values, and the ones where valid is False, are set to the label
+    default (as done by setOfImagesToTable for rows without the label).
+    """
+    labelType = md.label2Python(label)
+    missing = ~_hasValues(values)
+    if valid is not None:
+        missing |= ~valid
+    if missing.any():
+        values = values.astype(object)
+        values[missing] = labelType()
+    return values.astype(labelType)
+
+
+def _extraAttributes(obj, prefix, extraLabels, attrDict={}):
+    """ Return a list of (label, attribute name) with the extra labels
+    written by objectToRow for obj. Attribute names are prefixed to
+    be used with Set.getColumnArrays.
+    """
+    attrLabels = attrDict.values()
+    extraAttrs = []
+
+    for label in extraLabels:
+        attrName = '_' + md.label2Str(label)
+        if label not in attrLabels and obj.hasAttribute(attrName):
+            extraAttrs.append((label, prefix + attrName))
+
+    return extraAttrs
+
+
+def _locationsToRelion(indexes, filenames, filesDict):
+    """ Same as locationToRelion for arrays of indexes and filenames,
+    replacing first the filenames mapped in filesDict.
+    """
+    uniqueNames, inverse = numpy.unique(filenames.astype(str),
+                                        return_inverse=True)
+    filenames = numpy.array([filesDict.get(fn, fn) for fn in uniqueNames],
+                            dtype=str)[inverse]
+    hasIndex = _hasValues(indexes)
+    hasIndex[hasIndex] = indexes[hasIndex] != em.NO_INDEX
+    locations = filenames.astype(object)
+    locations[hasIndex] = numpy.char.add(
+        numpy.char.mod('%06d@', indexes[hasIndex].astype(int)),
+        filenames[hasIndex])
+
+    return locations
+
+
+def _particlesToTable(imgSet, blockName, **kwargs):
+    """ Same as setOfImagesToTable with particleToRow, but the columns
+    of the table are computed from the columns of the set (see
+    Set.getColumnArrays), without creating the particles nor the rows.
+    All items of a set have the same attributes, so the attributes to
+    write are taken from the first particle.
+    """
+    table = star.Table(blockName)
+    first = imgSet.getFirstItem()
+
+    if first is None:
+        return table
+
+    alignType = kwargs['alignType']
+    coord = first.getCoordinate()
+    ctfModel = first.getCTF() if kwargs.get('writeCtf', True) else None
+    acquisition = (first.getAcquisition()
+                   if kwargs.get('writeAcquisition', True) else None)
+    hasAlignment = alignType != em.ALIGN_NONE and first.hasTransform()
+
+    # Attributes of the set that will be read
+    attrs = ['id', 'enabled', '_index', '_filename', '_micId']
+    coordExtras, ctfExtras, phaseShiftAttr = [], [], None
+
+    if coord is not None:
+        coordExtras = _extraAttributes(coord, '_coordinate.',
+                                       COOR_EXTRA_LABELS, COOR_DICT)
+        attrs += ['_coordinate.' + attr
+                  for attr in COOR_DICT.keys() + ['_micName', '_micId']]
+
+    if first.hasAttribute('_rlnParticleId'):
+        attrs.append('_rlnParticleId')
+
+    fillRandomSubset = (kwargs.get('fillRandomSubset') and
+                        first.hasAttribute('_rlnRandomSubset'))
+    if fillRandomSubset:
+        attrs.append('_rlnRandomSubset')
+
+    if ctfModel is not None:
+        ctfExtras = _extraAttributes(ctfModel, '_ctfModel.',
+                                     CTF_EXTRA_LABELS, CTF_DICT)
+        attrs += ['_ctfModel.' + attr for attr in CTF_DICT]
+        # Same attribute used by CTFModel.getPhaseShift
+        for attr in ['_phaseShift', '_ctffind4_ctfPhaseShift',
+                     '_gctf_ctfPhaseShift']:
+            if getattr(ctfModel, attr, None) is not None:
+                phaseShiftAttr = '_ctfModel.' + attr
+                attrs.append(phaseShiftAttr)
+                break
+
+    if hasAlignment:
+        attrs.append('_transform._matrix')
+
+    if acquisition is not None:
+        attrs += ['_acquisition.' + attr for attr in ACQUISITION_DICT]
+
+    imgExtras = _extraAttributes(first, '', IMAGE_EXTRA_LABELS +
+                                 kwargs.get('extraLabels', []))
+    attrs += [attr for _, attr in coordExtras + ctfExtras + imgExtras]
+
+    values = imgSet.getColumnArrays(attrs)
+    n = len(values['id'])
+    # Labels are added in the same order as done by particleToRow
+    columns = OrderedDict()
+    micNames = numpy.repeat('', n).astype(object)
+    hasMicName = numpy.zeros(n, dtype=bool)
+
+    if coord is not None:
+        columns[md.RLN_IMAGE_ENABLED] = None
+        for attr, label in COOR_DICT.iteritems():
+            columns[label] = _labelColumn(label,
+                                          values['_coordinate.' + attr])
+        for label, attr in coordExtras:
+            columns[label] = _labelColumn(label, values[attr])
+        # Use the micrograph name without spaces or, if not set, its id
+        coordNames = values['_coordinate._micName']
+        coordMicIds = values['_coordinate._micId']
+        hasMicName = coordNames.astype(bool)
+        micNames[hasMicName] = numpy.char.replace(
+            coordNames[hasMicName].astype(str), ' ', '')
+        hasMicId = ~hasMicName & _hasValues(coordMicIds)
+        hasMicId[hasMicId] = coordMicIds[hasMicId] != 0
+        micNames[hasMicId] = coordMicIds[hasMicId].astype(int).astype(str)
+        hasMicName |= hasMicId
+        if hasMicName.any():
+            columns[md.RLN_MICROGRAPH_NAME] = None
+
+    micIds = values['_micId']
+    hasMicId = _hasValues(micIds)
+
+    if hasMicId.any():
+        columns[md.RLN_MICROGRAPH_ID] = _labelColumn(md.RLN_MICROGRAPH_ID,
+                                                     micIds, hasMicId)
+        # If the row does not contains the micrograph name
+        # use a fake micrograph name using id to relion
+        # could at least group for CTF using that
+        fakeNames = hasMicId & ~hasMicName
+        micNames[fakeNames] = numpy.char.mod('fake_micrograph_%06d.mrc',
+                                             micIds[fakeNames].astype(int))
+        hasMicName |= fakeNames
+
+    if hasMicName.any():
+        columns[md.RLN_MICROGRAPH_NAME] = _labelColumn(md.RLN_MICROGRAPH_NAME,
+                                                       micNames, hasMicName)
+
+    if first.hasAttribute('_rlnParticleId'):
+        columns[md.RLN_PARTICLE_ID] = _labelColumn(md.RLN_PARTICLE_ID,
+                                                   values['_rlnParticleId'])
+
+    if fillRandomSubset:
+        columns[md.RLN_PARTICLE_RANDOM_SUBSET] = _labelColumn(
+            md.RLN_PARTICLE_RANDOM_SUBSET, values['_rlnRandomSubset'])
+
+    columns[md.RLN_IMAGE_ID] = _labelColumn(md.RLN_IMAGE_ID, values['id'])
+    locations = _locationsToRelion(values['_index'], values['_filename'],
+                                   kwargs.get('filesDict', {}))
+    columns[md.RLN_IMAGE_NAME] = _labelColumn(md.RLN_IMAGE_NAME, locations)
+
+    if ctfModel is not None:
+        if phaseShiftAttr is not None:
+            phaseShifts = values[phaseShiftAttr]
+            hasPhaseShift = _hasValues(phaseShifts)
+            if hasPhaseShift.any():
+                columns[md.RLN_CTF_PHASESHIFT] = _labelColumn(
+                    md.RLN_CTF_PHASESHIFT, phaseShifts, hasPhaseShift)
+        columns.setdefault(md.RLN_IMAGE_ENABLED, None)
+        for attr, label in CTF_DICT.iteritems():
+            columns[label] = _labelColumn(label, values['_ctfModel.' + attr])
+        for label, attr in ctfExtras:
+            columns[label] = _labelColumn(label, values[attr])
+
+    if hasAlignment:
+        matrices = em.Matrix.valuesToMatrices(values['_transform._matrix'])
+        shifts, angles = geometryFromMatrices(matrices,
+                                              alignType == em.ALIGN_PROJ)
+        alignColumns = [(md.RLN_ORIENT_ORIGIN_X, shifts[:, 0]),
+                        (md.RLN_ORIENT_ORIGIN_Y, shifts[:, 1])]
+
+        if alignType == em.ALIGN_2D:
+            alignColumns.append((md.RLN_ORIENT_PSI,
+                                 -(angles[:, 0] + angles[:, 2])))
+            if (numpy.linalg.det(matrices[:, :2, :2]) < 0).any():
+                print "FLIP in 2D not implemented"
+        else:
+            alignColumns += [(md.RLN_ORIENT_ORIGIN_Z, shifts[:, 2]),
+                             (md.RLN_ORIENT_ROT, angles[:, 0]),
+                             (md.RLN_ORIENT_TILT, angles[:, 1]),
+                             (md.RLN_ORIENT_PSI, angles[:, 2])]
+
+        for label, alignValues in alignColumns:
+            columns[label] = _labelColumn(label, alignValues)
+
+    if acquisition is not None:
+        # Same as Image.hasAcquisition for each particle
+        hasAcquisition = (_hasValues(values['_acquisition._voltage']) &
+                          _hasValues(values['_acquisition._magnification']))
+        if hasAcquisition.any():
+            columns.setdefault(md.RLN_IMAGE_ENABLED, None)
+            for attr, label in ACQUISITION_DICT.iteritems():
+                columns[label] = _labelColumn(label,
+                                              values['_acquisition.' + attr],
+                                              hasAcquisition)
+
+    columns[md.RLN_IMAGE_ENABLED] = _labelColumn(md.RLN_IMAGE_ENABLED,
+                                                 values['enabled'])
+    for label, attr in imgExtras:
+        columns[label] = _labelColumn(label, values[attr])
+
+    for label, labelValues in columns.iteritems():
+        table.setColumn(md.label2Str(label), labelValues)
+
+    return table
+
+
 def writeSetOfParticles(imgSet, starFile,
                         outputDir, **kwargs):
     """ This function will write a SetOfImages as Relion meta
@@ -621,24 +1173,26 @@ def writeSetOfParticles(imgSet, starFile,
     """
     filesDict = convertBinaryFiles(imgSet, outputDir)
     kwargs['filesDict'] = filesDict
-    partMd = md.MetaData()
-    setOfImagesToMd(imgSet, partMd, particleToRow, **kwargs)
-    
+    blockName = kwargs.get('blockName', 'Particles')
+    partTable = setOfImagesToTable(imgSet, particleToRow, blockName, **kwargs)
+
+    magLabel = md.label2Str(md.RLN_CTF_MAGNIFICATION)
+
     if kwargs.get('fillMagnification', False):
         pixelSize = imgSet.getSamplingRate()
         mag = imgSet.getAcquisition().getMagnification()
         detectorPxSize = mag * pixelSize / 10000
         
-        partMd.fillConstant(md.RLN_CTF_MAGNIFICATION, mag)
-        partMd.fillConstant(md.RLN_CTF_DETECTOR_PIXEL_SIZE, detectorPxSize)
+        partTable.setColumn(magLabel, float(mag))
+        partTable.setColumn(md.label2Str(md.RLN_CTF_DETECTOR_PIXEL_SIZE),
+                            float(detectorPxSize))
     else:
         # Remove Magnification from metadata to avoid wrong values of pixel size.
         # In Relion if Magnification and DetectorPixelSize are in metadata,
         # pixel size is ignored in the command line.
-        partMd.removeLabel(md.RLN_CTF_MAGNIFICATION)
+        partTable.removeColumn(magLabel)
 
-    blockName = kwargs.get('blockName', 'Particles')
-    partMd.write('%s@%s' % (blockName, starFile))
+    star.writeStar(starFile, partTable)
 
     
 def writeReferences(inputSet, outputRoot, useBasename=False, **kwargs):
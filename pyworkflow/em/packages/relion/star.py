@@ -0,0 +1,221 @@
+# **************************************************************************
+# *
+# * Authors:     agent (agent@local)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+This module reads and writes STAR files using numpy, without the
+Xmipp MetaData binding. Each data block is loaded as a Table with
+one numpy array per column, parsing all the rows of a loop at once.
+"""
+
+import shlex
+from collections import OrderedDict
+
+import numpy as np
+
+
+class Table(object):
+    """ Data block of a STAR file stored by columns.
+    Column names do not contain the leading underscore
+    (e.g. 'rlnImageName').
+    """
+    def __init__(self, name='', columns=None):
+        self._name = name
+        self._columns = OrderedDict()
+
+        for colName, values in (columns or {}).iteritems():
+            self.setColumn(colName, values)
+
+    def getName(self):
+        return self._name
+
+    def getColumnNames(self):
+        return self._columns.keys()
+
+    def hasColumn(self, colName):
+        return colName in self._columns
+
+    def getColumn(self, colName):
+        return self._columns[colName]
+
+    def setColumn(self, colName, values):
+        """ Add or replace a column, the values can be any sequence
+        or a single value that will be used for all rows.
+        """
+        if np.isscalar(values):
+            values = np.repeat(values, len(self))
+        values = np.asarray(values)
+        if self._columns and len(values) != len(self):
+            raise Exception("Column %s has %d values, expected %d"
+                            % (colName, len(values), len(self)))
+        self._columns[colName] = values
+
+    def removeColumn(self, colName):
+        self._columns.pop(colName, None)
+
+    def filterRows(self, mask):
+        """ Keep only the rows where the boolean mask is True. """
+        for colName, values in self._columns.iteritems():
+            self._columns[colName] = values[mask]
+
+    def __len__(self):
+        for values in self._columns.itervalues():
+            return len(values)
+        return 0
+
+    def iterRows(self):
+        """ Iterate over the rows as dictionaries of column values. """
+        names = self.getColumnNames()
+        for values in zip(*[c.tolist() for c in self._columns.itervalues()]):
+            yield dict(zip(names, values))
+
+    def write(self, f):
+        """ Write the table as a data block in the opened file f. """
+        f.write("\ndata_%s\n\nloop_\n" % self._name)
+
+        for i, colName in enumerate(self._columns):
+            f.write("_%s #%d\n" % (colName, i + 1))
+
+        if len(self):
+            lines = None
+            for values in self._columns.itervalues():
+                strValues = _formatColumn(values)
+                if lines is None:
+                    lines = strValues
+                else:
+                    lines = np.char.add(np.char.add(lines, ' '), strValues)
+            f.write('\n'.join(lines.tolist()))
+            f.write('\n')
+        f.write('\n')
+
+
+def _formatColumn(values):
+    """ Convert all values of a column to strings at once. """
+    kind = values.dtype.kind
+
+    if kind in 'iub':
+        return np.char.mod('%12d', values.astype(np.int64))
+
+    if kind == 'f':
+        strValues = np.char.mod('%12.6f', values)
+        # Use exponential notation for small values to keep precision
+        small = (values != 0) & (np.abs(values) < 0.001)
+        if small.any():
+            strValues[small] = np.char.mod('%12.6e', values[small])
+        return strValues
+
+    strValues = values.astype(str)
+    # Quote empty strings and strings with spaces
+    quote = (np.char.str_len(strValues) == 0) | (np.char.find(strValues,
+                                                             ' ') >= 0)
+    if quote.any():
+        strValues = strValues.astype(object)
+        strValues[quote] = ['"%s"' % v for v in strValues[quote]]
+        strValues = strValues.astype(str)
+    return strValues
+
+
+def _parseColumn(values):
+    """ Convert a column of strings to int or float if possible. """
+    for dtype in (np.int64, np.float64):
+        try:
+            return values.astype(dtype)
+        except ValueError:
+            pass
+    return values
+
+
+def _createTable(name, labels, lines):
+    """ Create a table parsing all data lines of a loop at once. """
+    if not labels:
+        return Table(name)
+
+    text = '\n'.join(lines)
+    if '"' in text or "'" in text:
+        tokens = [t for line in lines for t in shlex.split(line)]
+    else:
+        tokens = text.split()
+
+    n = len(labels)
+    if len(tokens) % n:
+        raise Exception("Invalid STAR block '%s': %d values for %d columns"
+                        % (name, len(tokens), n))
+
+    data = np.array(tokens, dtype=str).reshape(-1, n)
+    columns = OrderedDict((label, _parseColumn(data[:, i]))
+                          for i, label in enumerate(labels))
+
+    return Table(name, columns)
+
+
+def readStar(filename, blockName=None):
+    """ Read the data blocks of a STAR file.
+    Return an OrderedDict with the Table of each block (by name) or
+    only the requested Table if blockName is passed.
+    Blocks without loop_ are read as a table with a single row.
+    """
+    tables = OrderedDict()
+    name, labels, lines = None, [], []
+    isLoop = False
+
+    def _addTable():
+        if name is not None and (blockName is None or name == blockName):
+            tables[name] = _createTable(name, labels, lines)
+
+    with open(filename) as f:
+        for line in f:
+            line = line.strip()
+
+            if not line or line.startswith('#'):
+                continue
+
+            if line.startswith('data_'):
+                _addTable()
+                name, labels, lines = line[5:], [], []
+                isLoop = False
+            elif line.startswith('loop_'):
+                isLoop = True
+            elif line.startswith('_'):
+                parts = line[1:].split(None, 1)
+                labels.append(parts[0])
+                if not isLoop:  # Label and value in the same line
+                    lines.append(parts[1] if len(parts) > 1 else '""')
+            else:
+                lines.append(line)
+
+        _addTable()
+
+    if blockName is not None:
+        if blockName not in tables:
+            raise Exception("Block '%s' not found in STAR file %s"
+                            % (blockName, filename))
+        return tables[blockName]
+
+    return tables
+
+
+def writeStar(filename, *tables):
+    """ Write the given tables as data blocks of a STAR file. """
+    with open(filename, 'w') as f:
+        f.write("# Written by Scipion\n")
+        for table in tables:
+            table.write(f)
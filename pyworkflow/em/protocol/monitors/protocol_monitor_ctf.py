@@ -126,7 +126,9 @@ class MonitorCTF(Monitor):
         self.astigmatism = kwargs['astigmatism']
         self._dataBase = kwargs.get('dbName', CTF_LOG_SQLITE)
         self._tableName = kwargs.get('tableName', 'log')
-        self.readCTFs = set()
+        # Last CTF id already stored in the table, only CTFs with
+        # greater ids will be read from the CTF protocol output
+        self._lastCtfId = 0
 
         self.conn = lite.connect(os.path.join(self.workingDir, self._dataBase),
                                  isolation_level=None)
@@ -137,22 +139,22 @@ class MonitorCTF(Monitor):
 
     def initLoop(self):
         self._createTable()
+        self._lastCtfId = self._getLastCtfId()
 
     def step(self):
         prot = getUpdatedProtocol(self.protocol)
-        # Create set of processed CTF from CTF protocol
+        # Read only the CTFs produced after the last step
         if hasattr(prot, 'outputCTF'):
-            CTFset = prot.outputCTF.getIdSet()
+            setOfCTFs = prot.outputCTF
         else:
             return False
-        # find difference
+
         sys.stdout.flush()
-        diffSet = CTFset - self.readCTFs
-        setOfCTFs = prot.outputCTF
         astigmatism = self.astigmatism
+        rows = []
 
-        for ctfID in diffSet:
-            ctf = setOfCTFs[ctfID]
+        for ctf in setOfCTFs.iterItems(sinceId=self._lastCtfId):
+            ctfID = ctf.getObjId()
             defocusU = ctf.getDefocusU()
             defocusV = ctf.getDefocusV()
             defocusAngle = ctf.getDefocusAngle()
@@ -186,17 +188,9 @@ class MonitorCTF(Monitor):
 
             # get CTFs with this ids a fill table
             # do not forget to compute astigmatism
-#            sql = """INSERT INTO %s(defocusU,defocusV,astigmatism,ratio,psdPath)
-#                     VALUES(%f,%f,%f,%f,"%s");""" % (self._tableName, defocusU,
-#                     defocusV, defocusAngle, defocusU / defocusV, psdPath)
-            sql = """INSERT INTO %s(ctfID, defocusU,defocusV,astigmatism,ratio, resolution, fitQuality, micPath,psdPath,shiftPlotPath )
-                     VALUES(%d,%f,%f,%f,%f,%f,%f,"%s","%s","%s");""" % (self._tableName, ctfID, defocusU,
-                     defocusV, astig, defocusU / defocusV, resolution, fitQuality, micPath, psdPath, shiftPlotPath)
-            try:
-                self.cur.execute(sql)
-            except Exception as e:
-                print("ERROR: saving one data point (CTF monitor). I continue")
-                print e
+            rows.append((ctfID, defocusU, defocusV, astig, defocusU / defocusV,
+                         resolution, fitQuality, micPath, psdPath,
+                         shiftPlotPath))
 
             if abs(defocusU - defocusV) > astigmatism:
                 self.warning("Astigmatism (defocusU - defocusV)  = %f."
@@ -212,10 +206,56 @@ class MonitorCTF(Monitor):
                              "minumum (%f)" % (defocusV, self.maxDefocus))
                 self.minDefocus = defocusV
 
-        self.readCTFs.update(diffSet)
+        setOfCTFs.close()
+        self._insertRows(rows)
+
         # Finish when protocol is not longer running
         return prot.getStatus() != STATUS_RUNNING
 
+    def _insertRows(self, rows):
+        """ Store the new CTF values in a single transaction and
+        move forward the last read CTF id. If the transaction fails,
+        the rows are stored one by one and the ones that can not be
+        stored are reported and skipped, so they are not read again.
+        """
+        if not rows:
+            return
+
+        try:
+            self._executeInsert(rows)
+        except lite.Error:
+            errors = []
+            for row in rows:
+                try:
+                    self._executeInsert([row])
+                except lite.Error as e:
+                    errors.append("ctfID %s: %s" % (row[0], e))
+            if errors:
+                self.warning("Error saving %d of %d CTFs in the monitor "
+                             "database, they are skipped.\n%s"
+                             % (len(errors), len(rows), '\n'.join(errors)))
+
+        self._lastCtfId = max(self._lastCtfId, max(r[0] for r in rows))
+
+    def _executeInsert(self, rows):
+        """ Insert the rows in a single transaction. """
+        sql = """INSERT INTO %s(ctfID, defocusU, defocusV, astigmatism, ratio,
+                                resolution, fitQuality, micPath, psdPath,
+                                shiftPlotPath)
+                 VALUES(?,?,?,?,?,?,?,?,?,?);""" % self._tableName
+        self.cur.execute("BEGIN")
+        try:
+            self.cur.executemany(sql, rows)
+            self.cur.execute("COMMIT")
+        except lite.Error:
+            self.cur.execute("ROLLBACK")
+            raise
+
+    def _getLastCtfId(self):
+        """ Return the greatest CTF id already stored in the table. """
+        self.cur.execute("SELECT MAX(ctfID) FROM %s" % self._tableName)
+        return self.cur.fetchone()[0] or 0
+
     def _createTable(self):
         self.cur.execute("""CREATE TABLE IF NOT EXISTS  %s(
                                 id INTEGER PRIMARY KEY AUTOINCREMENT,
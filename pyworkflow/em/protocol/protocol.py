@@ -26,6 +26,7 @@
 
 import time
 from itertools import izip
+from collections import OrderedDict
 
 from pyworkflow.protocol import Protocol
 import pyworkflow.protocol.params as params
@@ -54,16 +55,17 @@ class EMProtocol(Protocol):
     def __init__(self, **kwargs):
         Protocol.__init__(self, **kwargs)
         
-    def __createSet(self, SetClass, template, suffix):
+    def __createSet(self, SetClass, template, suffix, **kwargs):
         """ Create a set and set the filename using the suffix. 
-        If the file exists, it will be delete. """
+        If the file exists, it will be delete.
+        Extra keyword arguments are passed to the set constructor. """
         setFn = self._getPath(template % suffix)
         # Close the connection to the database if
         # it is open before deleting the file
         cleanPath(setFn)
         
         SqliteDb.closeConnection(setFn)        
-        setObj = SetClass(filename=setFn)
+        setObj = SetClass(filename=setFn, **kwargs)
         return setObj
     
     def _createSetOfMicrographs(self, suffix=''):
@@ -108,20 +110,21 @@ class EMProtocol(Protocol):
         return self.__createSet(SetOfMovieParticles,
                                 'movie_particles%s.sqlite', suffix)
     
-    def _createSetOfClasses2D(self, imgSet, suffix=''):
+    def _createSetOfClasses2D(self, imgSet, suffix='', **kwargs):
         classes = self.__createSet(SetOfClasses2D,
-                                   'classes2D%s.sqlite', suffix)
+                                   'classes2D%s.sqlite', suffix, **kwargs)
         classes.setImages(imgSet)
         return classes
     
-    def _createSetOfClasses3D(self, imgSet, suffix=''):
+    def _createSetOfClasses3D(self, imgSet, suffix='', **kwargs):
         classes =  self.__createSet(SetOfClasses3D,
-                                    'classes3D%s.sqlite', suffix)
+                                    'classes3D%s.sqlite', suffix, **kwargs)
         classes.setImages(imgSet)
         return classes
     
-    def _createSetOfClassesVol(self, suffix=''):
-        return self.__createSet(SetOfClassesVol, 'classesVol%s.sqlite', suffix)
+    def _createSetOfClassesVol(self, suffix='', **kwargs):
+        return self.__createSet(SetOfClassesVol, 'classesVol%s.sqlite',
+                                suffix, **kwargs)
     
     def _createSetOfVolumes(self, suffix=''):
         return self.__createSet(SetOfVolumes, 'volumes%s.sqlite', suffix)
@@ -250,6 +253,74 @@ class EMProtocol(Protocol):
                       % sleepOnWait)
             time.sleep(sleepOnWait)
 
+    def _getStreamState(self, inputSet):
+        """ Return the dict with the state of the reading of a streaming
+        input set (see _loadStreamItems and _loadSet). """
+        if not hasattr(self, '_streamState'):
+            self._streamState = {}
+        return self._streamState.setdefault(inputSet.getFileName(),
+                                            {'lastId': 0, 'count': 0,
+                                             'pending': OrderedDict()})
+
+    def _loadStreamItems(self, inputSet, SetClass):
+        """ Load the items added to a streaming input set since the
+        previous call. Only the greatest id and the number of items read
+        are kept between calls, so only the new rows are fetched (or all
+        of them, if some item was inserted with a lower id).
+        Params:
+            inputSet: the input set, used to get the db filename.
+            SetClass: the class used to open the set.
+        Returns:
+            a tuple (items, allRead, streamClosed), where items is a list
+            with the items read and allRead is True if the whole set
+            was read again.
+        """
+        setFn = inputSet.getFileName()
+        state = self._getStreamState(inputSet)
+
+        self.debug("Loading input db: %s (since id %s)"
+                   % (setFn, state['lastId']))
+        updatedSet = SetClass(filename=setFn)
+        updatedSet.loadAllProperties()
+        items, allRead = updatedSet.readNewItems(state['lastId'],
+                                                 state['count'])
+        streamClosed = updatedSet.isStreamClosed()
+        updatedSet.close()
+        self.debug("Closed db.")
+
+        if allRead:
+            state['lastId'], state['count'] = 0, 0
+        state['count'] += len(items)
+        state['lastId'] = max([state['lastId']] +
+                              [item.getObjId() for item in items])
+
+        return items, allRead, streamClosed
+
+    def _loadSet(self, inputSet, SetClass, getKeyFunc):
+        """ Load the items of a streaming input set whose key is not
+        in self.micDict. Only the new rows are read from the db (see
+        _loadStreamItems), and the items returned by the previous call
+        that are not in self.micDict yet (e.g. waiting for their CTF or
+        for a complete batch) are returned again.
+        This can be used to load new micrographs for picking as well as
+        new CTF (if used) in streaming.
+        Returns:
+            a tuple (itemsDict, streamClosed), where itemsDict is an
+            OrderedDict (key: item).
+        """
+        items, _, streamClosed = self._loadStreamItems(inputSet, SetClass)
+        state = self._getStreamState(inputSet)
+        itemsDict = OrderedDict((k, item)
+                                for k, item in state['pending'].iteritems()
+                                if k not in self.micDict)
+        for item in items:
+            micKey = getKeyFunc(item)
+            if micKey not in self.micDict:
+                itemsDict[micKey] = item
+        # Keep a copy, the caller can remove items from the returned dict
+        state['pending'] = OrderedDict(itemsDict)
+
+        return itemsDict, streamClosed
 
     def _insertNewMics(self, inputMics, getMicKeyFunc,
                        insertStepFunc, insertStepListFunc, *args):
@@ -540,27 +540,6 @@ class ProtCTFMicrographs(ProtMicrographs):
         """ Load the input set of micrographs that are ready to be picked. """
         return self._loadSet(self.getInputMicrographs(), SetOfMicrographs,
                         lambda mic: mic.getMicName())
-        
-    def _loadSet(self, inputSet, SetClass, getKeyFunc):
-        """ Load a given input set if their items are not already present
-        in the self.micDict.
-        This can be used to load new micrographs for picking as well as
-        new CTF (if used) in streaming.
-        """
-        setFn = inputSet.getFileName()
-        self.debug("Loading input db: %s" % setFn)
-        updatedSet = SetClass(filename=setFn)
-        updatedSet.loadAllProperties()
-        newItemDict = OrderedDict()
-        for item in updatedSet:
-            micKey = getKeyFunc(item)
-            if micKey not in self.micDict:
-                newItemDict[micKey] = item.clone()
-        streamClosed = updatedSet.isStreamClosed()
-        updatedSet.close()
-        self.debug("Closed db.")
-
-        return newItemDict, streamClosed
 
     def _updateOutputCTFSet(self, micList, streamMode):
         micDoneList = [mic for mic in micList]
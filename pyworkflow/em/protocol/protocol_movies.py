@@ -197,15 +197,14 @@ class ProtProcessMovies(ProtPreprocessMicrographs):
         return None
 
     def _loadInputList(self):
-        """ Load the input set of movies and create a list. """
-        moviesFile = self.inputMovies.get().getFileName()
-        self.debug("Loading input db: %s" % moviesFile)
-        movieSet = SetOfMovies(filename=moviesFile)
-        movieSet.loadAllProperties()
-        self.listOfMovies = [m.clone() for m in movieSet]
-        self.streamClosed = movieSet.isStreamClosed()
-        movieSet.close()
-        self.debug("Closed db.")
+        """ Load the new movies of the input set and add them to the
+        list of movies. Return the list of the new movies. """
+        newMovies, allRead, self.streamClosed = self._loadStreamItems(
+            self.inputMovies.get(), SetOfMovies)
+        if allRead or not hasattr(self, 'listOfMovies'):
+            self.listOfMovies = []
+        self.listOfMovies.extend(newMovies)
+        return newMovies
 
     def _checkNewInput(self):
         # Check if there are new movies to process from the input set
@@ -223,14 +222,13 @@ class ProtProcessMovies(ProtPreprocessMicrographs):
 
         self.lastCheck = now
         # Open input movies.sqlite and close it as soon as possible
-        self._loadInputList()
-        newMovies = any(m.getObjId() not in self.insertedDict
-                        for m in self.listOfMovies)
+        newMovies = [m for m in self._loadInputList()
+                     if m.getObjId() not in self.insertedDict]
         outputStep = self._getFirstJoinStep()
 
         if newMovies:
             fDeps = self._insertNewMoviesSteps(self.insertedDict,
-                                               self.listOfMovies)
+                                               newMovies)
             if outputStep is not None:
                 outputStep.addPrerequisites(*fDeps)
             self.updateSteps()
@@ -525,7 +523,7 @@ class ProtMovieAssignGain(ProtPreprocessMicrographs):
         moviesOut = self._createSetOfMovies()
         moviesOut.copyInfo(moviesIn)
         moviesOut.setGain(self.gainImage.get().getFileName())
-        moviesOut.copyItems(moviesIn)
+        moviesOut.copyItemsFrom(moviesIn)
 
         self._defineOutputs(outputMovies=moviesOut)
         self._defineSourceRelation(self.inputMovies, moviesOut)
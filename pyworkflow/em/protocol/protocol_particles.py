@@ -329,28 +329,13 @@ class ProtExtractParticles(ProtParticles):
         2) Micrographs to be extracted (in case it is different from 1)
         3) New computed CTF (in case it is associated with the particles)
         """
-        def _loadSet(inputSet, SetClass, getKeyFunc):
-            setFn = inputSet.getFileName()
-            self.debug("Loading input db: %s" % setFn)
-            updatedSet = SetClass(filename=setFn)
-            updatedSet.loadAllProperties()
-            newItemDict = OrderedDict()
-            for item in updatedSet:
-                micKey = getKeyFunc(item)
-                if micKey not in self.micDict:
-                    newItemDict[micKey] = item.clone()
-            streamClosed = updatedSet.isStreamClosed()
-            updatedSet.close()
-            self.debug("Closed db.")
-            return newItemDict, streamClosed
-
         def _loadMics(micSet):
-            return _loadSet(micSet, SetOfMicrographs,
-                             lambda mic: mic.getMicName())
+            return self._loadSet(micSet, SetOfMicrographs,
+                                 lambda mic: mic.getMicName())
 
         def _loadCTFs(ctfSet):
-            return _loadSet(ctfSet, SetOfCTF,
-                             lambda ctf: ctf.getMicrograph().getMicName())
+            return self._loadSet(ctfSet, SetOfCTF,
+                                 lambda ctf: ctf.getMicrograph().getMicName())
 
         # Load new micrographs coming from the coordinates
         self.debug("Loading Mics from Coords.")
@@ -312,27 +312,6 @@ class ProtParticlePickingAuto(ProtParticlePicking):
                                    self._insertPickMicrographListStep,
                                    *self._getPickArgs())
 
-    def _loadSet(self, inputSet, SetClass, getKeyFunc):
-        """ Load a given input set if their items are not already present
-        in the self.micDict.
-        This can be used to load new micrographs for picking as well as
-        new CTF (if used) in streaming.
-        """
-        setFn = inputSet.getFileName()
-        self.debug("Loading input db: %s" % setFn)
-        updatedSet = SetClass(filename=setFn)
-        updatedSet.loadAllProperties()
-        newItemDict = OrderedDict()
-        for item in updatedSet:
-            micKey = getKeyFunc(item)
-            if micKey not in self.micDict:
-                newItemDict[micKey] = item.clone()
-        streamClosed = updatedSet.isStreamClosed()
-        updatedSet.close()
-        self.debug("Closed db.")
-
-        return newItemDict, streamClosed
-
     def _loadMics(self, micSet):
         return self._loadSet(micSet, SetOfMicrographs,
                         lambda mic: mic.getMicName())
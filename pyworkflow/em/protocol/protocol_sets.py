@@ -32,9 +32,13 @@ This module contains protocols related to Set operations such us:
 """
 
 import random
+
+import numpy as np
+
 from protocol import EMProtocol
 import pyworkflow.protocol as pwprot
 from pyworkflow.object import Boolean, Object
+from pyworkflow.mapper.query import Attr
 
 
 class ProtSets(EMProtocol):
@@ -154,10 +158,22 @@ class ProtUnionSet(ProtSets):
                 if not "." in attr:
                     copyAttrs.append(attr)
 
-        for itemSet in self.inputSets:
-            for obj in itemSet.get():
+        inputSets = [itemSet.get() for itemSet in self.inputSets]
+
+        if self.ignoreExtraAttributes and isFlatSet(outputSet, *inputSets):
+            # Copy all the items in sqlite, the columns are matched by
+            # attribute name, so only the common attributes are kept
+            template = set1.ITEM_TYPE()
+            template.copyAttributes(set1.getFirstItem(), *copyAttrs)
+            self.cleanExtraAttributes(template, commonAttrs)
+            outputSet.appendFromSets(inputSets, template=template,
+                                     renumber=cleanIds)
+            inputSets = []
+
+        for itemSet in inputSets:
+            for obj in itemSet:
                 if self.ignoreExtraAttributes:
-                    newObj = itemSet.get().ITEM_TYPE()
+                    newObj = itemSet.ITEM_TYPE()
                     newObj.copyAttributes(obj, *copyAttrs)
 
                     self.cleanExtraAttributes(newObj, commonAttrs)
@@ -194,15 +210,9 @@ class ProtUnionSet(ProtSets):
     def duplicatedIds(self):
         """ Check if there are duplicated ids to renumber from
         the beginning. """
-        usedIds = set()  # to keep track of the object ids we have already seen
-        
-        for itemSet in self.inputSets:
-            for obj in itemSet.get():
-                objId = obj.getObjId()
-                if objId in usedIds:
-                    return True
-                usedIds.add(objId)
-        return False
+        ids = np.concatenate([itemSet.get().getColumnArrays(['id'])['id']
+                              for itemSet in self.inputSets])
+        return len(np.unique(ids)) < len(ids)
 
     def getAllSetsAttributes(self):
         allSetsAttributes = list()
@@ -322,12 +332,24 @@ class ProtSplitSet(ProtSets):
         pos, i = 0, 0  # index of current subset and index of position inside it
         orderBy = 'RANDOM()' if self.randomize else 'id'
 
-        for elem in elements.iterItems(orderBy=orderBy, direction='ASC'):
-            if i >= ns[pos]:
-                pos += 1
-                i = 0
-            subsets[pos].append(elem)
-            i += 1
+        if not self.randomize and isFlatSet(elements, *subsets):
+            # Each subset has a range of consecutive ids, copy its
+            # items directly in sqlite
+            ids = elements.getColumnArrays(['id'])['id']
+            for subset, size in zip(subsets, ns):
+                if size:
+                    firstId, lastId = ids[pos], ids[pos + size - 1]
+                    subset.copyItemsFrom(
+                        elements, copyDisabled=True,
+                        where=Attr('id').between(int(firstId), int(lastId)))
+                pos += size
+        else:
+            for elem in elements.iterItems(orderBy=orderBy, direction='ASC'):
+                if i >= ns[pos]:
+                    pos += 1
+                    i = 0
+                subsets[pos].append(elem)
+                i += 1
 
         key = 'output' + inputClassName.replace('SetOf', '') + '%02d'
         for i in range(1, n+1):
@@ -440,17 +462,22 @@ class ProtSubSet(ProtSets):
             # if it is 'intersection' we want that item is not None (found)
             # if it is 'difference' we want that item is None
             # (not found, different)
-            if self.setOperation == self.SET_INTERSECTION:
-                checkElem = lambda e: e is not None
+            difference = self.setOperation == self.SET_DIFFERENCE
+
+            if isFlatSet(outputSet, inputFullSet, inputSubSet):
+                # Perform the intersection (or difference) in sqlite
+                outputSet.appendFromSets([inputFullSet], subset=inputSubSet,
+                                         difference=difference)
             else:
-                checkElem = lambda e: e is None 
-            
-            for origElem in inputFullSet:
-                # TODO: this can be improved if we perform
-                # intersection directly in sqlite
-                otherElem = inputSubSet[origElem.getObjId()]
-                if checkElem(otherElem):
-                    outputSet.append(origElem)
+                if difference:
+                    checkElem = lambda e: e is None
+                else:
+                    checkElem = lambda e: e is not None
+
+                for origElem in inputFullSet:
+                    otherElem = inputSubSet[origElem.getObjId()]
+                    if checkElem(otherElem):
+                        outputSet.append(origElem)
             
         if outputSet.getSize():
             key = 'output' + inputClassName.replace('SetOf', '') 
@@ -523,3 +550,12 @@ class ProtSubSet(ProtSets):
             return ["The elements of %s that also are referenced in %s" %
                     (self.inputFullSet.getName(), self.inputSubSet.getName()),
                     "are now in %s" % getattr(self, key).getName()]
+
+
+def isFlatSet(*sets):
+    """ Return True if all the sets store their items in a single sqlite
+    table, so operations can be done directly in the database.
+    Sets of classes also store the items of each class, so they
+    are not considered flat.
+    """
+    return all(s._isFlat() for s in sets)
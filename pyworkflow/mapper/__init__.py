@@ -27,6 +27,7 @@
 from mapper import Mapper
 from sqlite import SqliteMapper
 from xmlmapper import XmlMapper
+from query import Attr
 
 
 
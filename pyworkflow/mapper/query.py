@@ -0,0 +1,232 @@
+# **************************************************************************
+# *
+# * Authors:     agent (agent@local)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Expressions to select the items of flat sets by the values of their
+attributes. They can be passed as the where of Set.iterItems (and other
+selections) instead of a string, and are translated to SQL with the
+columns of the attributes and the values as parameters. For example:
+
+    Attr('_ctfModel._resolution') < 4.0
+    Attr('_ctfModel._defocusU').between(10000, 30000) & Attr('_micId').isIn(ids)
+    (Attr('_classId') == 3) | Attr('_classId').isNull()
+"""
+
+
+class Expr(object):
+    """ Base class of the conditions, they can be combined with
+    & (and), | (or) and ~ (not). """
+
+    def __and__(self, other):
+        return BoolExpr('AND', self, other)
+
+    def __or__(self, other):
+        return BoolExpr('OR', self, other)
+
+    def __invert__(self):
+        return Not(self)
+
+    def compile(self, getColumn):
+        """ Return the SQL of the condition and the list of parameters.
+        Params:
+            getColumn: function returning the column of an attribute label.
+        """
+        raise NotImplementedError
+
+    def getLabels(self):
+        """ Return the attribute labels used in the condition. """
+        raise NotImplementedError
+
+    def __repr__(self):
+        sql, params = self.compile(lambda label: label)
+        return 'Expr(%r, %r)' % (sql, params)
+
+
+class Attr(object):
+    """ Reference to an attribute (e.g. '_micId' or '_ctfModel._defocusU',
+    also 'id' and 'enabled') used to build conditions with the comparison
+    operators and the methods below. Comparing with None checks for NULL.
+    """
+    def __init__(self, label):
+        self.label = label
+
+    def __eq__(self, value):
+        if value is None:
+            return self.isNull()
+        return Comparison(self, '=', value)
+
+    def __ne__(self, value):
+        if value is None:
+            return self.isNotNull()
+        return Comparison(self, '!=', value)
+
+    def __lt__(self, value):
+        return Comparison(self, '<', value)
+
+    def __le__(self, value):
+        return Comparison(self, '<=', value)
+
+    def __gt__(self, value):
+        return Comparison(self, '>', value)
+
+    def __ge__(self, value):
+        return Comparison(self, '>=', value)
+
+    # Attr objects are not hashable since == builds a condition
+    __hash__ = None
+
+    def between(self, low, high):
+        """ Values between low and high, both included. """
+        return Between(self, low, high)
+
+    def isIn(self, values):
+        return In(self, values)
+
+    def notIn(self, values):
+        return In(self, values, negate=True)
+
+    def isNull(self):
+        return Null(self)
+
+    def isNotNull(self):
+        return Null(self, negate=True)
+
+    def like(self, pattern):
+        """ String values matching a pattern of the SQL LIKE operator,
+        where % matches any sequence of characters and _ any one. """
+        return Comparison(self, 'LIKE', pattern)
+
+
+def _compileValue(value, getColumn, params):
+    """ Return the SQL of a value, that can be other attribute. """
+    if isinstance(value, Attr):
+        return getColumn(value.label)
+    params.append(value)
+    return '?'
+
+
+class Comparison(Expr):
+    def __init__(self, attr, op, value):
+        self.attr = attr
+        self.op = op
+        self.value = value
+
+    def compile(self, getColumn):
+        params = []
+        sql = '%s %s %s' % (getColumn(self.attr.label), self.op,
+                            _compileValue(self.value, getColumn, params))
+        return sql, params
+
+    def getLabels(self):
+        labels = [self.attr.label]
+        if isinstance(self.value, Attr):
+            labels.append(self.value.label)
+        return labels
+
+
+class Between(Expr):
+    def __init__(self, attr, low, high):
+        self.attr = attr
+        self.low = low
+        self.high = high
+
+    def compile(self, getColumn):
+        params = []
+        low = _compileValue(self.low, getColumn, params)
+        high = _compileValue(self.high, getColumn, params)
+        return ('%s BETWEEN %s AND %s' % (getColumn(self.attr.label),
+                                          low, high), params)
+
+    def getLabels(self):
+        return [self.attr.label]
+
+
+class In(Expr):
+    def __init__(self, attr, values, negate=False):
+        self.attr = attr
+        self.values = list(values)
+        self.negate = negate
+
+    def compile(self, getColumn):
+        if not self.values:  # Nothing is in an empty list
+            return ('1' if self.negate else '0'), []
+        return ('%s %sIN (%s)' % (getColumn(self.attr.label),
+                                  'NOT ' if self.negate else '',
+                                  ','.join('?' * len(self.values))),
+                list(self.values))
+
+    def getLabels(self):
+        return [self.attr.label]
+
+
+class Null(Expr):
+    def __init__(self, attr, negate=False):
+        self.attr = attr
+        self.negate = negate
+
+    def compile(self, getColumn):
+        return ('%s IS %sNULL' % (getColumn(self.attr.label),
+                                  'NOT ' if self.negate else ''), [])
+
+    def getLabels(self):
+        return [self.attr.label]
+
+
+class BoolExpr(Expr):
+    """ Conditions joined with AND or OR. """
+    def __init__(self, op, *exprs):
+        self.op = op
+        self.exprs = []
+        for expr in exprs:
+            if not isinstance(expr, Expr):
+                raise TypeError("Invalid condition: %r, comparisons should "
+                                "be in parenthesis when using & and |"
+                                % (expr,))
+            # Flatten nested expressions with the same operator
+            if isinstance(expr, BoolExpr) and expr.op == op:
+                self.exprs.extend(expr.exprs)
+            else:
+                self.exprs.append(expr)
+
+    def compile(self, getColumn):
+        sqls, params = [], []
+        for expr in self.exprs:
+            sql, exprParams = expr.compile(getColumn)
+            sqls.append('(%s)' % sql)
+            params.extend(exprParams)
+        return (' %s ' % self.op).join(sqls), params
+
+    def getLabels(self):
+        return [label for expr in self.exprs for label in expr.getLabels()]
+
+
+class Not(Expr):
+    def __init__(self, expr):
+        self.expr = expr
+
+    def compile(self, getColumn):
+        sql, params = self.expr.compile(getColumn)
+        return 'NOT (%s)' % sql, params
+
+    def getLabels(self):
+        return self.expr.getLabels()
@@ -0,0 +1,697 @@
+# **************************************************************************
+# *
+# * Authors:     agent (agent@local)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Read-only columnar snapshot of a flat set. The rows of the sqlite file
+are exported to a folder next to it with one .npy file per column and a
+schema.json file, the arrays are memory-mapped when the set is read.
+"""
+
+from __future__ import print_function
+import os
+import json
+from itertools import izip
+from collections import OrderedDict
+
+import numpy as np
+
+from pyworkflow.utils.path import cleanPath, makePath
+from mapper import Mapper
+from sqlite import SqliteFlatMapper, INTERNAL_PROPERTY, ID, SELF
+
+
+# Kind of the values stored in each column file
+INT = 'int'
+FLOAT = 'float'
+BOOL = 'bool'
+STR = 'str'
+BYTES = 'bytes'
+
+# Basic columns of the Objects table: (label, column, kind)
+BASIC_COLUMNS = [(ID, 'id', INT),
+                 ('enabled', 'enabled', INT),
+                 ('label', 'label', STR),
+                 ('comment', 'comment', STR),
+                 ('creation', 'creation', STR)]
+
+
+class SnapshotMapper(Mapper):
+    """ Read-only mapper for flat sets that have been exported to a
+    columnar snapshot (see exportSnapshot). Iteration, selection by id,
+    count, aggregates and column arrays are computed from the
+    memory-mapped arrays without decoding sqlite rows. Other selections
+    (e.g. with a where) are done in the sqlite file, and any change to
+    the set removes the snapshot before being written to sqlite.
+    """
+    SNAPSHOT_EXT = '.columns'
+    SCHEMA = 'schema.json'
+    VERSION = 1
+    # Number of rows converted to Python values at once when iterating
+    CHUNK_SIZE = 10000
+    KIND_MAP = {'Integer': INT,
+                'Float': FLOAT,
+                'Boolean': BOOL
+                }
+    DTYPE_MAP = {INT: np.int64,
+                 FLOAT: np.float64,
+                 BOOL: np.bool_
+                 }
+
+    def __init__(self, dbName, dictClasses=None, tablePrefix=''):
+        Mapper.__init__(self, dictClasses)
+        if tablePrefix.strip():
+            raise SnapshotMapperException("Snapshots are only supported for "
+                                          "the items of a set, tablePrefix: "
+                                          "%s" % tablePrefix)
+        self._dbName = dbName
+        self._dictClasses = dictClasses
+        self._indexes = []
+        self._sqliteMapper = None
+        self._path = self.getSnapshotPath(dbName)
+        self._schema = self.__loadSchema(self._path)
+        self._properties = self._schema['properties']
+        self._columns = OrderedDict()
+        self._values = {}  # Decoded values of string columns
+
+        for i, c in enumerate(self._schema['columns']):
+            fn = os.path.join(self._path, 'col%03d' % i)
+            column = {'kind': c['kind'], 'className': c['className'],
+                      'data': np.load(fn + '.npy', mmap_mode='r'),
+                      'null': None}
+            if c['null']:
+                column['null'] = np.load(fn + '.null.npy', mmap_mode='r')
+            if c['kind'] == STR:
+                column['strings'] = np.load(fn + '.values.npy',
+                                            mmap_mode='r')
+            self._columns[c['label']] = column
+
+        self._ids = self._columns[ID]['data']
+        self.__buildTemplate()
+
+    @classmethod
+    def getSnapshotPath(cls, dbName):
+        """ Return the folder of the snapshot of this set file. """
+        return dbName + cls.SNAPSHOT_EXT
+
+    @classmethod
+    def getSnapshotFiles(cls, dbName):
+        """ Return the list of files of the snapshot of this set file. """
+        path = cls.getSnapshotPath(dbName)
+        if not os.path.isdir(path):
+            return []
+        return [os.path.join(path, fn) for fn in sorted(os.listdir(path))]
+
+    @staticmethod
+    def __getSourceStat(dbName):
+        """ Return size and modification time of the sqlite file, used
+        to detect if the set was modified after the export. A non-empty
+        WAL file means that there are changes not in the db file yet.
+        """
+        walFn = dbName + '-wal'
+        if os.path.exists(walFn) and os.path.getsize(walFn):
+            return None
+        st = os.stat(dbName)
+        return [st.st_size, st.st_mtime]
+
+    @classmethod
+    def __loadSchema(cls, path):
+        with open(os.path.join(path, cls.SCHEMA)) as f:
+            return json.load(f)
+
+    @classmethod
+    def hasSnapshot(cls, dbName):
+        """ Return True if there is a snapshot of the set file and
+        it is up to date with the sqlite file.
+        """
+        path = cls.getSnapshotPath(dbName)
+        if not os.path.exists(os.path.join(path, cls.SCHEMA)):
+            return False
+        try:
+            schema = cls.__loadSchema(path)
+            return (schema['version'] == cls.VERSION and
+                    schema['source'] == cls.__getSourceStat(dbName))
+        except (ValueError, KeyError, OSError):
+            return False
+
+    @classmethod
+    def exportSnapshot(cls, dbName, dictClasses=None):
+        """ Write the columnar snapshot of a flat set. The set should
+        not be modified any more (e.g. a closed streaming set), since
+        any change will make the snapshot useless.
+        """
+        mapper = SqliteFlatMapper(dbName, dictClasses)
+        path = cls.getSnapshotPath(dbName)
+        tmpPath = path + '.tmp'
+        cleanPath(tmpPath)
+        makePath(tmpPath)
+
+        try:
+            try:
+                db = mapper.db
+                columns = list(BASIC_COLUMNS)
+                classes = []
+                for r in db.getClassRows():
+                    label = str(r['label_property'])
+                    className = r['class_name']
+                    classes.append([label, className])
+                    if label != SELF:
+                        columns.append((label, r['column_name'],
+                                        cls.KIND_MAP.get(className, STR)))
+                schemaColumns = []
+
+                for i, (label, col, kind) in enumerate(columns):
+                    cursor = db.connection.cursor()
+                    cursor.row_factory = None
+                    cursor.execute("SELECT %s %s ORDER BY id" % (col, db.FROM))
+                    values = [row[0] for row in cursor]
+                    cursor.close()
+                    fn = os.path.join(tmpPath, 'col%03d' % i)
+                    kind, hasNull = cls.__writeColumn(fn, label, kind, values)
+                    className = dict(classes).get(label)
+                    schemaColumns.append({'label': label,
+                                          'className': className,
+                                          'kind': kind, 'null': hasNull})
+
+                properties = dict((k, db.getProperty(k))
+                                  for k in db.getPropertyKeys())
+            finally:
+                mapper.close()
+
+            schema = {'version': cls.VERSION,
+                      'source': cls.__getSourceStat(dbName),
+                      'classes': classes,
+                      'columns': schemaColumns,
+                      'properties': properties}
+            with open(os.path.join(tmpPath, cls.SCHEMA), 'w') as f:
+                json.dump(schema, f, indent=2)
+            cleanPath(path)
+            os.rename(tmpPath, path)
+        finally:
+            cleanPath(tmpPath)
+
+    @classmethod
+    def __writeColumn(cls, fn, label, kind, values):
+        """ Write the values of a column, return its kind and whether
+        a mask for NULL values was written. NULL floats are stored as
+        nan and strings are stored as codes of the sorted unique values
+        (-1 for NULL), so sorting the codes sorts the strings. Binary
+        values (e.g. Matrix) should all have the same size, they are
+        stored in an array of fixed-width raw data.
+        """
+        nulls = np.array([v is None for v in values], dtype=bool)
+        hasNull = bool(nulls.any())
+
+        if any(isinstance(v, buffer) for v in values):
+            sizes = set(len(v) for v in values if v is not None)
+            if len(sizes) != 1 or not all(isinstance(v, buffer) for v in
+                                          values if v is not None):
+                raise SnapshotMapperException("Column '%s' has binary values "
+                                              "of different sizes or types, "
+                                              "it can not be exported."
+                                              % label)
+            kind = BYTES
+            width = sizes.pop()
+            empty = '\0' * width
+            data = np.array([empty if v is None else str(v) for v in values],
+                            dtype='V%d' % width)
+
+        elif kind != STR:
+            default = np.nan if kind == FLOAT else 0
+            try:
+                data = np.array([default if v is None else v for v in values],
+                                dtype=cls.DTYPE_MAP[kind])
+            except (ValueError, TypeError):
+                kind = STR  # Values that are not numbers
+
+        if kind == STR:
+            strings = [v if isinstance(v, basestring) else unicode(v)
+                       for v in values if v is not None]
+            uniqueValues = sorted(set(strings))
+            codes = dict((v, i) for i, v in enumerate(uniqueValues))
+            data = np.array([-1 if v is None else
+                             codes[v if isinstance(v, basestring)
+                                   else unicode(v)]
+                             for v in values], dtype=np.int32)
+            np.save(fn + '.values.npy',
+                    np.array([v.encode('utf-8') for v in uniqueValues] or
+                             [''], dtype='S'))
+
+        if kind == FLOAT or kind == STR:
+            hasNull = False  # Stored as nan or -1
+        elif hasNull:
+            np.save(fn + '.null.npy', nulls)
+        np.save(fn + '.npy', data)
+
+        return kind, hasNull
+
+    def __buildTemplate(self):
+        """ Build the template object from the classes of the schema,
+        as done by the SqliteFlatMapper from the Classes table. """
+        attrClasses = {}
+        self._objTemplate = None
+
+        for label, className in self._schema['classes']:
+            if label == SELF:
+                self._objTemplate = self._buildObjectFromClass(className)
+                continue
+            attrClasses[label] = className
+            o = self._objTemplate
+            attrJoin = ''
+            for a in label.split('.'):
+                attrJoin += a
+                attr = getattr(o, a, None)
+                if attr is None:
+                    attr = self._buildObjectFromClass(attrClasses[attrJoin])
+                    setattr(o, a, attr)
+                o = attr
+                attrJoin += '.'
+
+        self._objClasses = attrClasses
+        self.__buildSetters()
+
+    def __buildSetters(self):
+        """ Build the setters of the attribute columns and keep the
+        objects walked to detect if the template is modified. """
+        self._objSetters = []
+        self._objNodes = []
+
+        for label in self._columns.keys()[len(BASIC_COLUMNS):]:
+            parent = self._objTemplate
+            for name in label.split('.'):
+                child = getattr(parent, name)
+                self._objNodes.append((parent, name, child))
+                parent = child
+            self._objSetters.append(parent.set)
+
+    def __checkSetters(self):
+        for parent, name, child in self._objNodes:
+            if getattr(parent, name, None) is not child:
+                self.__buildSetters()
+                return
+
+    def __isBinary(self, labels):
+        """ Return True if any of the columns has binary values, sorting
+        or grouping by them is done in the sqlite file. """
+        if isinstance(labels, basestring):
+            labels = [labels]
+        return any(label in self._columns and
+                   self._columns[label]['kind'] == BYTES for label in labels)
+
+    def __getStrings(self, label):
+        """ Return the decoded values of a string column, the last item
+        is None to be used for the -1 code of NULL values. """
+        if label not in self._values:
+            strings = self._columns[label]['strings'].tolist()
+            self._values[label] = [s.decode('utf-8') for s in strings]
+            self._values[label].append(None)
+        return self._values[label]
+
+    def __getValues(self, label, rows):
+        """ Return a list with the Python values of a column for the
+        rows given by a slice or an array of indexes. """
+        column = self._columns[label]
+        data = column['data'][rows]
+
+        if column['kind'] == STR:
+            values = self.__getStrings(label)
+            return [values[c] for c in data.tolist()]
+
+        if column['kind'] == BYTES:
+            # Binary values are read from sqlite as buffers
+            values = [buffer(v) for v in data.tolist()]
+        else:
+            values = data.tolist()
+
+        if column['kind'] == FLOAT:
+            if np.isnan(data).any():
+                values = [None if v != v else v for v in values]
+        elif column['null'] is not None:
+            nulls = column['null'][rows]
+            if nulls.any():
+                values = [None if n else v
+                          for v, n in izip(values, nulls.tolist())]
+        return values
+
+    def __iterObjects(self, rows=None, objectFilter=None):
+        """ Fill the template object with the values of each row,
+        rows is an array of indexes or None for all rows by id. """
+        n = len(self._ids) if rows is None else len(rows)
+        obj = self._objTemplate
+        labels = self._columns.keys()
+        getStr = self._getStrValue
+
+        for start in xrange(0, n, self.CHUNK_SIZE):
+            end = min(n, start + self.CHUNK_SIZE)
+            chunk = slice(start, end) if rows is None else rows[start:end]
+            columns = [self.__getValues(label, chunk) for label in labels]
+
+            for values in izip(*columns):
+                objId, enabled, label, comment, creation = values[:5]
+                obj.setObjId(objId)
+                obj.setEnabled(enabled)
+                obj.setObjLabel(getStr(label))
+                obj.setObjComment(getStr(comment))
+                obj.setObjCreation(getStr(creation))
+                self.__checkSetters()
+                for setter, value in izip(self._objSetters, values[5:]):
+                    setter(value)
+                if objectFilter is None or objectFilter(obj):
+                    yield obj
+
+    def __getSortKeys(self, label):
+        """ Return the arrays to sort a column as sqlite does,
+        most significant first, with NULL values as the lowest ones. """
+        column = self._columns[label]
+        data = column['data']
+
+        if column['kind'] == STR:
+            return [data]
+        if column['kind'] == FLOAT:
+            nans = np.isnan(data)
+            return [~nans, np.where(nans, 0, data)]
+        data = data.astype(np.int64)
+        if column['null'] is not None:
+            return [~column['null'], data]
+        return [data]
+
+    def __getOrder(self, orderBy, direction):
+        """ Return the indexes of the rows in the given order, or None
+        if it is the order of the arrays (by id). As in SqliteFlatDb,
+        the direction only applies to the last column of the list and
+        to the id, that is used to sort the rows with the same values.
+        """
+        if orderBy == 'RANDOM()':
+            return np.random.permutation(len(self._ids))
+
+        labels = ([orderBy] if isinstance(orderBy, basestring)
+                  else list(orderBy))
+        if labels == [ID] and direction == 'ASC':
+            return None
+        sortIds = ID not in labels
+        if sortIds:
+            labels.append(ID)
+        # Index of the first column sorted in the given direction
+        firstDirected = len(labels) - (2 if sortIds else 1)
+
+        keys = []
+        for i, label in enumerate(labels):
+            labelKeys = self.__getSortKeys(label)
+            if i >= firstDirected and direction != 'ASC':
+                labelKeys = [-k.astype(np.int64) if k.dtype == bool else -k
+                             for k in labelKeys]
+            keys.extend(labelKeys)
+
+        # lexsort uses the last key as the most significant one
+        return np.lexsort(keys[::-1])
+
+    def _getSqliteMapper(self):
+        """ Return the sqlite mapper of the set file, used for the
+        operations that are not done with the snapshot. """
+        if self._sqliteMapper is None:
+            self._sqliteMapper = SqliteFlatMapper(self._dbName,
+                                                  self._dictClasses)
+            self._sqliteMapper.setIndexes(self._indexes)
+        return self._sqliteMapper
+
+    def _getWritableMapper(self):
+        """ Remove the snapshot and return the sqlite mapper,
+        that should be used for any change of the set. """
+        if self._path is not None:
+            cleanPath(self._path)
+            self._path = None
+        return self._getSqliteMapper()
+
+    def commit(self):
+        if self._sqliteMapper is not None:
+            self._sqliteMapper.commit()
+
+    def close(self):
+        if self._sqliteMapper is not None:
+            self._sqliteMapper.close()
+            self._sqliteMapper = None
+
+    def setIndexes(self, labels):
+        self._indexes = list(labels)
+        if self._sqliteMapper is not None:
+            self._sqliteMapper.setIndexes(labels)
+
+    def insert(self, obj):
+        self._getWritableMapper().insert(obj)
+
+    def insertMany(self, objs, batchSize=1000):
+        self._getWritableMapper().insertMany(objs, batchSize=batchSize)
+
+    def insertFrom(self, template, sources, **kwargs):
+        self._getWritableMapper().insertFrom(template, sources, **kwargs)
+
+    def enableAppend(self):
+        self._getWritableMapper().enableAppend()
+
+    def clear(self):
+        self._getWritableMapper().clear()
+
+    def deleteAll(self):
+        self._getWritableMapper().deleteAll()
+
+    def delete(self, obj):
+        self._getWritableMapper().delete(obj)
+
+    def updateTo(self, obj, level=1):
+        self._getWritableMapper().updateTo(obj, level)
+
+    def setProperty(self, key, value):
+        value = str(value) if value is not None else None
+        if self._properties.get(key, value) != value or \
+                key not in self._properties:
+            self._getWritableMapper().setProperty(key, value)
+            self._properties[key] = value
+
+    def deleteProperty(self, key):
+        if key in self._properties:
+            self._getWritableMapper().deleteProperty(key)
+            del self._properties[key]
+
+    def hasProperty(self, key):
+        return key in self._properties
+
+    def getProperty(self, key, defaultValue=None):
+        return self._properties.get(key, defaultValue)
+
+    def getPropertyKeys(self):
+        return [k for k in self._properties
+                if not k.startswith(INTERNAL_PROPERTY)]
+
+    def selectById(self, objId):
+        if self._path is None:
+            return self._getSqliteMapper().selectById(objId)
+        i = np.searchsorted(self._ids, objId)
+        if i == len(self._ids) or self._ids[i] != objId:
+            return None
+        return next(self.__iterObjects(np.array([i])))
+
+    def selectAll(self, iterate=True, objectFilter=None, orderBy=ID,
+                  direction='ASC', where='1'):
+        if where != '1' or self._path is None or self.__isBinary(orderBy):
+            return self._getSqliteMapper().selectAll(iterate, objectFilter,
+                                                     orderBy, direction,
+                                                     where)
+        objs = self.__iterObjects(self.__getOrder(orderBy, direction),
+                                  objectFilter)
+        if iterate:
+            return objs
+        return [obj.clone() for obj in objs]
+
+    def selectPage(self, limit, token=None, orderBy=ID, direction='ASC',
+                   where='1'):
+        return self._getSqliteMapper().selectPage(limit, token, orderBy,
+                                                  direction, where)
+
+    def selectColumnArrays(self, labels, orderBy=ID, direction='ASC',
+                           where='1'):
+        """ Return the arrays of the columns as
+        SqliteFlatMapper.selectColumnArrays does. """
+        if where != '1' or self._path is None or self.__isBinary(orderBy):
+            return self._getSqliteMapper().selectColumnArrays(
+                labels, orderBy, direction, where)
+
+        order = self.__getOrder(orderBy, direction)
+        rows = slice(None) if order is None else order
+        arrays = OrderedDict()
+
+        for label in labels:
+            column = self._columns[label]
+            if column['kind'] in [STR, BYTES]:
+                arrays[label] = np.array(self.__getValues(label, rows),
+                                         dtype=object)
+            elif column['null'] is not None and column['null'].any():
+                array = column['data'][rows].astype(float)
+                array[column['null'][rows]] = np.nan
+                arrays[label] = array
+            else:
+                arrays[label] = np.array(column['data'][rows])
+
+        return arrays
+
+    def __getNumbers(self, label):
+        """ Return the values of a numeric column and its NULL mask. """
+        column = self._columns[label]
+        data = column['data']
+        if column['kind'] == FLOAT:
+            return data, np.isnan(data)
+        if column['kind'] == BOOL:
+            data = data.astype(np.int64)
+        if column['null'] is not None:
+            return data, np.asarray(column['null'])
+        return data, np.zeros(len(data), dtype=bool)
+
+    def getColumnStats(self, label, bins=0):
+        """ Compute the statistics of the values of a numeric attribute,
+        see SqliteFlatDb.selectColumnStats. """
+        if self._path is None or self._columns[label]['kind'] in [STR, BYTES]:
+            return self._getSqliteMapper().getColumnStats(label, bins)
+
+        data, nulls = self.__getNumbers(label)
+        values = data[~nulls] if nulls.any() else data
+        count = len(values)
+        stats = {'count': count, 'min': None, 'max': None, 'mean': None,
+                 'std': None}
+        if count:
+            stats['min'] = values.min().item()
+            stats['max'] = values.max().item()
+            mean = float(values.mean(dtype=np.float64))
+            meanSq = float(np.mean(np.square(values, dtype=np.float64)))
+            stats['mean'] = mean
+            stats['std'] = float(np.sqrt(max(0., meanSq - mean * mean)))
+
+        if bins > 0:
+            histogram = [0] * bins
+            edges = None
+            if count:
+                low, high = stats['min'], stats['max']
+                width = float(high - low) / bins
+                edges = [low + i * width for i in range(bins)]
+                edges.append(high)
+                # Same bins as the CAST to INTEGER used in sqlite
+                binIndex = np.minimum(((values - low) / (width or 1.))
+                                      .astype(np.int64), bins - 1)
+                histogram = np.bincount(binIndex, minlength=bins).tolist()
+            stats['histogram'] = histogram
+            stats['edges'] = edges
+
+        return stats
+
+    def aggregate(self, operations, operationLabel, groupByLabels=None):
+        """ Compute COUNT, SUM, MIN, MAX and AVG of the values of an
+        attribute, optionally grouped by other attributes. The groups
+        are sorted by value, as returned by the GROUP BY of sqlite.
+        """
+        kind = self._columns[operationLabel]['kind']
+        unsupported = [op for op in operations
+                       if op not in ['COUNT', 'SUM', 'MIN', 'MAX', 'AVG'] or
+                       (kind == STR and op in ['SUM', 'AVG'])]
+        if (self._path is None or unsupported or kind == BYTES or
+                self.__isBinary(groupByLabels or [])):
+            return self._getSqliteMapper().aggregate(operations,
+                                                     operationLabel,
+                                                     groupByLabels)
+
+        n = len(self._ids)
+        if kind == STR:
+            data = self._columns[operationLabel]['data']
+            nulls = data < 0
+        else:
+            data, nulls = self.__getNumbers(operationLabel)
+
+        if groupByLabels:
+            if not n:
+                return []
+            groups, firstRows = self.__getGroups(groupByLabels)
+        else:
+            groups, firstRows = np.zeros(n, dtype=np.int64), [None]
+
+        numGroups = len(firstRows)
+        valid = ~nulls
+        validGroups = groups[valid]
+        validData = data[valid]
+        counts = np.bincount(validGroups, minlength=numGroups)
+        results = []
+
+        if 'MIN' in operations or 'MAX' in operations:
+            # Sort by group and value to get the first and last of each
+            order = np.lexsort((validData, validGroups))
+            sortedData = validData[order]
+            starts = np.searchsorted(validGroups[order], np.arange(numGroups))
+        if 'SUM' in operations or 'AVG' in operations:
+            sums = np.bincount(validGroups, weights=validData,
+                               minlength=numGroups)
+
+        for g, row in enumerate(firstRows):
+            values = {}
+            count = int(counts[g])
+            for op in operations:
+                if op == 'COUNT':
+                    values[op] = count
+                elif not count:
+                    values[op] = None
+                elif op == 'SUM':
+                    values[op] = (int(round(sums[g])) if kind in [INT, BOOL]
+                                  else float(sums[g]))
+                elif op == 'AVG':
+                    values[op] = float(sums[g]) / count
+                else:
+                    i = starts[g] if op == 'MIN' else starts[g] + count - 1
+                    value = sortedData[i].item()
+                    if kind == STR:
+                        value = self.__getStrings(operationLabel)[value]
+                    values[op] = value
+            for label in groupByLabels or []:
+                values[label] = self.__getValues(label, np.array([row]))[0]
+            results.append(values)
+
+        return results
+
+    def __getGroups(self, labels):
+        """ Return the group index of each row (groups sorted by the
+        values of the labels) and the first row of each group. """
+        combined = np.zeros(len(self._ids), dtype=np.int64)
+        for label in labels:
+            for key in self.__getSortKeys(label):
+                _, inverse = np.unique(key, return_inverse=True)
+                combined = combined * (inverse.max() + 1) + inverse
+        _, firstRows, groups = np.unique(combined, return_index=True,
+                                         return_inverse=True)
+        return groups, firstRows
+
+    def count(self):
+        if self._path is None:
+            return self._getSqliteMapper().count()
+        return len(self._ids)
+
+    def maxId(self):
+        if self._path is None:
+            return self._getSqliteMapper().maxId()
+        return int(self._ids[-1]) if len(self._ids) else 0
+
+
+class SnapshotMapperException(Exception):
+    pass
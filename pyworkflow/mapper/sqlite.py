@@ -26,9 +26,19 @@
 
 
 from __future__ import print_function
+import json
+import base64
+from operator import attrgetter, itemgetter
+from itertools import izip
+from collections import OrderedDict
+
+import numpy as np
+
 from pyworkflow.utils.path import replaceExt, joinExt
+from pyworkflow.object import Object, Integer, Float, String
 from mapper import Mapper
-from sqlite_db import SqliteDb
+from sqlite_db import SqliteDb, sqlite
+from query import Expr
 
 ID = 'id'
 PARENT_ID = 'parent_id'
@@ -173,9 +183,11 @@ class SqliteMapper(Mapper):
         objRow = self.db.selectObjectById(obj._objId)
         self.fillObject(obj, objRow)
             
-    def selectById(self, objId):
-        """Build the object which id is objId"""
-        if objId in self.objDict:
+    def selectById(self, objId, reload=False):
+        """Build the object which id is objId. If reload is True, the
+        object is built again even if it was already loaded.
+        """
+        if objId in self.objDict and not reload:
             obj = self.objDict[objId]
         else:
             objRow = self.db.selectObjectById(objId)
@@ -331,21 +343,48 @@ class SqliteMapper(Mapper):
         objRows = self.db.selectObjectsBy(**args)
         return self.__objectsFromRows(objRows, iterate, objectFilter)
     
+    def _getClassWhere(self, className):
+        """ Return the where string to select the objects of
+        a given class or any of its subclasses. """
+        from pyworkflow.utils.reflection import getSubclasses
+        whereStr = "classname='%s'" % className
+        base = self.dictClasses.get(className)
+        subDict = getSubclasses(base, self.dictClasses)
+        for k, v in subDict.iteritems():
+            if issubclass(v, base):
+                whereStr += " OR classname='%s'" % k
+        return whereStr
+
     def selectByClass(self, className, includeSubclasses=True, iterate=False, objectFilter=None):
         self.__initObjDict()
         
         if includeSubclasses:
-            from pyworkflow.utils.reflection import getSubclasses
-            whereStr = "classname='%s'" % className
-            base = self.dictClasses.get(className)
-            subDict = getSubclasses(base, self.dictClasses)
-            for k, v in subDict.iteritems():
-                if issubclass(v, base):
-                    whereStr += " OR classname='%s'" % k
-            objRows = self.db.selectObjectsWhere(whereStr)
+            objRows = self.db.selectObjectsWhere(self._getClassWhere(className))
             return self.__objectsFromRows(objRows, iterate, objectFilter)
         else:
             return self.selectBy(iterate=iterate, classname=className)
+
+    def selectRowsByClass(self, className, depth=1):
+        """ Select the rows of the objects of a class (including subclasses)
+        and the rows of their attributes up to a given depth, without
+        building any object. This is much faster than selectByClass when
+        only a few values are needed from big objects.
+        Returns:
+            a tuple with the list of object rows and a dict with the
+            list of rows of the direct children of each object id.
+        """
+        whereStr = self._getClassWhere(className)
+        objRows = self.db.selectObjectsWhere(whereStr)
+        childRows = {}
+
+        for _ in range(depth):
+            whereStr = "%s IN (SELECT %s FROM Objects WHERE %s)" % (PARENT_ID,
+                                                                    ID,
+                                                                    whereStr)
+            for row in self.db.selectObjectsWhere(whereStr):
+                childRows.setdefault(row[PARENT_ID], []).append(row)
+
+        return objRows, childRows
             
     def selectAll(self, iterate=False, objectFilter=None):
         self.__initObjDict()
@@ -478,7 +517,31 @@ class SqliteMapper(Mapper):
                            parentExtended=None, childExtended=None):
         self.db.insertRelation(relName, creatorId, parentId, childId,
                                parentExtended, childExtended)
-    
+
+    def insertChange(self, names=()):
+        """ Register that the objects with the given names have been
+        updated (any object if names is empty). It is committed with
+        the next commit. Return the new revision of the database.
+        """
+        return self.db.insertChange(names)
+
+    def getRevision(self):
+        """ Return the revision of the last change registered. """
+        return self.db.getRevision()
+
+    def selectChanges(self, revision):
+        """ Return the list of names of the objects changed after the given
+        revision, an empty name means that any object could have changed.
+        None is returned if the changes since revision are not available.
+        """
+        rows = self.db.selectChanges(revision)
+        if rows is None:
+            return None
+        names = []
+        for row in rows:
+            names.extend((row['names'] or '').split(','))
+        return names
+
     
 class SqliteObjectsDb(SqliteDb):
     """Class to handle a Sqlite database.
@@ -486,7 +549,9 @@ class SqliteObjectsDb(SqliteDb):
     # Maintain the current version of the DB schema
     # useful for future updates and backward compatibility
     # version should be an integer number
-    VERSION = 1
+    VERSION = 2
+    # Number of changes kept in the Changes table
+    CHANGES_SIZE = 100
     
     SELECT = "SELECT id, parent_id, name, classname, value, label, comment, datetime(creation, 'localtime') as creation FROM Objects WHERE "
     DELETE = "DELETE FROM Objects WHERE "
@@ -545,13 +610,23 @@ class SqliteObjectsDb(SqliteDb):
                       object_parent_extended TEXT DEFAULT NULL, -- extended property to consider internal objects
                       object_child_extended TEXT DEFAULT NULL
                       )""")
+        self.__createChangesTable()
         self.commit()
+
+    def __createChangesTable(self):
+        """ Create the table with the log of changes, each change
+        has a revision number that never decreases. """
+        self.executeCommand("""CREATE TABLE IF NOT EXISTS Changes
+                     (revision  INTEGER PRIMARY KEY AUTOINCREMENT,
+                      names     TEXT DEFAULT NULL  -- comma separated names of the changed objects
+                      )""")
         
     def __updateTables(self):
         """ This method is intended to update the table schema
         in the case of dealing with old database version.
         """
-        if self.getVersion() < self.VERSION: # This applies for version 1
+        version = self.getVersion()
+        if version < 1:
             # Add the extra column for pointer extended attribute in Relations table
             # from version 1 on, there is not needed since the table will 
             # already contains this column
@@ -562,6 +637,12 @@ class SqliteObjectsDb(SqliteDb):
             if not 'object_child_extended' in columns:    
                 self.executeCommand("ALTER TABLE Relations "
                                     "ADD COLUMN object_child_extended  TEXT DEFAULT NULL")
+        if version < 2:
+            try:
+                self.__createChangesTable()
+            except sqlite.OperationalError:
+                return  # Read-only database, it can not be updated
+        if version < self.VERSION:
             self.setVersion(self.VERSION)
         
         
@@ -698,12 +779,62 @@ class SqliteObjectsDb(SqliteDb):
     def deleteRelationsByCreator(self, parent_id):
         self.executeCommand("DELETE FROM Relations where parent_id=?", (parent_id,))
 
+    def insertChange(self, names):
+        """ Register a change of the objects with the given names, an
+        empty list means that any object could have changed. Only the
+        last CHANGES_SIZE changes are kept. Return the new revision.
+        """
+        self.executeCommand("INSERT INTO Changes (names) VALUES (?)",
+                            (','.join(names),))
+        revision = self.cursor.lastrowid
+        self.executeCommand("DELETE FROM Changes WHERE revision<=?",
+                            (revision - self.CHANGES_SIZE,))
+        return revision
+
+    def getRevision(self):
+        """ Return the revision of the last change (0 if none). """
+        if not self.hasTable('Changes'):
+            return 0
+        self.executeCommand("SELECT MAX(revision) FROM Changes")
+        return self.cursor.fetchone()[0] or 0
+
+    def selectChanges(self, revision):
+        """ Return the rows of the changes after the given revision or
+        None if some of them are not longer in the log.
+        """
+        if not self.hasTable('Changes'):
+            return None
+        self.executeCommand("SELECT MIN(revision) FROM Changes")
+        first = self.cursor.fetchone()[0]
+        if first is not None and first > revision + 1:
+            return None
+        self.executeCommand("SELECT revision, names FROM Changes "
+                            "WHERE revision>? ORDER BY revision", (revision,))
+        return self.cursor.fetchall()
+
 
 class SqliteFlatMapper(Mapper):
     """Specific Flat Mapper implementation using Sqlite database"""
+    # Numpy types used when reading columns of these classes
+    DTYPE_MAP = {'Integer': int,
+                 'Float': float,
+                 'Boolean': bool
+                 }
+    # Builtin types used by the conversion of scalar classes, the values
+    # of these attributes are set directly when filling the template
+    SCALAR_CONVERTERS = {Integer._convertValue.im_func: int,
+                         Float._convertValue.im_func: float,
+                         String._convertValue.im_func: str
+                         }
+
     def __init__(self, dbName, dictClasses=None, tablePrefix=''):
         Mapper.__init__(self, dictClasses)
         self._objTemplate = None
+        self._objGetter = None
+        self._indexes = []
+        self._indexesChecked = False
+        # Cached statistics could be stored in the db
+        self._statsCached = True
         try:
             self.db = SqliteFlatDb(dbName, tablePrefix)
             self.doCreateTables = self.db.missingTables()
@@ -716,19 +847,179 @@ class SqliteFlatMapper(Mapper):
                             (dbName, tablePrefix, ex))
     
     def commit(self):
+        self.__checkIndexes()
         self.db.commit()
         
     def close(self):
         self.db.close()
         
-    def insert(self, obj):
+    def setIndexes(self, labels):
+        """ Declare the attributes (e.g. _micId or _ctfModel._defocusU)
+        whose columns should be indexed. The indexes are created with
+        the tables or, for existing databases, the next time that the
+        changes are committed (e.g. with Set.write), never when reading.
+        """
+        self._indexes = list(labels)
+        self._indexesChecked = False
+
+    def _createTables(self, obj):
+        """ Create the tables using obj as template for the columns. """
+        objDict = obj.getObjDict(includeClass=True)
+        self._objGetter = None
+        if self.db.missingTables():
+            self.db.createTables(objDict)
+        else:
+            # A table shared by several classes could have been
+            # created by other mapper after this one was opened
+            self.__loadObjDict()
+            self.db.setupCommands(objDict)
+        self.doCreateTables = False
+        self.__checkIndexes()
+
+    def __checkIndexes(self):
+        """ Create the declared indexes that are not registered yet,
+        they will be committed with the other pending changes.
+        """
+        if self._indexesChecked or self.doCreateTables:
+            return
+        self._indexesChecked = True
+        indexes = self.db.getIndexes()
+        missing = [label for label in self._indexes if label not in indexes]
+        if missing:
+            try:
+                for label in missing:
+                    self.db.createIndex(label)
+            except sqlite.OperationalError as ex:
+                # The db could be read-only, the queries will
+                # work anyway without the index
+                print("WARNING: could not create indexes %s on db: %s\n"
+                      "         %s" % (missing, self.db.getDbName(), ex))
+
+    def __setupInsert(self, obj):
+        """ Create the tables or the insert command if needed, and
+        the getter of the column values, using obj as template.
+        """
+        self.__deleteColumnStats()
         if self.doCreateTables:
-            self.db.createTables(obj.getObjDict(includeClass=True))
-            self.doCreateTables = False
+            self._createTables(obj)
+        elif self.db.INSERT_OBJECT is None:
+            self.db.setupCommands(obj.getObjDict(includeClass=True))
+        if self._objGetter is None:
+            self.__buildGetter(obj)
+
+    def __buildGetter(self, obj):
+        """ Build a function returning the values of all the columns of
+        an object in a single call, so the values of each inserted object
+        are read without building its objDict (the reverse of the setters
+        used to fill the template when reading). The internal value of
+        each attribute is read directly, unless its class in obj redefines
+        getObjValue, then getObjValue is called on the attribute.
+        """
+        self._objLabels = self.db.getColumnLabels()
+        paths = []
+        self._objValueIndexes = []
+
+        for i, label in enumerate(self._objLabels):
+            try:
+                attrClass = type(attrgetter(label)(obj))
+                getObjValue = attrClass.getObjValue.im_func
+            except AttributeError:
+                getObjValue = None
+            if getObjValue is Object.getObjValue.im_func:
+                paths.append(label + '._objValue')
+            else:
+                paths.append(label)
+                self._objValueIndexes.append(i)
+
+        if len(paths) > 1:
+            self._objGetter = attrgetter(*paths)
+        else:  # attrgetter only returns a tuple for several attributes
+            getters = [attrgetter(p) for p in paths]
+            self._objGetter = lambda o: [g(o) for g in getters]
+
+    def __getRow(self, obj):
+        """ Return the values of the columns of an object. """
+        row = [obj.getObjId(), obj.isEnabled(), obj.getObjLabel(),
+               obj.getObjComment()]
+        try:
+            values = list(self._objGetter(obj))
+            for i in self._objValueIndexes:
+                values[i] = values[i].getObjValue()
+        except AttributeError:
+            # Some attribute is missing (or None) in this object
+            objDict = obj.getObjDict()
+            values = [objDict.get(label) for label in self._objLabels]
+        row.extend(values)
+        return row
+
+    def insert(self, obj):
         """Insert a new object into the system, the id will be set"""
-        self.db.insertObject(obj.getObjId(), obj.isEnabled(), obj.getObjLabel(), obj.getObjComment(), 
-                             *obj.getObjDict().values())
-        
+        self.__setupInsert(obj)
+        self.db.insertObject(*self.__getRow(obj))
+
+    def insertMany(self, objs, batchSize=1000):
+        """ Insert several objects using batched inserts.
+        The rows are written with executemany in groups of batchSize.
+        Since the values of each object are taken as soon as it is
+        iterated, the same instance can be reused by the objs iterator.
+        The changes are not committed, so all batches will be part
+        of the same transaction until commit is called.
+        """
+        rows = []
+
+        for obj in objs:
+            if not rows:
+                self.__setupInsert(obj)
+            rows.append(self.__getRow(obj))
+
+            if len(rows) == batchSize:
+                self.db.insertObjects(rows)
+                rows = []
+
+        if rows:
+            self.db.insertObjects(rows)
+
+    def insertFrom(self, template, sources, subset=None, difference=False,
+                   renumber=False, where='1', updateColumns=None,
+                   copyDisabled=True, conditionalColumns=None):
+        """ Insert the items stored in other databases directly with SQL,
+        without building any object. The databases are attached to this
+        connection and the changes are committed.
+        Params:
+            template: object used to create the tables if they do not exist.
+                Columns of the sources are matched by attribute label, so
+                attributes not present in the template are dropped.
+            sources: list of (dbName, tablePrefix) of the items to insert.
+            subset: optional (dbName, tablePrefix), only the items whose id
+                is also there (or is not, if difference=True) are inserted.
+            renumber: assign new ids instead of keeping the original ones.
+            where, updateColumns, copyDisabled, conditionalColumns: see
+                SqliteFlatDb.insertObjectsFrom, labels are the ones
+                of the template attributes.
+        """
+        if self.doCreateTables:
+            self._createTables(template)
+
+        aliases = []
+        try:
+            for i, (dbName, prefix) in enumerate(sources):
+                alias = 'source%d' % i
+                self.db.attachDb(dbName, alias)
+                aliases.append((alias, prefix))
+            subsetAlias = None
+            if subset is not None:
+                self.db.attachDb(subset[0], 'subset')
+                subsetAlias = ('subset', subset[1])
+                aliases.append(subsetAlias)
+
+            self.db.insertObjectsFrom(aliases[:len(sources)], subsetAlias,
+                                      difference, renumber, where,
+                                      updateColumns, copyDisabled,
+                                      conditionalColumns)
+        finally:
+            for alias, _ in aliases:
+                self.db.detachDb(alias)
+
     def enableAppend(self):
         """ This will allow to append items to existing db. 
         This is by default not allow, since most sets are not 
@@ -741,18 +1032,21 @@ class SqliteFlatMapper(Mapper):
         
     def clear(self):
         self.db.clear()
-        self.doCreateTables = True
+        self.doCreateTables = self.db.missingTables()
     
     def deleteAll(self):
         """ Delete all objects stored """
+        self.__deleteColumnStats()
         self.db.deleteAll()
                 
     def delete(self, obj):
         """Delete an object and all its childs"""
+        self.__deleteColumnStats()
         self.db.deleteObject(obj.getObjId())
     
     def updateTo(self, obj, level=1):
         """ Update database entry with new object values. """ 
+        self.__deleteColumnStats()
         if self.db.INSERT_OBJECT is None:
             self.db.setupCommands(obj.getObjDict(includeClass=True))
         args = list(obj.getObjDict().values())
@@ -765,6 +1059,7 @@ class SqliteFlatMapper(Mapper):
         if objRow is None:
             obj = None
         else:
+            self.__checkSetters()
             obj = self.__objFromRow(objRow)
         return obj
 
@@ -800,9 +1095,77 @@ class SqliteFlatMapper(Mapper):
                         setattr(o, a, attr)
                     o = attr
                     attrJoin += '.'
+        self._objClasses = attrClasses
         basicRows = 5
         n = len(rows) + basicRows - 1
         self._objColumns = zip(range(basicRows, n), columnList)
+        self.__buildSetters()
+
+    def __buildSetters(self):
+        """ Build the list of (column index, setter) pairs to fill the
+        template object from a row, so the attribute names do not need
+        to be parsed for each row. Integer, Float and String attributes
+        are not filled with their setter, but with the internal value
+        converted with the builtin type (as done by set). The objects
+        walked are also kept in (parent, name, child) tuples to detect
+        if any attribute of the template has been replaced by another
+        object.
+        """
+        self._objSetters = []
+        scalarColumns = []
+        self._objScalars = []
+        nodes = OrderedDict()
+        topNames = OrderedDict()
+
+        for c, attrName in self._objColumns:
+            parent = self._objTemplate
+            topNames[attrName.split('.')[0]] = True
+            for name in attrName.split('.'):
+                child = getattr(parent, name, None)
+                if child is None:
+                    raise SqliteFlatMapperException(
+                        "Attribute '%s' of '%s' is None, it can not be read"
+                        % (name, attrName))
+                nodes[(id(parent), name)] = (parent, name, child)
+                parent = child
+            attrClass = type(parent)
+            convert = None
+            if attrClass.set.im_func is Object.set.im_func:
+                convert = self.SCALAR_CONVERTERS.get(
+                    attrClass._convertValue.im_func)
+            if convert is None:
+                self._objSetters.append((c, parent.set))
+            else:
+                scalarColumns.append(c)
+                self._objScalars.append((parent, convert))
+
+        if len(scalarColumns) > 1:
+            self._objScalarValues = itemgetter(*scalarColumns)
+        else:  # itemgetter only returns a tuple for several items
+            getters = [itemgetter(c) for c in scalarColumns]
+            self._objScalarValues = lambda row: [g(row) for g in getters]
+
+        self._objNodes = nodes.values()
+        # Direct attributes of the template and the ids of their values
+        self._objTopNames = topNames.keys()
+        self._objTopIds = self.__getTopIds()
+
+    def __getTopIds(self):
+        return map(id, map(self._objTemplate.__dict__.get,
+                           self._objTopNames))
+
+    def __checkSetters(self):
+        """ Rebuild the setters if an attribute of the template has
+        been replaced. All attributes are checked once per selection,
+        and only the direct ones for each row (the ones replaced
+        when using the iterated item, e.g. with setCTF).
+        """
+        if self._objTemplate is None:
+            return
+        for parent, name, child in self._objNodes:
+            if getattr(parent, name, None) is not child:
+                self.__buildSetters()
+                return
          
     def __buildAndFillObj(self):
         obj = self._buildObjectFromClass(self._objClassName)
@@ -835,12 +1198,18 @@ class SqliteFlatMapper(Mapper):
             print("         db: %s" % self.db.getDbName())
             print("         objRow: ", dict(objRow))
         
-        for c, attrName in self._objColumns:
-            obj.setAttributeValue(attrName, objRow[c])
+        if self.__getTopIds() != self._objTopIds:
+            self.__buildSetters()
+        for (attr, convert), value in izip(self._objScalars,
+                                           self._objScalarValues(objRow)):
+            attr._objValue = value if value is None else convert(value)
+        for c, setter in self._objSetters:
+            setter(objRow[c])
 
         return obj
         
     def __iterObjectsFromRows(self, objRows, objectFilter=None):
+        self.__checkSetters()
         for objRow in objRows:
             obj = self.__objFromRow(objRow)
             if objectFilter is None or objectFilter(obj): 
@@ -880,6 +1249,89 @@ class SqliteFlatMapper(Mapper):
         
         return self.__objectsFromRows(objRows, iterate, objectFilter) 
 
+    def selectAllByClass(self, where='1'):
+        """ Iterate over the objects of a table shared by several classes
+        (see SqliteFlatDb.getClassPrefix) ordered by class and id.
+        Yield (classId, obj) pairs, where obj is the same instance
+        filled with the values of each row.
+        """
+        if self.doCreateTables:
+            return
+
+        if self._objTemplate is None:
+            self.__loadObjDict()
+
+        self.__checkSetters()
+        for objRow in self.db.selectAllByClass(where=where):
+            yield objRow[CLASS_ID], self.__objFromRow(objRow)
+
+    def selectPage(self, limit, token=None, orderBy=ID, direction='ASC',
+                   where='1'):
+        """ Select a page of at most limit objects using keyset pagination,
+        the page starts after the last row of the previous page and the
+        cost does not depend on how deep the page is.
+        Params:
+            limit: maximum number of objects in the page.
+            token: resume token returned for the previous page (None for
+                the first page). It is only valid with the same orderBy and
+                direction used to create it.
+            orderBy: a column or list of columns; the id is always used
+                as last column to have a unique order.
+        Returns:
+            a tuple (objects, nextToken) where objects is a list with a
+            clone of each object and nextToken is None if there are no
+            more pages.
+        """
+        if not self.db.hasTable('Properties'):
+            return [], None
+
+        if self._objTemplate is None:
+            self.__loadObjDict()
+
+        orderByList = [orderBy] if isinstance(orderBy, basestring) else orderBy
+        orderByList = [c for c in orderByList if c != ID] + [ID]
+        after = self._parsePageToken(token, orderByList, direction)
+
+        rows = self.db.selectPage(limit, after, orderByList, direction, where)
+        objs = [obj.clone() for obj in self.__iterObjectsFromRows(rows)]
+        nextToken = None
+
+        if rows and len(rows) == limit:
+            lastValues = [rows[-1][str(self.db._getRealCol(c))]
+                          for c in orderByList]
+            nextToken = self._createPageToken(orderByList, direction,
+                                               lastValues)
+
+        return objs, nextToken
+
+    @staticmethod
+    def _createPageToken(orderByList, direction, lastValues):
+        # BLOB values (e.g. Matrix columns) can not be stored in json
+        values = [{'blob': base64.b64encode(v)} if isinstance(v, buffer)
+                  else v for v in lastValues]
+        pageDict = {'orderBy': orderByList, 'direction': direction,
+                    'values': values}
+        return base64.urlsafe_b64encode(json.dumps(pageDict))
+
+    @staticmethod
+    def _parsePageToken(token, orderByList, direction):
+        """ Return the values of the last row of the previous page. """
+        if token is None:
+            return None
+
+        try:
+            pageDict = json.loads(base64.urlsafe_b64decode(str(token)))
+        except (TypeError, ValueError):
+            raise SqliteFlatMapperException("Invalid page token: %s" % token)
+
+        if (pageDict['orderBy'] != orderByList or
+                pageDict['direction'] != direction):
+            raise SqliteFlatMapperException("Page token was created with "
+                                            "a different order")
+
+        return [buffer(base64.b64decode(v['blob'])) if isinstance(v, dict)
+                else v for v in pageDict['values']]
+
     def aggregate(self, operations, operationLabel, groupByLabels=None):
         rows = self.db.aggregate(operations, operationLabel, groupByLabels)
         results = []
@@ -894,12 +1346,91 @@ class SqliteFlatMapper(Mapper):
 
         return results
 
+    def selectColumnArrays(self, labels, orderBy=ID, direction='ASC',
+                           where='1'):
+        """ Select the values of some attributes (and also 'id' or 'enabled')
+        for all rows matching the where, without building any object.
+        Return an OrderedDict with a numpy array for each label.
+        Integer columns with NULL values are returned as float with nan,
+        and Boolean ones as objects with None (as Boolean.get does).
+        """
+        arrays = OrderedDict()
+
+        if self.doCreateTables:
+            for label in labels:
+                arrays[label] = np.array([])
+            return arrays
+
+        if self._objTemplate is None:
+            self.__loadObjDict()
+
+        rows = self.db.selectColumns(labels, orderBy=orderBy,
+                                     direction=direction, where=where)
+        columns = zip(*rows) if rows else [()] * len(labels)
+
+        for label, values in zip(labels, columns):
+            if label in ['id', 'enabled']:
+                className = 'Integer'
+            else:
+                className = self._objClasses[label]
+            dtype = self.DTYPE_MAP.get(className, object)
+            if dtype is int and None in values:
+                dtype = float
+            elif dtype is bool and None in values:
+                values = [v if v is None else bool(v) for v in values]
+                dtype = object
+            arrays[label] = np.array(values, dtype=dtype)
+
+        return arrays
+
     def count(self):
         return 0 if self.doCreateTables else self.db.count()
 
     def maxId(self):
         return 0 if self.doCreateTables else self.db.maxId()
 
+    def getColumnStats(self, label, bins=0):
+        """ Return the statistics of the values of an attribute
+        (see SqliteFlatDb.selectColumnStats). The result is cached in the
+        Properties table together with the number of rows and the max id,
+        and deleted when items are inserted, updated or deleted.
+        """
+        if self.doCreateTables:
+            return self.__emptyColumnStats(bins)
+
+        if self._objTemplate is None:
+            self.__loadObjDict()
+
+        key = '%s%s.%d' % (self.db.STATS_PROPERTY, label, bins)
+        fingerprint = [self.db.count(), self.db.maxId()]
+        value = self.db.getProperty(key)
+        if value is not None:
+            cached = json.loads(value)
+            if cached['fingerprint'] == fingerprint:
+                return cached['stats']
+
+        stats = self.db.selectColumnStats(label, bins)
+        # The db could be locked by a writer (even this mapper, if it has
+        # pending changes) or be read-only, then stats will not be cached
+        if self.db.cacheProperty(key, json.dumps({'fingerprint': fingerprint,
+                                                  'stats': stats})):
+            self._statsCached = True
+        return stats
+
+    def __emptyColumnStats(self, bins):
+        stats = {'count': 0, 'min': None, 'max': None, 'mean': None,
+                 'std': None}
+        if bins > 0:
+            stats['histogram'] = [0] * bins
+            stats['edges'] = None
+        return stats
+
+    def __deleteColumnStats(self):
+        """ Delete the cached statistics when the rows change. """
+        if self._statsCached:
+            self.db.deleteColumnStats()
+            self._statsCached = False
+
     def __objectsFromIds(self, objIds):
         """Return a list of objects, given a list of id's
         """
@@ -918,7 +1449,10 @@ class SqliteFlatMapper(Mapper):
         return self.db.deleteProperty(key)
     
     def getPropertyKeys(self):
-        return self.db.getPropertyKeys()
+        """ Return the keys of the properties stored for the Set,
+        skipping the ones used internally by the mapper. """
+        return [k for k in self.db.getPropertyKeys()
+                if not k.startswith(INTERNAL_PROPERTY)]
         
 
 class SqliteFlatMapperException(Exception):
@@ -926,6 +1460,14 @@ class SqliteFlatMapperException(Exception):
 
 
 SELF = 'self'
+# Properties with keys starting with this prefix are used internally
+# by the mapper and do not correspond to attributes of the Set
+INTERNAL_PROPERTY = 'db.'
+# The items of several sets (e.g. the classes of a SetOfClasses) can be
+# stored in the same tables, with a column for the class of each row.
+# The prefix of each set is then given as 'tablePrefix:classId'
+CLASS_ID = 'class_id'
+CLASS_SEP = ':'
 
 
 class SqliteFlatDb(SqliteDb):
@@ -938,14 +1480,13 @@ class SqliteFlatDb(SqliteDb):
     
     CLASS_MAP = {'Integer': 'INTEGER',
                  'Float': 'REAL',
-                 'Boolean': 'INTEGER'
+                 'Boolean': 'INTEGER',
+                 'Matrix': 'BLOB'
                  }
 
     def __init__(self, dbName, tablePrefix='', timeout=1000):
         SqliteDb.__init__(self)
-        tablePrefix = tablePrefix.strip()
-        if tablePrefix and not tablePrefix.endswith('_'): # Avoid having _ for empty prefix
-            tablePrefix += '_'
+        tablePrefix, self.classId = self.splitTablePrefix(tablePrefix)
         #NOTE (Jose Miguel, 2014/01/02
         # Reusing connections is a bit dangerous, since it have lead to
         # unexpected and hard to trace errors due to using an out-of-date
@@ -959,9 +1500,16 @@ class SqliteFlatDb(SqliteDb):
             self._reuseConnections = False#True
         
         self.CHECK_TABLES = "SELECT name FROM sqlite_master WHERE type='table' AND name='%sObjects';" % tablePrefix
-        self.SELECT = "SELECT * FROM %sObjects WHERE " % tablePrefix
-        self.FROM   = "FROM %sObjects" % tablePrefix
-        self.DELETE = "DELETE FROM %sObjects WHERE " % tablePrefix
+        if self.classId is None:
+            self.FROM   = "FROM %sObjects" % tablePrefix
+            self.DELETE = "DELETE FROM %sObjects WHERE " % tablePrefix
+        else:
+            # Only the rows of this class are visible in the shared table
+            self.FROM   = "FROM (SELECT * FROM %sObjects WHERE %s=%d)" % (
+                tablePrefix, CLASS_ID, self.classId)
+            self.DELETE = "DELETE FROM %sObjects WHERE %s=%d AND " % (
+                tablePrefix, CLASS_ID, self.classId)
+        self.SELECT = "SELECT * %s WHERE " % self.FROM
         self.INSERT_CLASS = "INSERT INTO %sClasses (label_property, column_name, class_name) VALUES (?, ?, ?)" % tablePrefix
         self.SELECT_CLASS = "SELECT * FROM %sClasses;" % tablePrefix
         self.tablePrefix = tablePrefix
@@ -975,6 +1523,38 @@ class SqliteFlatDb(SqliteDb):
         self.UPDATE_PROPERTY = "UPDATE Properties SET value=? WHERE key=?"
         self.SELECT_PROPERTY = "SELECT value FROM Properties WHERE key=?"
         self.SELECT_PROPERTY_KEYS = "SELECT key FROM Properties"
+        # The Properties table is shared by all prefixes, so the
+        # internal keys should include the table prefix
+        self.INDEXES_PROPERTY = "%s%sindexes" % (INTERNAL_PROPERTY, tablePrefix)
+        self.STATS_PROPERTY = "%s%sstats." % (INTERNAL_PROPERTY, tablePrefix)
+        if self.classId is not None:
+            self.STATS_PROPERTY += '%s%d.' % (CLASS_ID, self.classId)
+
+    @staticmethod
+    def getTablePrefix(prefix):
+        """ Return the prefix used in the tables names. """
+        prefix = prefix.strip()
+        if prefix and not prefix.endswith('_'): # Avoid having _ for empty prefix
+            prefix += '_'
+        return prefix
+
+    @staticmethod
+    def getClassPrefix(prefix, classId):
+        """ Return the prefix of a set whose items are stored, together
+        with the ones of other sets, in the table with the given prefix.
+        """
+        return '%s%s%d' % (prefix.strip(), CLASS_SEP, classId)
+
+    @staticmethod
+    def splitTablePrefix(prefix):
+        """ Return the prefix used in the tables names and the class id
+        (None if the table is not shared) of the prefix of a set.
+        """
+        classId = None
+        if CLASS_SEP in prefix:
+            prefix, classId = prefix.rsplit(CLASS_SEP, 1)
+            classId = int(classId)
+        return SqliteFlatDb.getTablePrefix(prefix), classId
 
     def hasProperty(self, key):
         """ Return true if a property with this value is registered. """
@@ -1017,6 +1597,28 @@ class SqliteFlatDb(SqliteDb):
         else:
             self.executeCommand(self.INSERT_PROPERTY, (key, value))
             
+    def cacheProperty(self, key, value):
+        """ Set a property using a new connection that does not wait
+        for locks, so the pending changes of this one are not committed.
+        Return False if the property could not be stored (e.g. the db
+        is locked by a writer, even this connection).
+        """
+        dbName = self.getDbName()
+        if dbName == self.POOL.MEMORY or not self.hasTable('Properties'):
+            return False
+        connection = sqlite.Connection(dbName, timeout=0)
+        try:
+            with connection:
+                cursor = connection.execute(self.UPDATE_PROPERTY,
+                                            (value, key))
+                if not cursor.rowcount:
+                    connection.execute(self.INSERT_PROPERTY, (key, value))
+            return True
+        except sqlite.OperationalError:
+            return False
+        finally:
+            connection.close()
+
     def getPropertyKeys(self):
         """ Return all properties stored of this object. """
         self.executeCommand(self.SELECT_PROPERTY_KEYS)
@@ -1037,6 +1639,10 @@ class SqliteFlatDb(SqliteDb):
         return result is None
 
     def clear(self):
+        if self.classId is not None:
+            # Other classes are stored in the same tables
+            self.deleteAll()
+            return
         self.executeCommand("DROP TABLE IF EXISTS Properties;")
         self.executeCommand("DROP TABLE IF EXISTS %sClasses;" % self.tablePrefix)
         self.executeCommand("DROP TABLE IF EXISTS %sObjects;" % self.tablePrefix)
@@ -1060,12 +1666,13 @@ class SqliteFlatDb(SqliteDb):
                       class_name TEXT DEFAULT NULL  -- relation's class name
                       )""" % self.tablePrefix)
         CREATE_OBJECT_TABLE = """CREATE TABLE IF NOT EXISTS %sObjects
-                     (id        INTEGER PRIMARY KEY,
+                     (id        INTEGER %s,
                       enabled   INTEGER DEFAULT 1,   -- used to selected/deselect items from a set
                       label     TEXT DEFAULT NULL,   -- object label, text used for display
                       comment   TEXT DEFAULT NULL,   -- object comment, text used for annotations
                       creation  DATE                 -- creation date and time of the object
-                      """ % self.tablePrefix
+                      """ % (self.tablePrefix,
+                             'PRIMARY KEY' if self.classId is None else '')
 
         c = 0
         for k, v in objDict.iteritems():
@@ -1076,6 +1683,11 @@ class SqliteFlatDb(SqliteDb):
             if k != SELF:
                 CREATE_OBJECT_TABLE += ',%s  %s DEFAULT NULL' % (colName, self.CLASS_MAP.get(className, 'TEXT'))
 
+        if self.classId is not None:
+            # Ids are only unique within each class, the primary key
+            # is also used as the index to select the rows of a class
+            CREATE_OBJECT_TABLE += (',%s INTEGER, PRIMARY KEY (%s, id)'
+                                    % (CLASS_ID, CLASS_ID))
         CREATE_OBJECT_TABLE += ')'
         # Create the Objects table
         self.executeCommand(CREATE_OBJECT_TABLE)
@@ -1096,8 +1708,16 @@ class SqliteFlatDb(SqliteDb):
                 self.INSERT_OBJECT += ',%s' % colName
                 self.UPDATE_OBJECT += ', %s=?' % colName
 
-        self.INSERT_OBJECT += ") VALUES (?,?,?,?, datetime('now')" + ',?' * (c-1) + ')'
-        self.UPDATE_OBJECT += ' WHERE id=?'
+        values = ',?' * (c-1)
+        if self.classId is not None:
+            self.INSERT_OBJECT += ',%s' % CLASS_ID
+            values += ',%d' % self.classId
+            self.UPDATE_OBJECT += ' WHERE %s=%d AND id=?' % (CLASS_ID,
+                                                             self.classId)
+        else:
+            self.UPDATE_OBJECT += ' WHERE id=?'
+
+        self.INSERT_OBJECT += ") VALUES (?,?,?,?, datetime('now')" + values + ')'
 
     def getClassRows(self):
         """ Create a dictionary with names of the attributes
@@ -1105,6 +1725,35 @@ class SqliteFlatDb(SqliteDb):
         self.executeCommand(self.SELECT_CLASS)
         return self._results(iterate=False)
 
+    def getIndexes(self):
+        """ Return the attribute labels that have been indexed. """
+        value = self.getProperty(self.INDEXES_PROPERTY)
+        return value.split(',') if value else []
+
+    def createIndex(self, label):
+        """ Create an index on the column mapped to the attribute label
+        and register it in the Properties table. Attributes that
+        are not stored in this table are ignored.
+        """
+        colName = self._columnsMapping.get(label)
+        if colName is None:
+            return
+        self.executeCommand("CREATE INDEX IF NOT EXISTS %sObjects_%s "
+                            "ON %sObjects(%s)"
+                            % (self.tablePrefix, colName,
+                               self.tablePrefix, colName))
+        indexes = self.getIndexes()
+        if label not in indexes:
+            indexes.append(label)
+            self.setProperty(self.INDEXES_PROPERTY, ','.join(indexes))
+
+    def getColumnLabels(self):
+        """ Return the attribute labels (all except 'self') in the
+        same order of the columns of the Objects table.
+        """
+        return [str(r['label_property']) for r in self.getClassRows()
+                if r['label_property'] != SELF]
+
     def getSelfClassName(self):
         """ Return the class name of the attribute named 'self'.
         This is the class of the items stored in a Set.
@@ -1123,6 +1772,12 @@ class SqliteFlatDb(SqliteDb):
         """
         self.executeCommand(self.INSERT_OBJECT, args)
 
+    def insertObjects(self, rows):
+        """ Insert several objects at once with a single executemany.
+        rows: list of tuples with the same values as insertObject args.
+        """
+        self.cursor.executemany(self.INSERT_OBJECT, rows)
+
     def updateObject(self, *args):
         """Update object data """
         self.executeCommand(self.UPDATE_OBJECT, args)
@@ -1132,44 +1787,125 @@ class SqliteFlatDb(SqliteDb):
         self.executeCommand(self.selectCmd(ID + "=?"), (objId,))
         return self.cursor.fetchone()
 
-    def selectAll(self, iterate=True, orderBy=ID, direction='ASC', where='1'):
+    def _getRealCol(self, colName):
+        """ Transform the column name taking into account
+         special columns such as: id or RANDOM(), and
+         getting the mapping translation otherwise.
+        """
+        if colName in ['id', 'enabled', 'RANDOM()', CLASS_ID]:
+            return colName
+        else:
+            return self._columnsMapping[colName]
+
+    def _getOrderByStr(self, orderBy, direction):
+        """ Return the ORDER BY string with the real table columns. """
         # Handle the specials orderBy values of 'id' and 'RANDOM()'
         # other columns names should be mapped to table column
         # such as: _micId -> c04
-
-        def _getRealCol(colName):
-            """ Transform the column name taking into account
-             special columns such as: id or RANDOM(), and
-             getting the mapping translation otherwise.
-            """
-            if colName in ['id', 'RANDOM()']:
-                return colName
-            else:
-                return self._columnsMapping[colName]
-
         if isinstance(orderBy, basestring):
-            orderByCol = _getRealCol(orderBy)
-        elif isinstance(orderBy, list):
-            orderByCol = ','.join([_getRealCol(c) for c in orderBy])
-        else:
+            orderBy = [orderBy]
+        elif not isinstance(orderBy, list):
             raise Exception('Invalid type for orderBy: %s' % type(orderBy))
+        orderByCol = ','.join([self._getRealCol(c) for c in orderBy])
+        orderByStr = ' ORDER BY %s %s' % (orderByCol, direction)
 
-        # Parse the where string to replace the colunm name with
-        # the real table column name ( for example: _micId -> c01 )
-        # Right now we are asuming a simple where string in the form
-        # colName=VALUE
+        # Rows with the same values are sorted by id (in the same
+        # direction), so the order does not depend on the query plan
+        if ID not in orderBy and 'RANDOM()' not in orderBy:
+            orderByStr += ', id %s' % direction
+
+        return orderByStr
+
+    def _getWhereStr(self, where):
+        """ Parse the where string to replace the colunm name with
+        the real table column name ( for example: _micId -> c01 )
+        Right now we are asuming a simple where string in the form
+        colName=VALUE
+        """
         if '=' in where:
             whereCol = where.split('=')[0]
-            whereRealCol = _getRealCol(whereCol)
-            whereStr = where.replace(whereCol, whereRealCol)
-        else:
-            whereStr = where
+            whereRealCol = self._getRealCol(whereCol)
+            return where.replace(whereCol, whereRealCol)
+
+        return where
 
+    def _getWhere(self, where):
+        """ Return the where string and its parameters. The where can be
+        a string (see _getWhereStr) or an expression with attribute labels
+        (see pyworkflow.mapper.query), whose values are passed as
+        parameters.
+        """
+        if isinstance(where, Expr):
+            return where.compile(self._getRealCol)
+        return self._getWhereStr(where), []
+
+    def selectAll(self, iterate=True, orderBy=ID, direction='ASC', where='1'):
+        whereStr, params = self._getWhere(where)
         cmd = self.selectCmd(whereStr,
-                             orderByStr=' ORDER BY %s %s' % (orderByCol, direction))
-        self.executeCommand(cmd)
+                             orderByStr=self._getOrderByStr(orderBy, direction))
+        self.executeCommand(cmd, params)
         return self._results(iterate)
 
+    def selectColumns(self, labels, orderBy=ID, direction='ASC', where='1'):
+        """ Select only the columns mapped to the given attribute labels.
+        Special columns such as 'id' or 'enabled' can also be requested.
+        Return a list of tuples (not sqlite.Row) with the values.
+        """
+        cols = [c if c in ['id', 'enabled'] else self._getRealCol(c)
+                for c in labels]
+        whereStr, params = self._getWhere(where)
+        cmd = "SELECT %s %s WHERE %s%s" % (','.join(cols), self.FROM,
+                                           whereStr,
+                                           self._getOrderByStr(orderBy,
+                                                               direction))
+        cursor = self.connection.cursor()
+        cursor.row_factory = None
+        cursor.execute(cmd, params)
+        return cursor.fetchall()
+
+    def selectPage(self, limit, after, orderBy, direction='ASC', where='1'):
+        """ Select at most limit rows ordered by the orderBy columns
+        (the last one should be the id) that come after the given
+        values of these columns. If after is None, the first rows are
+        returned. NULL values are sorted as SQLite does (first in ASC).
+        """
+        cols = [self._getRealCol(c) for c in orderBy]
+        if 'RANDOM()' in cols:
+            raise Exception("RANDOM() order can not be used for pagination")
+
+        whereStr, params = self._getWhere(where)
+        whereStr = '(%s)' % whereStr
+
+        if after is not None:
+            # Expand (c1, c2, id) > (v1, v2, lastId) as:
+            # c1 > v1 OR (c1 = v1 AND c2 > v2) OR (c1 = v1 AND c2 = v2 AND..)
+            terms = []
+            for i, (col, value) in enumerate(zip(cols, after)):
+                conds = []
+                for prevCol, prevValue in zip(cols[:i], after[:i]):
+                    if prevValue is None:
+                        conds.append('%s IS NULL' % prevCol)
+                    else:
+                        conds.append('%s=?' % prevCol)
+                        params.append(prevValue)
+                if value is None:
+                    # NULLs are the lowest values in SQLite
+                    conds.append('%s IS NOT NULL' % col
+                                 if direction == 'ASC' else '0')
+                elif direction == 'ASC':
+                    conds.append('%s>?' % col)
+                    params.append(value)
+                else:
+                    conds.append('(%s<? OR %s IS NULL)' % (col, col))
+                    params.append(value)
+                terms.append('(%s)' % ' AND '.join(conds))
+            whereStr += ' AND (%s)' % ' OR '.join(terms)
+
+        orderByStr = ' ORDER BY %s LIMIT %d' % (
+            ','.join('%s %s' % (c, direction) for c in cols), limit)
+        self.executeCommand(self.selectCmd(whereStr, orderByStr), params)
+        return self._results(iterate=False)
+
     def aggregate(self, operations, operationLabel, groupByLabels=None):
         #let us count for testing
         selectStr = 'SELECT '
@@ -1196,16 +1932,80 @@ class SqliteFlatDb(SqliteDb):
         self.executeCommand(sqlCommand)
         return self._results(iterate=False)
 
+    def selectColumnStats(self, label, bins=0, valueRange=None):
+        """ Compute with SQL the statistics of the values stored for
+        an attribute, NULL values are not taken into account.
+        Return a dict with count, min, max, mean and std. If bins > 0,
+        the histogram of the values (list of counts) and the edges
+        of the bins are also returned. The bins are computed between
+        the min and max values, or the ones given in valueRange, which
+        should include all values.
+        """
+        col = self._getRealCol(label)
+        cursor = self.connection.cursor()
+        cursor.row_factory = None
+        cursor.execute("SELECT COUNT(%(c)s), MIN(%(c)s), MAX(%(c)s), "
+                       "AVG(%(c)s), AVG(%(c)s * %(c)s) %(f)s"
+                       % {'c': col, 'f': self.FROM})
+        count, minValue, maxValue, mean, meanSq = cursor.fetchone()
+        std = None
+        if count:
+            # Rounding errors could give a small negative variance
+            std = float(np.sqrt(max(0., meanSq - mean * mean)))
+        stats = {'count': count, 'min': minValue, 'max': maxValue,
+                 'mean': mean, 'std': std}
+
+        if bins > 0:
+            histogram = [0] * bins
+            edges = None
+            if count:
+                low, high = valueRange or (minValue, maxValue)
+                width = float(high - low) / bins
+                edges = [low + i * width for i in range(bins)]
+                edges.append(high)
+                # All values fall in the first bin if there is only one
+                cursor.execute("SELECT MIN(CAST((%(c)s - ?) / ? AS INTEGER), "
+                               "?) AS bin, COUNT(*) %(f)s WHERE %(c)s "
+                               "IS NOT NULL GROUP BY bin"
+                               % {'c': col, 'f': self.FROM},
+                               (low, width or 1., bins - 1))
+                for b, n in cursor.fetchall():
+                    histogram[b] = n
+            stats['histogram'] = histogram
+            stats['edges'] = edges
+        cursor.close()
+
+        return stats
+
+    def deleteColumnStats(self):
+        """ Delete all the statistics cached in the Properties table. """
+        if self.hasTable('Properties'):
+            self.executeCommand("DELETE FROM Properties WHERE "
+                                "substr(key, 1, ?)=?",
+                                (len(self.STATS_PROPERTY),
+                                 self.STATS_PROPERTY))
+
     def count(self):
         """ Return the number of element in the table. """
-        self.executeCommand(self.selectCmd('1').replace('*', 'COUNT(id)'))
+        self.executeCommand("SELECT COUNT(id) %s" % self.FROM)
         return self.cursor.fetchone()[0]
 
     def maxId(self):
         """ Return the maximum id from the Objects table. """
-        self.executeCommand(self.selectCmd('1').replace('*', 'MAX(id)'))
+        self.executeCommand("SELECT MAX(id) %s" % self.FROM)
         return self.cursor.fetchone()[0]
 
+    def selectAllByClass(self, where='1'):
+        """ Select the rows of a table shared by several classes
+        ordered by class and id, the class_id column has the class
+        of each row.
+        """
+        whereStr, params = self._getWhere(where)
+        cmd = self.selectCmd(whereStr,
+                             orderByStr=' ORDER BY %s, %s' % (CLASS_ID, ID))
+        self.executeCommand(cmd, params)
+        return self._results(iterate=True)
+
     # FIXME: Seems to be duplicated and a subset of selectAll
     def selectObjectsBy(self, iterate=False, **args):
         """More flexible select where the constrains can be passed
@@ -1232,3 +2032,132 @@ class SqliteFlatDb(SqliteDb):
         if not self.missingTables():
             self.executeCommand(self.DELETE + "1")
 
+
+    def attachDb(self, dbName, alias):
+        """ Attach another database file to the connection, so its
+        tables can be used in queries as alias.tableName.
+        """
+        # ATTACH and DETACH are not allowed within a transaction
+        self.commit()
+        self.executeCommand("ATTACH DATABASE ? AS %s" % alias, (dbName,))
+
+    def detachDb(self, alias):
+        self.commit()
+        self.executeCommand("DETACH DATABASE %s" % alias)
+
+    def getClassColumns(self, alias='main', tablePrefix=None):
+        """ Return an OrderedDict with the column of each attribute label
+        (except 'self') reading the Classes table of the given database.
+        By default the table of this db is used, but it can also be
+        one of an attached database.
+        """
+        if tablePrefix is None:
+            tablePrefix = self.tablePrefix
+        self.executeCommand("SELECT label_property, column_name FROM "
+                            "%s.%sClasses ORDER BY id" % (alias, tablePrefix))
+        return OrderedDict((str(r['label_property']), str(r['column_name']))
+                           for r in self._iterResults()
+                           if r['label_property'] != SELF)
+
+    def _getObjectsWhere(self, alias, prefix):
+        """ Return the Objects table of an attached database followed
+        by a WHERE clause to select only the rows of the set with this
+        prefix, since the table could be shared by several classes.
+        """
+        tablePrefix, classId = self.splitTablePrefix(prefix)
+        classWhere = '1' if classId is None else '%s=%d' % (CLASS_ID, classId)
+        return '%s.%sObjects WHERE %s' % (alias, tablePrefix, classWhere)
+
+    def _getCopySelect(self, columns, alias, prefix, sourceIndex):
+        """ Return the SELECT of the rows of an attached Objects table
+        with the columns named as in this table. Columns are matched by
+        attribute label, so the layouts can be different: labels
+        missing in the other table are selected as NULL.
+        """
+        otherColumns = self.getClassColumns(alias,
+                                            self.splitTablePrefix(prefix)[0])
+        cols = ['%d AS _source' % sourceIndex, ID, 'enabled', 'label',
+                'comment']
+        cols.extend('%s AS %s' % (otherColumns.get(label, 'NULL'), col)
+                    for label, col in columns.iteritems())
+        return "SELECT %s FROM %s" % (', '.join(cols),
+                                      self._getObjectsWhere(alias, prefix))
+
+    def insertObjectsFrom(self, sources, subset=None, difference=False,
+                          renumber=False, where='1', updateColumns=None,
+                          copyDisabled=True, conditionalColumns=None):
+        """ Insert the rows of the Objects tables of attached databases
+        with a single INSERT ... SELECT.
+        Params:
+            sources: list of (alias, prefix) whose rows are joined
+                with UNION ALL, in the same order.
+            subset: optional (alias, prefix), only rows whose id is
+                in that table (or is not, if difference=True) are inserted.
+            renumber: if True, new ids are assigned following the order
+                of the sources, otherwise the ids are kept. Not allowed
+                if this table is shared by several classes.
+            where: condition on the attribute labels of this table that
+                the inserted rows should satisfy.
+            updateColumns: dict with attribute labels and the (already
+                converted) value that all inserted rows will have.
+            copyDisabled: if False, only enabled rows are inserted.
+            conditionalColumns: list of (where, values), the values are
+                set as in updateColumns, but only in the rows matching
+                the where. The last ones take precedence.
+        """
+        columns = self.getClassColumns()
+        self._columnsMapping.update(columns)
+        selectStr = ' UNION ALL '.join(
+            self._getCopySelect(columns, alias, prefix, i)
+            for i, (alias, prefix) in enumerate(sources))
+        whereStr, whereParams = self._getWhere(where)
+        whereList = [whereStr]
+
+        if subset is not None:
+            whereList.append('%s %sIN (SELECT id FROM %s)' % (
+                ID, 'NOT ' if difference else '',
+                self._getObjectsWhere(*subset)))
+
+        if not copyDisabled:
+            whereList.append('enabled=1')
+
+        updateColumns = updateColumns or {}
+        conditionalColumns = conditionalColumns or []
+        for values in [updateColumns] + [v for _, v in conditionalColumns]:
+            for label in values:
+                if label not in columns:
+                    raise Exception("Attribute '%s' not found in Classes "
+                                    "table, it can not be updated." % label)
+
+        insertCols = [ID, 'enabled', 'label', 'comment', 'creation']
+        insertCols.extend(columns.values())
+        selectCols = ['NULL' if renumber else ID, 'enabled', 'label',
+                      'comment', "datetime('now')"]
+        params = []
+        for label, col in columns.iteritems():
+            if label in updateColumns:
+                colStr, colParams = '?', [updateColumns[label]]
+            else:
+                colStr, colParams = col, []
+            for condition, values in conditionalColumns:
+                if label in values:
+                    whenStr, whenParams = self._getWhere(condition)
+                    colStr = 'CASE WHEN %s THEN ? ELSE %s END' % (whenStr,
+                                                                  colStr)
+                    colParams = whenParams + [values[label]] + colParams
+            selectCols.append(colStr)
+            params.extend(colParams)
+
+        if self.classId is not None:
+            if renumber:
+                raise Exception("Items can not be renumbered when inserted "
+                                "in a table shared by several classes.")
+            insertCols.append(CLASS_ID)
+            selectCols.append(str(self.classId))
+
+        self.executeCommand("INSERT INTO %sObjects (%s) SELECT %s FROM (%s) "
+                            "WHERE %s ORDER BY _source, %s"
+                            % (self.tablePrefix, ','.join(insertCols),
+                               ','.join(selectCols), selectStr,
+                               ' AND '.join('(%s)' % w for w in whereList),
+                               ID), params + whereParams)
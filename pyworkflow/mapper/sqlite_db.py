@@ -29,30 +29,232 @@ from __future__ import print_function
 This module contains some sqlite basic tools to handle Databases.
 """
 
+import os
+import threading
+from collections import OrderedDict
 from sqlite3 import dbapi2 as sqlite
 
 from pyworkflow.utils import envVarOn
 
 
+class ConnectionPool(object):
+    """ Keep track of the sqlite connections opened by SqliteDb objects.
+    A connection can be shared by several SqliteDb of the same file (e.g.
+    tables with different prefix), it is only closed when none of them
+    uses it. Shared connections that are not used are kept open for
+    reuse until more than maxSize connections are open, then the least
+    recently used ones are closed. Connections in use are never closed
+    by the pool. All methods can be used from different threads.
+    Optionally, the cache size and the memory map size (in MB) of each
+    new connection can be set.
+    A thread can also ask for private connections (see setPrivate),
+    that are neither shared nor registered in the pool.
+    """
+    MEMORY = ':memory:'
+
+    def __init__(self, maxSize=32, cacheSize=None, mmapSize=None):
+        self.maxSize = maxSize
+        self.cacheSize = cacheSize
+        self.mmapSize = mmapSize
+        self._lock = threading.RLock()
+        self._local = threading.local()
+        # Store the registered connection of each db, the order of the
+        # dict is the order of use (last used at the end)
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _connect(self, dbName, timeout):
+        connection = sqlite.Connection(dbName, timeout,
+                                       check_same_thread=False)
+        connection.row_factory = sqlite.Row
+        if self.cacheSize:  # negative values are KB instead of pages
+            connection.execute('PRAGMA cache_size=%d'
+                               % (-self.cacheSize * 1024))
+        if self.mmapSize:
+            connection.execute('PRAGMA mmap_size=%d'
+                               % (self.mmapSize * 1024 * 1024))
+        return connection
+
+    def _getFileId(self, dbName):
+        """ Identify the file, to detect when it has been replaced. """
+        try:
+            st = os.stat(dbName)
+            return st.st_dev, st.st_ino
+        except OSError:
+            return None
+
+    def acquire(self, dbName, timeout, reuse=False):
+        """ Return a connection to the database and True if it is the
+        one registered for dbName (only if reuse=True) or False if it
+        was just created.
+        """
+        if getattr(self._local, 'private', False):
+            # Not registered, so it will be closed when released
+            return self._connect(dbName, timeout), False
+
+        with self._lock:
+            entry = self._entries.get(dbName)
+
+            if entry is not None and entry['fileId'] != self._getFileId(dbName):
+                # The file was deleted or replaced, the connection should
+                # not be used to open it again. If it is still used, it
+                # will be closed when released, since it is not registered
+                del self._entries[dbName]
+                if not entry['users']:
+                    entry['connection'].close()
+                entry = None
+
+            if reuse and entry is not None:
+                self.hits += 1
+                entry['users'] += 1
+                entry['shared'] = True
+                self._entries[dbName] = self._entries.pop(dbName)
+                return entry['connection'], True
+
+            self.misses += 1
+            connection = self._connect(dbName, timeout)
+            if dbName not in self._entries:
+                self._entries[dbName] = {'connection': connection,
+                                         'users': 1,
+                                         'shared': reuse,
+                                         'timeout': timeout,
+                                         'fileId': self._getFileId(dbName)}
+                self._evict()
+            return connection, False
+
+    def setPrivate(self, private=True):
+        """ If private=True, the connections acquired from the current
+        thread are new connections not shared with other SqliteDb, e.g.
+        to read a db from a background thread while other thread is
+        using it.
+        """
+        self._local.private = private
+
+    def release(self, dbName, connection, wal=False):
+        """ Should be called when a SqliteDb does not use the connection
+        anymore. Not shared connections are closed, shared ones are kept
+        open while the pool has room for them.
+        When no SqliteDb uses the connection, its uncommitted changes are
+        discarded and, if wal=True, the WAL file is checkpointed.
+        """
+        with self._lock:
+            entry = self._entries.get(dbName)
+
+            if entry is None or entry['connection'] is not connection:
+                self._finish(connection, wal)
+                connection.close()
+                return
+
+            entry['users'] = max(0, entry['users'] - 1)
+            if entry['users'] <= 0:
+                self._finish(connection, wal, entry['timeout'])
+                if entry['shared']:
+                    self._evict()
+                else:
+                    self._close(dbName)
+
+    def _finish(self, connection, wal, timeout=0):
+        """ Discard uncommitted changes, as closing would do, an idle
+        connection should not keep the db locked. In WAL mode this
+        is also needed before the checkpoint, that would commit them.
+        """
+        connection.rollback()
+        if wal:
+            self.checkpoint(connection, timeout)
+
+    @staticmethod
+    def checkpoint(connection, timeout):
+        """ Copy the changes in the WAL file into the database and
+        truncate it, so the database file is complete by itself.
+        It does not wait for active readers, in which case the
+        checkpoint is only partial.
+        Return True if the checkpoint was completed.
+        """
+        connection.execute('PRAGMA busy_timeout=0')
+        cursor = connection.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        busy = cursor.fetchone()[0]
+        connection.execute('PRAGMA busy_timeout=%d' % (timeout * 1000))
+        return not busy
+
+    def _close(self, dbName):
+        entry = self._entries.pop(dbName)
+        entry['connection'].close()
+
+    def close(self, dbName):
+        """ Close the registered connection of this db, even if used. """
+        with self._lock:
+            if dbName in self._entries:
+                self._close(dbName)
+
+    def _evict(self):
+        """ Close not used connections, starting from the least recently
+        used ones, until the size of the pool is not exceeded.
+        """
+        # The data of in-memory databases would be lost when closing them
+        unused = [k for k, e in self._entries.iteritems()
+                  if not e['users'] and k != self.MEMORY]
+        for dbName in unused[:max(0, len(self._entries) - self.maxSize)]:
+            self._close(dbName)
+            self.evictions += 1
+
+    def clear(self):
+        """ Close all connections that are not in use. """
+        with self._lock:
+            for dbName, entry in self._entries.items():
+                if not entry['users'] and dbName != self.MEMORY:
+                    self._close(dbName)
+
+    def getStats(self):
+        """ Return a dict with the number of hits, misses, evictions and
+        connections open (and in use) in the pool. """
+        with self._lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'open': len(self._entries),
+                    'used': sum(1 for e in self._entries.itervalues()
+                                if e['users'])
+                    }
+
+
+def _envInt(varName, default=None):
+    value = os.environ.get(varName)
+    return int(value) if value else default
+
+
 class SqliteDb():
     """Class to handle a Sqlite database.
     It will create connection, execute queries and commands.
+
+    If the SCIPION_SQLITE_WAL variable is set, databases are switched to
+    Write-Ahead Logging, so readers do not block the writer (and the
+    writer does not block readers) while streaming. WAL requires shared
+    memory between processes, so it should not be used with databases
+    stored in network filesystems. The mode is kept in the file, so all
+    connections will use it once it has been enabled.
+
+    Connections are handled by a ConnectionPool, its maximum size and the
+    cache and memory map sizes (in MB) of the connections can be set with
+    the SCIPION_SQLITE_MAX_CONNECTIONS, SCIPION_SQLITE_CACHE_MB and
+    SCIPION_SQLITE_MMAP_MB variables.
     """
-    OPEN_CONNECTIONS = {} # Store all conections made
+    POOL = ConnectionPool(_envInt('SCIPION_SQLITE_MAX_CONNECTIONS', 32),
+                          _envInt('SCIPION_SQLITE_CACHE_MB'),
+                          _envInt('SCIPION_SQLITE_MMAP_MB'))
     
     def __init__(self):
         self._reuseConnections = False
+        self._wal = False
         
     def _createConnection(self, dbName, timeout):
         """Establish db connection"""
         self._dbName = dbName
-        if self._reuseConnections and dbName in self.OPEN_CONNECTIONS:
-            self.connection = self.OPEN_CONNECTIONS[dbName]
-        else:
-            self.connection = sqlite.Connection(dbName, timeout, check_same_thread=False)
-            self.connection.row_factory = sqlite.Row
-            self.OPEN_CONNECTIONS[dbName] = self.connection
-            
+        self._timeout = timeout
+        self._wal = False
+        self.connection, reused = self.POOL.acquire(dbName, timeout,
+                                                    self._reuseConnections)
         self.cursor = self.connection.cursor()
         # Define some shortcuts functions
         if envVarOn('SCIPION_DEBUG_SQLITE'):
@@ -60,21 +262,48 @@ class SqliteDb():
         else:
             self.executeCommand = self.cursor.execute
         self.commit = self.connection.commit
+
+        if envVarOn('SCIPION_SQLITE_WAL'):
+            self._enableWal(timeout, setup=not reused)
+
+    def _enableWal(self, timeout, setup=True):
+        """ Switch the journal mode to WAL and wait up to timeout
+        seconds when the database is busy.
+        """
+        if setup:
+            self.executeCommand('PRAGMA busy_timeout=%d' % (timeout * 1000))
+            self.executeCommand('PRAGMA journal_mode=WAL')
+            # Durable enough in WAL mode and avoids a sync per commit
+            self.executeCommand('PRAGMA synchronous=NORMAL')
+        self._wal = self.getJournalMode() == 'wal'
+
+    def getJournalMode(self):
+        self.executeCommand('PRAGMA journal_mode')
+        return str(self.cursor.fetchone()[0])
+
+    def checkpoint(self):
+        """ Copy the changes in the WAL file into the database, see
+        ConnectionPool.checkpoint. Return True if it was completed.
+        """
+        if not self._wal:
+            return True
+        return self.POOL.checkpoint(self.connection, self._timeout)
         
     @classmethod
     def closeConnection(cls, dbName):
-        if dbName in cls.OPEN_CONNECTIONS:
-            connection = cls.OPEN_CONNECTIONS[dbName]
-            del cls.OPEN_CONNECTIONS[dbName]
-            connection.close()
+        cls.POOL.close(dbName)
         
     def getDbName(self):
         return self._dbName
     
     def close(self):
-        self.connection.close()
-        if self._dbName in self.OPEN_CONNECTIONS:
-            del self.OPEN_CONNECTIONS[self._dbName]
+        # Finish the statements of this db before the connection can be
+        # closed by the pool from other thread
+        self.cursor.close()
+        # The pool discards uncommitted changes and does the checkpoint
+        # only when the connection is not used by other SqliteDb
+        self.POOL.release(self._dbName, self.connection, self._wal)
+        self._wal = False
         
     def _debugExecute(self, *args):
         try:
@@ -0,0 +1,540 @@
+# **************************************************************************
+# *
+# * Authors:     agent (agent@local)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Mapper for flat sets whose items are spread over several sqlite files
+(shards). The file of the set is a small JSON manifest that describes
+how the items are distributed and keeps the set properties; the shards
+are sqlite files stored next to it, that are created on demand.
+"""
+
+from __future__ import print_function
+import os
+import re
+import json
+import glob
+import heapq
+import random
+from itertools import chain
+from collections import OrderedDict
+
+import numpy as np
+
+from mapper import Mapper
+from sqlite import SqliteFlatMapper, INTERNAL_PROPERTY, ID
+from query import Comparison
+
+
+class SqliteShardedMapper(Mapper):
+    """ Flat mapper that stores the items of a set in several sqlite
+    files, each one handled by a SqliteFlatMapper. Items are assigned to
+    a shard by id range (shardSize consecutive ids per shard) or by the
+    value of an integer attribute such as the micrograph id (modulo
+    numShards), so all items of a micrograph are in the same file.
+    Selections are done in all shards and merged following the
+    requested order. Since each shard is a different file, several
+    processes can append items to different shards at the same time
+    without waiting for the lock of the others.
+    """
+    MANIFEST_EXT = '.shards'
+    VERSION = 1
+    DEFAULT_SHARD_SIZE = 1000000
+    DEFAULT_NUM_SHARDS = 16
+
+    def __init__(self, dbName, dictClasses=None, tablePrefix=''):
+        Mapper.__init__(self, dictClasses)
+        if not self.isManifest(dbName):
+            raise SqliteShardedMapperException("Invalid manifest file name: "
+                                               "%s, it should end with %s"
+                                               % (dbName, self.MANIFEST_EXT))
+        self._dbName = dbName
+        self._dictClasses = dictClasses
+        self._tablePrefix = tablePrefix
+        self._indexes = []
+        self._shards = {}  # Opened SqliteFlatMapper of each shard index
+
+        if not os.path.exists(dbName):
+            self.createManifest(dbName)
+        with open(dbName) as f:
+            manifest = json.load(f)
+        self._shardBy = manifest['shardBy']
+        self._shardSize = manifest['shardSize']
+        self._numShards = manifest['numShards']
+        self._properties = manifest['properties']
+        self._propertiesChanged = False
+        self.__findShards()
+
+    @classmethod
+    def isManifest(cls, dbName):
+        """ Return True if the file name is the one of a sharded set. """
+        return dbName.endswith(cls.MANIFEST_EXT)
+
+    @classmethod
+    def createManifest(cls, dbName, shardBy=ID, shardSize=DEFAULT_SHARD_SIZE,
+                       numShards=DEFAULT_NUM_SHARDS):
+        """ Write the manifest of an empty sharded set.
+        Params:
+            shardBy: 'id' to assign items to shards by id ranges of
+                shardSize items, or the label of an integer attribute
+                (e.g. '_micId') whose value modulo numShards gives the
+                shard of each item.
+        """
+        if shardBy != ID and numShards < 1:
+            raise SqliteShardedMapperException("Invalid number of shards: %s"
+                                               % numShards)
+        cls.__writeManifest(dbName, {'version': cls.VERSION,
+                                     'shardBy': shardBy,
+                                     'shardSize': shardSize,
+                                     'numShards': numShards,
+                                     'properties': {}})
+
+    @staticmethod
+    def __writeManifest(dbName, manifest):
+        """ Replace the manifest file at once, so it is never read
+        partially written. """
+        tmpName = dbName + '.tmp'
+        with open(tmpName, 'w') as f:
+            json.dump(manifest, f, indent=2)
+        os.rename(tmpName, dbName)
+
+    def getShardFileName(self, index):
+        """ Return the file name of the shard with this index. """
+        return '%s_shard%04d.sqlite' % (os.path.splitext(self._dbName)[0],
+                                        index)
+
+    def getShardFiles(self):
+        """ Return the list of files of the existing shards. """
+        self.__findShards()
+        return [self.getShardFileName(i) for i in sorted(self._shards)]
+
+    def getShardIndex(self, obj):
+        """ Return the index of the shard where the object is stored. """
+        if self._shardBy == ID:
+            return (obj.getObjId() - 1) // self._shardSize
+        return obj.getNestedValue(self._shardBy) % self._numShards
+
+    def __findShards(self):
+        """ Open the mappers of the shards created since the last check,
+        maybe by other processes.
+        """
+        pattern = '%s_shard*.sqlite' % os.path.splitext(self._dbName)[0]
+        for fn in glob.glob(pattern):
+            match = re.search(r'_shard(\d+)\.sqlite$', fn)
+            if match and int(match.group(1)) not in self._shards:
+                self.__getShard(int(match.group(1)))
+
+    def __getShard(self, index):
+        """ Return the mapper of the shard, the file is created
+        if it does not exist. """
+        if index not in self._shards:
+            shard = SqliteFlatMapper(self.getShardFileName(index),
+                                     self._dictClasses, self._tablePrefix)
+            shard.setIndexes(self._indexes)
+            self._shards[index] = shard
+        return self._shards[index]
+
+    def __iterShards(self, where='1'):
+        """ Iterate over the mappers of the shards in order. When items
+        are assigned by an attribute value, a where such as '_micId=3'
+        (or Attr('_micId') == 3) is only evaluated in the shard of that value.
+        """
+        self.__findShards()
+        indexes = sorted(self._shards)
+        value = None
+
+        if self._shardBy == ID:
+            pass
+        elif isinstance(where, basestring):
+            match = re.match(r'\s*%s\s*=\s*(\d+)\s*$' % re.escape(self._shardBy),
+                             where)
+            if match:
+                value = int(match.group(1))
+        elif (isinstance(where, Comparison) and where.op == '=' and
+              where.attr.label == self._shardBy and
+              isinstance(where.value, (int, long))):
+            value = where.value
+
+        if value is not None:
+            indexes = [i for i in indexes if i == value % self._numShards]
+
+        for index in indexes:
+            yield self._shards[index]
+
+    def commit(self):
+        for shard in self._shards.values():
+            shard.commit()
+        if self._propertiesChanged:
+            with open(self._dbName) as f:
+                manifest = json.load(f)
+            manifest['properties'] = self._properties
+            self.__writeManifest(self._dbName, manifest)
+            self._propertiesChanged = False
+
+    def close(self):
+        for shard in self._shards.values():
+            shard.close()
+        self._shards = {}
+
+    def setIndexes(self, labels):
+        self._indexes = list(labels)
+        for shard in self._shards.values():
+            shard.setIndexes(labels)
+
+    def insert(self, obj):
+        self.__getShard(self.getShardIndex(obj)).insert(obj)
+
+    def insertMany(self, objs, batchSize=1000):
+        """ Insert the objects using the batched insert of each shard.
+        Consecutive objects of the same shard are inserted together,
+        so sets sharded by id are written in a few batches.
+        """
+        objs = iter(objs)
+        nextObj = [next(objs, None)]
+        while nextObj[0] is not None:
+            index = self.getShardIndex(nextObj[0])
+            self.__getShard(index).insertMany(
+                self.__iterShardObjs(objs, nextObj, index),
+                batchSize=batchSize)
+
+    def __iterShardObjs(self, objs, nextObj, index):
+        """ Yield the following objects while they belong to the shard. """
+        while (nextObj[0] is not None and
+               self.getShardIndex(nextObj[0]) == index):
+            yield nextObj[0]
+            nextObj[0] = next(objs, None)
+
+    def insertFrom(self, template, sources, **kwargs):
+        raise SqliteShardedMapperException("Items can not be copied in the "
+                                           "database to a sharded set")
+
+    def enableAppend(self):
+        for shard in self.__iterShards():
+            shard.enableAppend()
+
+    def clear(self):
+        for shard in self.__iterShards():
+            shard.clear()
+        self._properties = {}
+        self._propertiesChanged = True
+
+    def deleteAll(self):
+        for shard in self.__iterShards():
+            shard.deleteAll()
+
+    def delete(self, obj):
+        self.__getShard(self.getShardIndex(obj)).delete(obj)
+
+    def updateTo(self, obj, level=1):
+        """ Update the object in its shard, the attribute used
+        to assign the shard should not be changed. """
+        self.__getShard(self.getShardIndex(obj)).updateTo(obj, level)
+
+    def selectById(self, objId):
+        if self._shardBy == ID:
+            index = (objId - 1) // self._shardSize
+            if index not in self._shards:
+                self.__findShards()
+            shard = self._shards.get(index)
+            return None if shard is None else shard.selectById(objId)
+
+        for shard in self.__iterShards():
+            obj = shard.selectById(objId)
+            if obj is not None:
+                return obj
+        return None
+
+    def selectAll(self, iterate=True, objectFilter=None, orderBy=ID,
+                  direction='ASC', where='1'):
+        iterators = [shard.selectAll(iterate=True, objectFilter=objectFilter,
+                                     orderBy=orderBy, direction=direction,
+                                     where=where)
+                     for shard in self.__iterShards(where)]
+
+        if self.__isShardsOrder(orderBy, direction):
+            objs = chain(*iterators)
+        else:
+            objs = self.__mergeObjs(iterators,
+                                    *self.__getOrderKeys(orderBy, direction))
+
+        if iterate:
+            return objs
+        return [obj.clone() for obj in objs]
+
+    def __isShardsOrder(self, orderBy, direction):
+        """ Return True if concatenating the shards gives this order. """
+        return self._shardBy == ID and orderBy == ID and direction == 'ASC'
+
+    @staticmethod
+    def __getOrderKeys(orderBy, direction, allColumns=False):
+        """ Return the columns used to sort and which ones are sorted in
+        descending order. As in SqliteFlatDb, selectAll only applies the
+        direction to the last column and to the id, that is added to sort
+        the rows with the same values, while selectPage applies it to all
+        of them.
+        """
+        orderByList = ([orderBy] if isinstance(orderBy, basestring)
+                       else list(orderBy))
+        desc = direction != 'ASC'
+        if allColumns:
+            return orderByList, [desc] * len(orderByList)
+        descending = [False] * (len(orderByList) - 1) + [desc]
+        if ID not in orderByList and 'RANDOM()' not in orderByList:
+            orderByList.append(ID)
+            descending.append(desc)
+        return orderByList, descending
+
+    @staticmethod
+    def __getKeyFunc(orderBy, descending):
+        """ Return a function to get the sort key of an object. """
+        labels = [orderBy] if isinstance(orderBy, basestring) else orderBy
+        if 'RANDOM()' in labels:
+            return lambda obj: random.random()
+
+        def _getValue(obj, label, desc):
+            if label == ID:
+                value = obj.getObjId()
+            elif label == 'enabled':
+                value = obj.isEnabled()
+            else:
+                value = obj.getNestedValue(label)
+            return _Descending(value) if desc else value
+
+        def _getKey(obj):
+            return tuple(_getValue(obj, label, desc)
+                         for label, desc in zip(labels, descending))
+
+        return _getKey
+
+    def __mergeObjs(self, iterators, orderBy, descending):
+        """ Merge the objects of the shards, each one sorted in the
+        same order. The key is taken before the next object of the
+        shard is read, since all objects of a shard are the same
+        instance. NULL values are the lowest ones, as in sqlite.
+        """
+        getKey = self.__getKeyFunc(orderBy, descending)
+
+        def _decorate(index, objs):
+            for obj in objs:
+                yield getKey(obj), index, obj
+
+        for _, _, obj in heapq.merge(*[_decorate(i, objs)
+                                       for i, objs in enumerate(iterators)]):
+            yield obj
+
+    def selectPage(self, limit, token=None, orderBy=ID, direction='ASC',
+                   where='1'):
+        """ Select a page of objects, see SqliteFlatMapper.selectPage.
+        The page of each shard is read with the same token, since it
+        only contains the values of the last object of the previous page.
+        """
+        orderByList = [orderBy] if isinstance(orderBy, basestring) else orderBy
+        orderByList = [c for c in orderByList if c != ID] + [ID]
+        pages = []
+        hasMore = False
+
+        for shard in self.__iterShards(where):
+            objs, nextToken = shard.selectPage(limit, token, orderByList,
+                                               direction, where)
+            pages.append(objs)
+            hasMore = hasMore or nextToken is not None
+
+        _, descending = self.__getOrderKeys(orderByList, direction, True)
+        objs = list(self.__mergeObjs(pages, orderByList, descending))
+        nextToken = None
+
+        if len(objs) > limit or (hasMore and len(objs) == limit):
+            objs = objs[:limit]
+            lastObj = objs[-1]
+            lastValues = [lastObj.getObjId() if c == ID else
+                          lastObj.getNestedValue(c) for c in orderByList]
+            nextToken = SqliteFlatMapper._createPageToken(orderByList,
+                                                          direction,
+                                                          lastValues)
+        return objs, nextToken
+
+    def selectColumnArrays(self, labels, orderBy=ID, direction='ASC',
+                           where='1'):
+        """ Select the values of some attributes in all shards,
+        see SqliteFlatMapper.selectColumnArrays.
+        """
+        orderByList, descending = self.__getOrderKeys(orderBy, direction)
+        allLabels = list(labels)
+        allLabels.extend(l for l in orderByList
+                         if l not in labels and l != 'RANDOM()')
+        parts = [shard.selectColumnArrays(allLabels, orderBy, direction,
+                                          where)
+                 for shard in self.__iterShards(where)]
+        # Empty shards would change the type of the arrays
+        parts = [p for p in parts if len(p[allLabels[0]])] or parts[:1]
+        arrays = OrderedDict()
+
+        for label in allLabels:
+            arrays[label] = (np.concatenate([p[label] for p in parts])
+                             if parts else np.array([]))
+
+        if len(parts) > 1 and not self.__isShardsOrder(orderBy, direction):
+            size = len(arrays[allLabels[0]])
+            if orderBy == 'RANDOM()':
+                order = np.random.permutation(size)
+            else:
+                # Stable sort by each column, from the last one,
+                # descending columns are sorted by the negated rank
+                order = np.arange(size)
+                for label, desc in reversed(zip(orderByList, descending)):
+                    keys = arrays[label][order]
+                    if desc:
+                        keys = -np.unique(keys, return_inverse=True)[1]
+                    order = order[np.argsort(keys, kind='mergesort')]
+            for label in allLabels:
+                arrays[label] = arrays[label][order]
+
+        return OrderedDict((label, arrays[label]) for label in labels)
+
+    def getColumnStats(self, label, bins=0):
+        """ Combine the statistics of each shard, which are cached
+        in each file (see SqliteFlatMapper.getColumnStats). The
+        histogram is computed with the same bins in all shards.
+        """
+        shardStats = [(shard, shard.getColumnStats(label))
+                      for shard in self.__iterShards()]
+        shardStats = [(shard, s) for shard, s in shardStats if s['count']]
+        count = sum(s['count'] for _, s in shardStats)
+        stats = {'count': count, 'min': None, 'max': None, 'mean': None,
+                 'std': None}
+
+        if count:
+            stats['min'] = min(s['min'] for _, s in shardStats)
+            stats['max'] = max(s['max'] for _, s in shardStats)
+            mean = sum(s['count'] * s['mean'] for _, s in shardStats) / count
+            meanSq = sum(s['count'] * (s['std'] ** 2 + s['mean'] ** 2)
+                         for _, s in shardStats) / count
+            stats['mean'] = mean
+            stats['std'] = float(np.sqrt(max(0., meanSq - mean * mean)))
+
+        if bins > 0:
+            histogram = np.zeros(bins, dtype=int)
+            edges = None
+            for shard, _ in shardStats:
+                s = shard.db.selectColumnStats(label, bins,
+                                               (stats['min'], stats['max']))
+                histogram += s['histogram']
+                edges = s['edges']
+            stats['histogram'] = histogram.tolist()
+            stats['edges'] = edges
+
+        return stats
+
+    def aggregate(self, operations, operationLabel, groupByLabels=None):
+        """ Compute the aggregate in each shard and combine the results.
+        Supported operations are COUNT, SUM, MIN, MAX and AVG.
+        """
+        # The names of the operations are not case sensitive in sqlite,
+        # the results are returned with the names given by the caller
+        shardOps = [op.upper() for op in operations]
+        if 'AVG' in shardOps and 'COUNT' not in shardOps:
+            shardOps.append('COUNT')
+        groupByLabels = groupByLabels or []
+        groups = {}
+
+        for shard in self.__iterShards():
+            for row in shard.aggregate(shardOps, operationLabel,
+                                       groupByLabels or None):
+                key = tuple(row[label] for label in groupByLabels)
+                groups.setdefault(key, []).append(row)
+
+        results = []
+        for key in sorted(groups):
+            rows = groups[key]
+            values = dict(zip(groupByLabels, key))
+            for op in operations:
+                values[op] = self.__combine(op.upper(), rows)
+            results.append(values)
+
+        return results
+
+    @staticmethod
+    def __combine(op, rows):
+        """ Combine the values of an aggregate operation of several shards. """
+        values = [r[op] for r in rows if r[op] is not None]
+        if op == 'COUNT':
+            return sum(values)
+        if not values:
+            return None
+        if op == 'SUM':
+            return sum(values)
+        if op == 'MIN':
+            return min(values)
+        if op == 'MAX':
+            return max(values)
+        if op == 'AVG':
+            count = sum(r['COUNT'] for r in rows if r[op] is not None)
+            return sum(r[op] * r['COUNT'] for r in rows
+                       if r[op] is not None) / float(count)
+        raise SqliteShardedMapperException("Aggregate operation '%s' is not "
+                                           "supported for sharded sets" % op)
+
+    def count(self):
+        return sum(shard.count() for shard in self.__iterShards())
+
+    def maxId(self):
+        return max([shard.maxId() or 0 for shard in self.__iterShards()] or [0])
+
+    def hasProperty(self, key):
+        return key in self._properties
+
+    def getProperty(self, key, defaultValue=None):
+        return self._properties.get(key, defaultValue)
+
+    def setProperty(self, key, value):
+        # Stored as string, as done in the Properties table
+        value = str(value) if value is not None else None
+        if self._properties.get(key) != value or key not in self._properties:
+            self._properties[key] = value
+            self._propertiesChanged = True
+
+    def deleteProperty(self, key):
+        if key in self._properties:
+            del self._properties[key]
+            self._propertiesChanged = True
+
+    def getPropertyKeys(self):
+        return [k for k in self._properties
+                if not k.startswith(INTERNAL_PROPERTY)]
+
+
+class _Descending(object):
+    """ Wrap a value of a sort key to get the reverse order. """
+    __slots__ = ['value']
+
+    def __init__(self, value):
+        self.value = value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+
+class SqliteShardedMapperException(Exception):
+    pass
@@ -29,7 +29,10 @@ The Object class is the root in the hierarchy and some other
 basic classes.
 """
 
+import sys
 from itertools import izip
+import threading
+import Queue
 from collections import OrderedDict
 import datetime as dt
 
@@ -546,8 +549,8 @@ class OrderedObject(Object):
         return False
     
     def __setattr__(self, name, value):
-        if (name not in self._attributes and
-            issubclass(value.__class__, Object) and
+        if (issubclass(value.__class__, Object) and
+            name not in self._attributes and
             not self.__attrPointed(name, value) and value._objDoStore):
             self._attributes.append(name)
         Object.__setattr__(self, name, value)
@@ -990,6 +993,11 @@ class Set(OrderedObject):
     All items will have an unique id that identifies each element in the set.
     """
     ITEM_TYPE = None # This property should be defined to know the item type
+    # Item attributes that are frequently used in where clauses
+    # and should be indexed in the underlying database
+    INDEXES = []
+    # Items passed at once from the prefetch thread (see iterItems)
+    PREFETCH_CHUNK = 100
     
     # This will be used for stream Set where data is populated on the fly
     STREAM_OPEN = 1
@@ -1043,11 +1051,158 @@ class Set(OrderedObject):
         """ element in Set """
         return self._getMapper().selectById(itemId) != None
 
-    def iterItems(self, orderBy='id', direction='ASC', where='1'):
+    def iterItems(self, orderBy='id', direction='ASC', where='1',
+                  sinceId=None, prefetch=0):
+        """ Iterate over the items of the set.
+        The where can be a string (e.g. '_micId=3') or an expression
+        built with pyworkflow.mapper.query.Attr, such as:
+        (Attr('_ctfModel._defocusU') > 20000) & Attr('_micId').isIn(ids)
+        If sinceId is not None, only items with a greater id are returned,
+        which is useful to read only the new items of a streaming set.
+        If prefetch > 0, the items are read in a background thread with
+        its own connection to the database and up to prefetch items
+        (each one a different object) are kept ready, so the time spent
+        by the caller in I/O for each item overlaps with the reading.
+        Building a new object for each item is slower than reusing the
+        same one, so it is only worth when there is I/O for each item.
+        Only items already committed to the database are read then.
+        """
+        if sinceId:
+            if not isinstance(where, basestring):
+                from pyworkflow.mapper.query import Attr
+                where = where & (Attr('id') > sinceId)
+            else:
+                sinceWhere = 'id>%d' % sinceId
+                where = sinceWhere if where == '1' else '%s AND %s' % (
+                    where, sinceWhere)
+        if prefetch > 0 and self.getFileName() != ':memory:':
+            return self._iterPrefetched(prefetch, orderBy=orderBy,
+                                        direction=direction, where=where)
         return self._getMapper().selectAll(orderBy=orderBy,
                                            direction=direction,
                                            where=where)#has flat mapper, iterate is true
 
+    def _iterPrefetched(self, prefetch, **kwargs):
+        """ Iterate over the items selected by a new mapper (with the
+        kwargs of selectAll) in a background thread. The mapper uses
+        private connections, not shared with the mappers of the calling
+        thread. The items are cloned and passed in chunks through a
+        queue of limited size.
+        """
+        from pyworkflow.mapper.sqlite_db import SqliteDb
+        chunkSize = max(1, min(self.PREFETCH_CHUNK, prefetch))
+        items = Queue.Queue(maxsize=max(1, prefetch // chunkSize))
+        stop = threading.Event()
+        fn, prefix = self._mapperPath
+        MapperClass = self._getMapperClass()
+        classesDict = self._loadClassesDict()
+
+        def _put(value):
+            # Stop waiting for room if the consumer is gone
+            while not stop.is_set():
+                try:
+                    items.put(value, timeout=0.1)
+                    return True
+                except Queue.Full:
+                    pass
+            return False
+
+        def _read():
+            mapper = None
+            try:
+                SqliteDb.POOL.setPrivate()
+                mapper = MapperClass(fn, classesDict, prefix)
+                chunk = []
+                for item in mapper.selectAll(**kwargs):
+                    chunk.append(item.clone())
+                    if len(chunk) == chunkSize:
+                        if not _put(chunk):
+                            return
+                        chunk = []
+                _put(chunk)
+                _put(None)
+            except Exception:
+                _put(sys.exc_info())
+            finally:
+                if mapper is not None:
+                    mapper.close()
+
+        thread = threading.Thread(target=_read, name='prefetch-%s' % fn)
+        thread.daemon = True
+        thread.start()
+
+        try:
+            while True:
+                chunk = items.get()
+                if chunk is None:
+                    break
+                if isinstance(chunk, tuple):  # error in the thread
+                    raise chunk[0], chunk[1], chunk[2]
+                for item in chunk:
+                    yield item
+        finally:
+            stop.set()
+            thread.join()
+
+    def getPage(self, limit, token=None, orderBy='id', direction='ASC',
+                where='1'):
+        """ Return a page of at most limit items (cloned) and the token
+        to retrieve the next page (None if this is the last one).
+        Pages are selected after the last item of the previous page,
+        so reading deep pages of big sets is as fast as the first one.
+        """
+        return self._getMapper().selectPage(limit, token, orderBy=orderBy,
+                                            direction=direction, where=where)
+
+    def readNewItems(self, lastId=0, lastCount=0):
+        """ Read the items added to a streaming set after a previous read.
+        Only the rows with id greater than lastId are fetched, unless
+        the set has more items than expected (some item was inserted
+        with a lower id), in which case all items are read again.
+        Params:
+            lastId: the greatest id of the items read previously.
+            lastCount: the number of items read previously.
+        Returns:
+            a tuple (items, allRead) where items is a list with a clone
+            of each item read and allRead is True if all items were read.
+        """
+        items = [item.clone() for item in self.iterItems(sinceId=lastId)]
+        # Count after the select, so rows inserted in between (with any id)
+        # are detected and will be read in the full read
+        if lastCount + len(items) < self._getMapper().count():
+            return [item.clone() for item in self.iterItems()], True
+        return items, False
+
+    def getColumnArrays(self, labels, orderBy='id', direction='ASC',
+                        where='1'):
+        """ Return the values of some item attributes as numpy arrays.
+        No item object is created, which makes this much faster than
+        iterating the set when only a few attributes are needed.
+        Params:
+            labels: list of attribute names, e.g. ['_micId',
+                '_ctfModel._defocusU'], 'id' and 'enabled' are also valid.
+        Returns:
+            an OrderedDict with the array of each label.
+        """
+        return self._getMapper().selectColumnArrays(labels, orderBy=orderBy,
+                                                    direction=direction,
+                                                    where=where)
+
+    def getColumnStats(self, label, bins=0):
+        """ Return the statistics of the values of an item attribute
+        computed in the database, without iterating the items.
+        The result is cached in the set file until items are added,
+        deleted or updated, so repeated calls are very fast.
+        Params:
+            label: attribute name, e.g. '_ctfModel._defocusU'.
+            bins: if greater than 0, also compute a histogram.
+        Returns:
+            a dict with the 'count' of not null values, 'min', 'max',
+            'mean' and 'std', and also 'histogram' (list of counts)
+            and 'edges' (bins + 1 values) if bins > 0.
+        """
+        return self._getMapper().getColumnStats(label, bins)
+
     def getFirstItem(self):
         """ Return the first item in the Set. """
         # This function is used in many contexts where the mapper can be
@@ -1107,12 +1262,50 @@ class Set(OrderedObject):
         """ Set the dictionary with classes where to look for classes names. """
         self._classesDict = classesDict
     
+    def _getMapperClass(self):
+        """ Return the class of the mapper used to load the set.
+        Flat sets whose file is a shards manifest are stored in
+        several sqlite files (see SqliteShardedMapper) and the ones
+        with an up to date snapshot are read from it (see SnapshotMapper).
+        """
+        from pyworkflow.mapper.sqlite import SqliteFlatMapper
+        from pyworkflow.mapper.sqlite_shards import SqliteShardedMapper
+        from pyworkflow.mapper.snapshot import SnapshotMapper
+        fn = self.getFileName()
+        if self._MapperClass is SqliteFlatMapper and fn:
+            if SqliteShardedMapper.isManifest(fn):
+                return SqliteShardedMapper
+            if (not (self.getPrefix() or '').strip() and
+                    SnapshotMapper.hasSnapshot(fn)):
+                return SnapshotMapper
+        return self._MapperClass
+
+    def exportSnapshot(self):
+        """ Export the items to a read-only columnar snapshot, which is
+        used instead of the sqlite file the next time the set is loaded,
+        until the set is modified. Only for flat sets that are not
+        going to change, e.g. after the stream has been closed.
+        """
+        from pyworkflow.mapper.snapshot import SnapshotMapper
+        if self.isStreamOpen():
+            raise Exception("Set.exportSnapshot: the stream of the set "
+                            "is still open.")
+        if not self._isFlat() or (self.getPrefix() or '').strip():
+            raise Exception("Set.exportSnapshot: only flat sets can be "
+                            "exported.")
+        self.write()
+        self.close()
+        SnapshotMapper.exportSnapshot(self.getFileName(),
+                                      self._loadClassesDict())
+
     def load(self):
         """ Load extra data from files. """
         if self._mapperPath.isEmpty():
             raise Exception("Set.load:  mapper path and prefix not set.")
         fn, prefix = self._mapperPath
-        self._mapper = self._MapperClass(fn, self._loadClassesDict(), prefix)            
+        MapperClass = self._getMapperClass()
+        self._mapper = MapperClass(fn, self._loadClassesDict(), prefix)
+        self._mapper.setIndexes(self.INDEXES)
         self._size.set(self._mapper.count())
         self._idCount = self._mapper.maxId()
            
@@ -1143,14 +1336,165 @@ class Set(OrderedObject):
         #
         # Anyway, this can be easily changed by updating
         # both from the underlying sqlite when reading a set.
+        self._prepareItem(item)
+        self._insertItem(item)
+        self._size.increment()
+
+    def appendMany(self, items, batchSize=1000):
+        """ Add several items to the set at once.
+        Ids are assigned in the same way as in append, but the
+        items are written to the database in batches of batchSize
+        rows. The items iterator can reuse the same object
+        instance, since each item is stored before getting the next.
+        """
+        self._getMapper().insertMany(self._iterPreparedItems(items),
+                                     batchSize=batchSize)
+
+    def _iterPreparedItems(self, items):
+        """ Prepare each item before yielding it for insertion
+        and update the size once it has been consumed.
+        """
+        for item in items:
+            self._prepareItem(item)
+            yield item
+            self._size.increment()
+
+    def appendFromSets(self, sets, template=None, subset=None,
+                       difference=False, renumber=False):
+        """ Add all the items of other sets (in order) performing the
+        operation directly in the database, which is much faster than
+        iterating and appending the items one by one.
+        Params:
+            sets: list of sets whose items will be added.
+            template: item with the attributes to store, by default the
+                first item of the sets. Attributes of the input items
+                that are not in the template are not copied.
+            subset: if not None, only the items whose id is also in this
+                set (or is not, if difference=True) are added.
+            renumber: if True, new ids are assigned to the added items.
+        The values set by _prepareItem are also set in the added items
+        (see _getPreparedColumns). Changes are committed.
+        """
+        for s in sets:
+            if template is not None:
+                break
+            template = s.getFirstItem()
+
+        if template is None:  # nothing to add from empty sets
+            return
+
+        sources = [(s.getFileName(), s.getPrefix() or '') for s in sets]
+        if subset is not None:
+            subset = (subset.getFileName(), subset.getPrefix() or '')
+
+        mapper = self._getMapper()
+        mapper.insertFrom(template, sources, subset=subset,
+                          difference=difference, renumber=renumber,
+                          conditionalColumns=self._getPreparedColumns())
+        self._size.set(mapper.count())
+        self._idCount = mapper.maxId()
+
+    def _isFlat(self):
+        """ Return True if the items are stored in a single sqlite
+        table, so they can be copied directly in the database.
+        """
+        from pyworkflow.mapper.sqlite import SqliteFlatMapper
+        from pyworkflow.mapper.snapshot import SnapshotMapper
+        if not self.getFileName():
+            return False
+        MapperClass = self._getMapperClass()
+        return (issubclass(MapperClass, SqliteFlatMapper) or
+                MapperClass is SnapshotMapper)
 
+    def copyItemsFrom(self, other, where='1', updateColumns=None,
+                      updateItemCallback=None, itemDataIterator=None,
+                      copyDisabled=False):
+        """ Copy the items of other set, optionally only the ones matching
+        the where condition and setting some attributes to a constant value.
+        If both sets are flat and no updateItemCallback is passed, the copy
+        is done with a single INSERT ... SELECT and no item is built, the
+        values set by _prepareItem are set in the copied rows (see
+        _getPreparedColumns). Otherwise, each item is cloned and appended
+        as in copyItems.
+        Params:
+            where: condition on the attribute labels of the items.
+            updateColumns: dict with attribute labels (e.g. '_micId' or
+                '_ctfModel._defocusU') and the value for all copied items.
+            updateItemCallback, itemDataIterator: as in copyItems, if
+                passed, the items are copied one by one.
+            copyDisabled: if False, only enabled items are copied.
+        """
+        updateColumns = updateColumns or {}
+
+        if (updateItemCallback is None and self._isFlat() and
+                other._isFlat()):
+            firstItem = other.getFirstItem()
+            if firstItem is None:
+                return
+            template = firstItem.clone()
+            for label, value in updateColumns.iteritems():
+                template.setAttributeValue(label, value)
+            # Use the values as they are stored by the mapper
+            objDict = template.getObjDict()
+            updateValues = dict((label, objDict[label])
+                                for label in updateColumns)
+            mapper = self._getMapper()
+            mapper.insertFrom(template, [(other.getFileName(),
+                                          other.getPrefix() or '')],
+                              where=where, updateColumns=updateValues,
+                              copyDisabled=copyDisabled,
+                              conditionalColumns=self._getPreparedColumns())
+            self._size.set(mapper.count())
+            self._idCount = mapper.maxId()
+            return
+
+        self._appendClones(other.iterItems(where=where), updateColumns,
+                           updateItemCallback, itemDataIterator, copyDisabled)
+
+    def _appendClones(self, items, updateColumns=None,
+                      updateItemCallback=None, itemDataIterator=None,
+                      copyDisabled=False):
+        """ Append a clone of each item, used when the items can not be
+        copied in the database (see copyItemsFrom and copyItems).
+        """
+        updateColumns = updateColumns or {}
+
+        for item in items:
+            # copy items if enabled or copyDisabled=True
+            if copyDisabled or item.isEnabled():
+                newItem = item.clone()
+                for label, value in updateColumns.iteritems():
+                    newItem.setAttributeValue(label, value)
+                if updateItemCallback:
+                    row = None if itemDataIterator is None \
+                        else next(itemDataIterator)
+                    updateItemCallback(newItem, row)
+                # If updateCallBack function returns attribute
+                # _appendItem to False do not append the item
+                if getattr(newItem, "_appendItem", True):
+                    self.append(newItem)
+            elif itemDataIterator is not None:
+                next(itemDataIterator)  # just skip disabled data row
+
+    def _getPreparedColumns(self):
+        """ Return the values that _prepareItem sets in the items, so they
+        are also set in the items copied in the database (see
+        copyItemsFrom and appendFromSets). It is a list of (where, values)
+        with a condition on the items and a dict with the values (as
+        stored) by attribute label of the items matching it.
+        """
+        return []
+
+    def _prepareItem(self, item):
+        """ Set the id of an item that is going to be inserted.
+        If the item has already an id, use it.
+        If not, keep a counter with the max id and assign the next one.
+        """
         if not item.hasObjId():
             self._idCount += 1
             item.setObjId(self._idCount)
         else:
             self._idCount = max(self._idCount, item.getObjId()) + 1
-        self._insertItem(item)
-        self._size.increment()
 
     def _insertItem(self, item):
         self._getMapper().insert(item)
@@ -1215,9 +1559,17 @@ class Set(OrderedObject):
         return s
     
     def getFiles(self):
+        from pyworkflow.mapper.sqlite_shards import SqliteShardedMapper
+        from pyworkflow.mapper.snapshot import SnapshotMapper
         files = set()
-        if self.getFileName():
-            files.add(self.getFileName())
+        fn = self.getFileName()
+        if fn:
+            files.add(fn)
+            MapperClass = self._getMapperClass()
+            if MapperClass is SqliteShardedMapper:
+                files.update(self._getMapper().getShardFiles())
+            elif MapperClass is SnapshotMapper:
+                files.update(SnapshotMapper.getSnapshotFiles(fn))
         return files
     
     def getStreamState(self):
@@ -88,6 +88,9 @@ class Project(object):
         self.settingsPath = self.__addPath(PROJECT_SETTINGS)
         self.configPath = self.__addPath(PROJECT_CONFIG)
         self.runs = None
+        # Mapper used to load the runs and keys of their summaries
+        self._runsMapper = None
+        self._runsKeys = {}
         self._runsGraph = None
         self._transformGraph = None
         self._sourceGraph = None
@@ -455,7 +458,7 @@ class Project(object):
 
             # NOTE: now we are simply copying the entire project db, this can be
             # changed later to only create a subset of the db need for the run
-            pwutils.path.copyFile(self.dbPath, protocol.getDbPath())
+            self._copyProtocolDb(protocol)
 
         # Launch the protocol, the jobId should be set after this call
         pwprot.launch(protocol, wait)
@@ -478,6 +481,10 @@ class Project(object):
         isRestart = protocol.getRunMode() == MODE_RESTART
 
         protocol.setStatus(pwprot.STATUS_SCHEDULED)
+        # The run has no process until the scheduler launches it,
+        # clear the ones of previous executions
+        protocol.setPid(None)
+        protocol.setJobId(None)
         protocol.addPrerequisites(*prerequisites)
 
         self._setupProtocol(protocol)
@@ -490,12 +497,23 @@ class Project(object):
         # Prepare a separate db for this run
         # NOTE: now we are simply copying the entire project db, this can be
         # changed later to only create a subset of the db need for the run
-        pwutils.path.copyFile(self.dbPath, protocol.getDbPath())
-        # Launch the protocol, the jobId should be set after this call
+        self._copyProtocolDb(protocol)
+        # Add the protocol to the requests of the project scheduler
         pwprot.schedule(protocol)
         self.mapper.store(protocol)
         self.mapper.commit()
 
+    def _copyProtocolDb(self, protocol):
+        """ Create the run.db of the protocol as a copy of the project db.
+        The revisions of the new run.db are not related to the ones of the
+        previous run.db, so the next update will load the whole protocol.
+        """
+        protocol.lastUpdateRevision.set(0)
+        if protocol.lastUpdateRevision.hasObjId():
+            self.mapper.store(protocol.lastUpdateRevision)
+        self.mapper.commit()
+        pwutils.path.copyFile(self.dbPath, protocol.getDbPath())
+
     def _updateProtocol(self, protocol, tries=0, checkPid=False,
                         skipUpdatedProtocols=True):
 
@@ -518,6 +536,27 @@ class Project(object):
             lastUpdateTime = pwutils.getFileLastModificationDate(
                                                         protocol.getDbPath())
 
+            # Try first to copy only the attributes that have changed
+            # since the last update, the revision is read before so
+            # changes done while loading will be copied next time
+            runMapper = self.createMapper(protocol.getDbPath())
+            try:
+                revision = runMapper.getRevision()
+                updated = self._updateProtocolChanges(protocol, runMapper,
+                                                      revision)
+            finally:
+                runMapper.close()
+
+            if updated:
+                if checkPid:
+                    self.checkPid(protocol)
+                protocol.lastUpdateRevision.set(revision)
+                protocol.lastUpdateTimeStamp.set(lastUpdateTime)
+                for attr in [protocol.status, protocol.lastUpdateRevision,
+                             protocol.lastUpdateTimeStamp]:
+                    self.mapper.store(attr)
+                return
+
             # If the protocol database has ....
             #  Comparing date will not work unless we have a reliable
             # lastModificationDate of a protocol in the project.sqlite
@@ -542,6 +581,7 @@ class Project(object):
             # possible inconsistencies
             # protocol.lastUpdateTimeStamp.set(datetime.datetime.now())
             protocol.lastUpdateTimeStamp.set(lastUpdateTime)
+            protocol.lastUpdateRevision.set(revision)
 
             self.mapper.store(protocol)
 
@@ -563,6 +603,40 @@ class Project(object):
                 time.sleep(0.5)
                 self._updateProtocol(protocol, tries + 1)
 
+    def _updateProtocolChanges(self, protocol, runMapper, revision):
+        """ Copy to the protocol only the attributes changed in its run.db
+        since the last update, using the log of changes of the run.db.
+        Return False if the changes are not known or can not be applied
+        this way (e.g. outputs were added), so the whole protocol should
+        be loaded.
+        """
+        lastRevision = protocol.lastUpdateRevision.get()
+
+        if not lastRevision or revision < lastRevision:
+            return False
+
+        if revision == lastRevision:
+            return True  # Nothing changed
+
+        names = runMapper.selectChanges(lastRevision)
+
+        if names is None or '' in names:
+            return False
+
+        changes = []
+        for name in set(names):
+            attr = getattr(protocol, name, None)
+            objs = runMapper.selectBy(name='%s.%s' % (protocol.strId(), name))
+            if attr is None or len(objs) != 1:
+                return False
+            changes.append((attr, objs[0]))
+
+        for attr, obj in changes:
+            attr.copy(obj, copyId=False)
+            self.mapper.store(attr)
+
+        return True
+
     def stopProtocol(self, protocol):
         """ Stop a running protocol """
         try:
@@ -671,7 +745,7 @@ class Project(object):
             raise Exception(error)
         else:
             protocol.deleteOutput(output)
-            pwutils.path.copyFile(self.dbPath, protocol.getDbPath())
+            self._copyProtocolDb(protocol)
 
     def __setProtocolLabel(self, newProt):
         """ Set a readable label to a newly created protocol.
@@ -1046,40 +1120,114 @@ class Project(object):
             self._storeProtocol(protocol)
 
     def getRuns(self, iterate=False, refresh=True, checkPids=False):
-        """ Return the existing protocol runs in the project. 
+        """ Return the existing protocol runs in the project.
+        The first load builds all the runs. On later refreshes, the
+        summaries of the runs (see getRunsSummary) are compared with the
+        ones of the previous refresh, so only the runs that changed in
+        the project db are built again.
         """
         if self.runs is None or refresh:
-            # Close db open connections to db files
-            if self.runs is not None:
-                for r in self.runs:
-                    r.closeMappers()
+            summaries = self.getRunsSummary()
+
+            if self.runs is None or self._runsMapper is not self.mapper:
+                # Use new selectAll Batch
+                # self.runs = self.mapper.selectAll(iterate=False,
+                #               objectFilter=lambda o: isinstance(o, pwprot.Protocol))
+                runs = self.mapper.selectAllBatch(objectFilter=lambda o: isinstance(o, pwprot.Protocol))
+                runsDict = dict((r.getObjId(), r) for r in runs)
+                changedIds = set(runsDict)
+                self._runsMapper = self.mapper
+            else:
+                runsDict, changedIds = self._reloadChangedRuns(summaries)
 
-            # Use new selectAll Batch
-            # self.runs = self.mapper.selectAll(iterate=False,
-            #               objectFilter=lambda o: isinstance(o, pwprot.Protocol))
-            self.runs = self.mapper.selectAllBatch(objectFilter=lambda o: isinstance(o, pwprot.Protocol))
+            self.runs = [runsDict[s.getObjId()] for s in summaries
+                         if s.getObjId() in runsDict]
+            updated = False
 
             for r in self.runs:
 
-                self._setProtocolMapper(r)
+                if r.getObjId() in changedIds:
+                    self._setProtocolMapper(r)
 
-                # Check for run warnings
-                r.checkSummaryWarnings()
+                    # Check for run warnings
+                    r.checkSummaryWarnings()
 
                 # Update nodes that are running and were not invoked
                 # by other protocols
                 if r.isActive():
                     if not r.isChild():
                         self._updateProtocol(r, checkPid=checkPids)
+                        updated = True
 
                 self._annotateLastRunTime(r.endTime)
 
             # cursor = self.mapper.db.executeCommand('SELECT * FROM Objects WHERE parent_Id IS NOT NULL ORDER BY parent_id, name')
 
             self.mapper.commit()
+            # Updated runs are stored in the project db, so the
+            # summaries are read again to not build them next time
+            if updated:
+                summaries = self.getRunsSummary()
+            self._runsKeys = dict((s.getObjId(), s.getRowsKey())
+                                  for s in summaries)
 
         return self.runs
 
+    def _reloadChangedRuns(self, summaries):
+        """ Build again the runs whose summary changed since the last
+        refresh, and the runs using them (or their outputs) as input, so
+        their pointers do not reference the previous objects. The other
+        runs are kept. Return a dict with the run of each id and the
+        set of ids of the runs built again.
+        """
+        oldRuns = dict((r.getObjId(), r) for r in self.runs)
+        changedIds = set(s.getObjId() for s in summaries
+                         if s.getObjId() not in oldRuns or
+                         self._runsKeys.get(s.getObjId()) != s.getRowsKey())
+
+        while True:
+            # Ids of the changed runs and their outputs
+            changedObjIds = set(changedIds)
+            for s in summaries:
+                if s.getObjId() in changedIds:
+                    changedObjIds.update(objId for _, objId, _
+                                         in s.iterOutputs())
+            usingIds = set(s.getObjId() for s in summaries
+                           if any(pointedId in changedObjIds
+                                  for _, pointedId, _ in s.iterInputs()))
+            if usingIds <= changedIds:
+                break
+            changedIds.update(usingIds)
+
+        runsDict = {}
+        for s in summaries:
+            runId = s.getObjId()
+            if runId in changedIds:
+                run = self.mapper.selectById(runId, reload=True)
+                if isinstance(run, pwprot.Protocol):
+                    runsDict[runId] = run
+            else:
+                runsDict[runId] = oldRuns[runId]
+
+        # Close db open connections of the runs not used anymore
+        for runId, r in oldRuns.iteritems():
+            if runsDict.get(runId) is not r:
+                r.closeMappers()
+
+        return runsDict, changedIds
+
+    def getRunsSummary(self):
+        """ Return a RunSummary for each protocol run in the project.
+        Only the project database is read and no Protocol is built,
+        so it is used by getRuns to cheaply detect which runs changed.
+        Status of active runs is the one stored in the project, it is
+        not updated from their run.db.
+        """
+        # Depth 3 reaches the extended of pointers inside a PointerList
+        runRows, childRows = self.mapper.selectRowsByClass('Protocol',
+                                                           depth=3)
+        return [RunSummary(row, childRows) for row in runRows]
+
     def _annotateLastRunTime(self, protLastTS):
         """ Sets _lastRunTime for the project if it is after current _lastRunTime"""
         try:
@@ -1401,3 +1549,124 @@ class Project(object):
 
 class MissingProjectDbException(Exception):
     pass
+
+
+class RunSummary(object):
+    """ Basic information of a protocol run read from the project
+    database rows, without building the Protocol object (with all
+    its parameters and outputs). It is mainly used to detect the
+    runs that changed in the project db; use Project.getProtocol to
+    get the full protocol when it is needed.
+    """
+    def __init__(self, objRow, childRows):
+        self._objRow = objRow
+        self._childRows = childRows
+        # Direct attributes of the run, the stored name is prefixed
+        # with the names of its parents
+        self._attrRows = OrderedDict((row['name'].split('.')[-1], row)
+                                     for row in childRows.get(objRow['id'],
+                                                              []))
+
+    def getObjId(self):
+        return self._objRow['id']
+
+    def strId(self):
+        return str(self.getObjId())
+
+    def getClassName(self):
+        return self._objRow['classname']
+
+    def getObjLabel(self):
+        return self._objRow['label'] or ''
+
+    def getObjComment(self):
+        return self._objRow['comment'] or ''
+
+    def getObjCreation(self):
+        return self._objRow['creation']
+
+    def getRunName(self):
+        runName = self.getObjLabel().strip()
+        if not len(runName):
+            runName = '%s.%s' % (self.getClassName(), self.strId())
+        return runName
+
+    def isChild(self):
+        """ Return true if the run was invoked from another protocol. """
+        return self._objRow['parent_id'] is not None
+
+    def getAttributeValue(self, attrName, defaultValue=None):
+        """ Return the stored value (as string) of a direct attribute. """
+        row = self._attrRows.get(attrName)
+        if row is None or row['value'] is None:
+            return defaultValue
+        return row['value']
+
+    def getStatus(self):
+        return self.getAttributeValue('status', pwprot.STATUS_NEW)
+
+    def isActive(self):
+        return self.getStatus() in pwprot.ACTIVE_STATUS
+
+    def getInitTime(self):
+        return self.getAttributeValue('initTime')
+
+    def getEndTime(self):
+        return self.getAttributeValue('endTime')
+
+    def getJobId(self):
+        return self.getAttributeValue('_jobId')
+
+    def getPid(self):
+        pid = self.getAttributeValue('_pid')
+        return None if pid is None else int(pid)
+
+    def __getPointer(self, row):
+        """ Return the pointed id and extended of a pointer row. """
+        extended = None
+        for childRow in self._childRows.get(row['id'], []):
+            if childRow['name'].endswith('._extended'):
+                extended = childRow['value']
+        pointedId = None if row['value'] is None else int(row['value'])
+        return pointedId, extended
+
+    def iterInputs(self):
+        """ Iterate over the input pointers of the run, yielding
+        (attrName, pointedId, extended) tuples, as iterInputAttributes
+        of the protocol does, pointers without value are skipped. The
+        pointers inside a PointerList are returned with the list name.
+        """
+        for attrName, row in self._attrRows.iteritems():
+            if row['classname'] == 'Pointer':
+                pointers = [row]
+            elif row['classname'] == 'PointerList':
+                pointers = self._childRows.get(row['id'], [])
+            else:
+                continue
+            for pointerRow in pointers:
+                pointedId, extended = self.__getPointer(pointerRow)
+                if pointedId is not None:
+                    yield attrName, pointedId, extended
+
+    def getRowsKey(self):
+        """ Return a tuple with the stored values of the run and its
+        attributes (up to the depth read), it changes when the run is
+        stored with different values. """
+        key = []
+        rows = [self._objRow]
+        while rows:
+            row = rows.pop()
+            key.append((row['id'], row['name'], row['classname'],
+                        row['value'], row['label'], row['comment']))
+            rows.extend(self._childRows.get(row['id'], []))
+        return tuple(key)
+
+    def iterOutputs(self):
+        """ Iterate over the outputs of the run, yielding
+        (attrName, objId, className) tuples.
+        """
+        outputs = self.getAttributeValue('_outputs')
+        for attrName in outputs.split(',') if outputs else []:
+            row = self._attrRows.get(attrName)
+            if row is not None:
+                yield attrName, row['id'], row['classname']
@@ -34,16 +34,98 @@ import time
 import datetime
 import traceback
 import threading
+from collections import deque
 
 import pyworkflow.utils.process as process
 import constants as cts
 
 
+class StepsGraph():
+    """ Keep the dependencies between steps to know which ones are
+    ready to run, without scanning the whole list of steps each time.
+    The number of unfinished prerequisites of each step is computed
+    once, and steps are queued as ready when the last of them finishes.
+    """
+    def __init__(self, steps):
+        self.update(steps)
+
+    def update(self, steps):
+        """ Rebuild the graph from the steps list. This should be called
+        when steps are added or their status is changed from outside
+        the executor (e.g. in the steps check callback of streaming).
+        """
+        self._steps = steps
+        self._size = len(steps)
+        self._indexes = {}  # map each step object to its position
+        self._dependents = {}  # unfinished step -> steps depending on it
+        self._missing = {}  # step -> number of unfinished prerequisites
+        self._ready = deque()
+        self._running = set()
+        self._waiting = 0
+
+        for i, step in enumerate(steps):
+            self._indexes[id(step)] = i
+            if step.isFinished():
+                continue
+            if step.isRunning():
+                self._running.add(i)
+            elif step.isWaiting():
+                self._waiting += 1
+            missing = 0
+            for p in step._prerequisites:
+                p = int(p) - 1
+                if not steps[p].isFinished():
+                    self._dependents.setdefault(p, []).append(i)
+                    missing += 1
+            self._missing[i] = missing
+            if missing == 0 and step.getStatus() == cts.STATUS_NEW:
+                self._ready.append(i)
+
+    def isOutdated(self, steps):
+        """ Return True if new steps were added after the last update. """
+        return steps is not self._steps or len(steps) != self._size
+
+    def getReady(self, n=1):
+        """ Return up to n steps that are ready to run.
+        They will be considered running after this call.
+        """
+        rs = []
+
+        while self._ready and len(rs) < n:
+            i = self._ready.popleft()
+            step = self._steps[i]
+            # The status could have changed since it was queued
+            if step.getStatus() == cts.STATUS_NEW:
+                self._running.add(i)
+                rs.append(step)
+        return rs
+
+    def setDone(self, step):
+        """ Register that a step is not running anymore.
+        If it has finished, the steps depending on it that have
+        no other unfinished prerequisites will be ready to run.
+        """
+        i = self._indexes[id(step)]
+        self._running.discard(i)
+
+        if step.isFinished():
+            for d in self._dependents.pop(i, []):
+                self._missing[d] -= 1
+                if (self._missing[d] == 0 and
+                        self._steps[d].getStatus() == cts.STATUS_NEW):
+                    self._ready.append(d)
+
+    def hasPending(self):
+        """ Return True if there are steps running or waiting. """
+        return bool(self._running) or self._waiting > 0
+
+
 class StepExecutor():
     """ Run a list of Protocol steps. """
     def __init__(self, hostConfig, **kwargs):
         self.hostConfig = hostConfig
         self.gpuList = kwargs.get(cts.GPU_LIST, None)
+        self._graph = None
 
     def getGpuList(self):
         """ Return the GPU list assigned to current thread. """
@@ -60,26 +142,41 @@ class StepExecutor():
                        self.hostConfig,
                        env=env, cwd=cwd, gpuList=self.getGpuList())
         
+    def _getGraph(self, steps):
+        """ Return the steps graph, rebuilding it if new steps were added. """
+        if self._graph is None or self._graph.isOutdated(steps):
+            self._graph = StepsGraph(steps)
+        return self._graph
+
     def _getRunnable(self, steps, n=1):
         """ Return the n steps that are 'new' and all its
         dependencies have been finished, or None if none ready.
         """
-        rs = [] # return a list of runnable steps
+        return self._getGraph(steps).getReady(n)
+
+    def _stepDone(self, steps, step):
+        """ Notify that a step is not running anymore. """
+        self._getGraph(steps).setDone(step)
 
-        for s in steps:
-            if (s.getStatus() == cts.STATUS_NEW and
-                    all(steps[i-1].isFinished() for i in s._prerequisites)):
-                rs.append(s)
-                if len(rs) == n:
-                    break
-        return rs
-    
     def _arePending(self, steps):
         """ Return True if there are pending steps (either running or waiting)
         that can be done and thus enable other steps to be executed.
         """
-        return any(s.isRunning() or s.isWaiting() for s in steps)
-    
+        return self._getGraph(steps).hasPending()
+
+    def _checkSteps(self, steps, stepsCheckCallback):
+        """ Call stepsCheckCallback and update the steps graph, since
+        new steps could be added or waiting steps could be released.
+        """
+        stepsCheckCallback()
+        self._getGraph(steps).update(steps)
+
+    @staticmethod
+    def _getCheckTimeout(lastCheck, delta):
+        """ Return the seconds until the next steps check. """
+        timeout = lastCheck + delta - datetime.datetime.now()
+        return max(timeout.total_seconds(), 0)
+
     def runSteps(self, steps, 
                  stepStartedCallback, 
                  stepFinishedCallback,
@@ -92,6 +189,7 @@ class StepExecutor():
 
         delta = datetime.timedelta(seconds=stepsCheckSecs)
         lastCheck = datetime.datetime.now()
+        self._graph = StepsGraph(steps)
 
         while True:
             # Get an step to run, if there is one
@@ -104,6 +202,7 @@ class StepExecutor():
                 step.setRunning()
                 stepStartedCallback(step)
                 step.run()
+                self._stepDone(steps, step)
                 doContinue = stepFinishedCallback(step)
             
                 if not doContinue:
@@ -111,9 +210,12 @@ class StepExecutor():
 
             elif self._arePending(steps):
                 # We have not found any runnable step, but still there
-                # there are some running or waiting for dependencies
-                # So, let's wait a bit to check if something changes
-                time.sleep(0.5)
+                # are some waiting, only the steps check can change that,
+                # so let's wait until it is time to check again
+                time.sleep(self._getCheckTimeout(lastCheck, delta))
+                self._checkSteps(steps, stepsCheckCallback)
+                lastCheck = datetime.datetime.now()
+                continue
             else:
                 # No steps to run, neither running or waiting
                 # So, we are done, either failed or finished :)
@@ -121,7 +223,7 @@ class StepExecutor():
 
             now = datetime.datetime.now()
             if now - lastCheck > delta:
-                stepsCheckCallback()
+                self._checkSteps(steps, stepsCheckCallback)
                 lastCheck = now
 
 
@@ -129,7 +231,10 @@ class StepExecutor():
 
 
 class StepThread(threading.Thread):
-    """ Thread to run Steps in parallel. """
+    """ Thread to run Steps in parallel.
+    The lock should be a threading.Condition that will be
+    notified when the step is done.
+    """
     def __init__(self, thId, step, lock):
         threading.Thread.__init__(self)
         self.thId = thId
@@ -150,6 +255,7 @@ class StepThread(threading.Thread):
                 else:
                     self.step.setFailed(error)
                 self.step.endTime.set(datetime.datetime.now())
+                self.lock.notify()
 
 
 class ThreadStepExecutor(StepExecutor):
@@ -196,17 +302,24 @@ class ThreadStepExecutor(StepExecutor):
         delta = datetime.timedelta(seconds=stepsCheckSecs)
         lastCheck = datetime.datetime.now()
 
-        sharedLock = threading.Lock()
+        # Threads will notify through this condition when a step is done
+        sharedLock = threading.Condition()
+        self._graph = StepsGraph(steps)
 
         runningSteps = {}  # currently running step in each node ({node: step})
         freeNodes = range(self.numberOfProcs)  # available nodes to send jobs
 
+        def _anyFinished():
+            return any(not step.isRunning() for step in runningSteps.values())
+
         while True:
             # See which of the runningSteps are not really running anymore.
             # Update them and freeNodes, and call final callback for step.
             with sharedLock:
                 nodesFinished = [node for node, step in runningSteps.iteritems()
                                  if not step.isRunning()]
+                for node in nodesFinished:
+                    self._stepDone(steps, runningSteps[node])
             doContinue = True
             for node in nodesFinished:
                 step = runningSteps.pop(node)  # remove entry from runningSteps
@@ -239,15 +352,19 @@ class ThreadStepExecutor(StepExecutor):
                         t.start()
                 anyPending = self._arePending(steps)
 
-            if not anyLaunched:
-                if anyPending:  # nothing running
-                    time.sleep(0.5)
-                else:
-                    break  # yeah, we are done, either failed or finished :)
+                if not anyLaunched and anyPending and not _anyFinished():
+                    # Sleep until a thread notifies that a step is done
+                    # or it is time to check the steps again
+                    sharedLock.wait(self._getCheckTimeout(lastCheck, delta))
+
+            if not anyLaunched and not anyPending:
+                break  # yeah, we are done, either failed or finished :)
 
             now = datetime.datetime.now()
             if now - lastCheck > delta:
                 stepsCheckCallback()
+                with sharedLock:
+                    self._graph.update(steps)
                 lastCheck = now
 
         stepsCheckCallback()
@@ -41,14 +41,22 @@ B. Remote execution:
 """
 import os
 import re
+import json
+from glob import glob
 from subprocess import Popen, PIPE
 import pyworkflow as pw
-from pyworkflow.utils import (redStr, greenStr, makeFilePath, join, process,
-                              getHostFullName)
+from pyworkflow.utils import (redStr, greenStr, makeFilePath, makePath, join,
+                              process, getHostFullName)
 
 UNKNOWN_JOBID = -1
 LOCALHOST = 'localhost'
 
+# Files used by the project scheduler (see apps/pw_schedule_run.py)
+SCHEDULER_PATH = os.path.join('Logs', 'scheduler')
+SCHEDULER_PID = 'scheduler.pid'
+SCHEDULER_LOCK = 'scheduler.lock'
+SCHEDULER_QUEUE = 'queue'
+
 
 # ******************************************************************
 # *         Public functions provided by the module
@@ -80,20 +88,79 @@ def stop(protocol):
 def schedule(protocol, wait=False):
     """ Use this function to schedule protocols that are not ready to
     run yet. Right now it only make sense to schedule jobs locally.
+    The protocol is added to the requests queue of the project and
+    a single scheduler process (pw_schedule_run.py) per project will
+    launch it when ready. The scheduler is started here if needed.
     """
-    protStrId = protocol.strId()
-    python = pw.SCIPION_PYTHON
-    scipion = pw.getScipionScript()
-    cmd = '%s %s runprotocol pw_schedule_run.py' % (python, scipion)
-    cmd += ' "%s" "%s" %s' % (protocol.getProject().path,
-                              protocol.getDbPath(),
-                              protStrId)
-    jobId = _run(cmd, wait)
-    protocol.setJobId(jobId)
+    projPath = protocol.getProject().path
+    _writeScheduleRequest(projPath, protocol)
+    jobId = getSchedulerPid(projPath)
+
+    if jobId is None:
+        python = pw.SCIPION_PYTHON
+        scipion = pw.getScipionScript()
+        cmd = '%s %s runprotocol pw_schedule_run.py "%s"' % (python, scipion,
+                                                             projPath)
+        jobId = _run(cmd, wait)
 
     return jobId
 
 
+def getSchedulerPath(projPath, *paths):
+    """ Return the path (inside the project Logs) where the scheduler
+    keeps its pid, lock and queue of requests.
+    """
+    return join(projPath, SCHEDULER_PATH, *paths)
+
+
+def getSchedulerPid(projPath):
+    """ Return the pid of the scheduler of the given project
+    or None if it is not running.
+    """
+    pidFile = getSchedulerPath(projPath, SCHEDULER_PID)
+
+    try:
+        pid = int(open(pidFile).read())
+    except (IOError, ValueError):
+        return None
+
+    return pid if process.isProcessAlive(pid) else None
+
+
+def readScheduleRequests(projPath):
+    """ Read and remove the pending schedule requests of the project.
+    Return a list of (protId, dbPath) tuples.
+    """
+    queuePath = getSchedulerPath(projPath, SCHEDULER_QUEUE)
+    requests = []
+
+    for reqFile in sorted(glob(join(queuePath, '*.json'))):
+        try:
+            with open(reqFile) as f:
+                reqDict = json.load(f)
+            requests.append((reqDict['protId'], str(reqDict['dbPath'])))
+        except (IOError, ValueError, KeyError) as e:
+            print "** Invalid schedule request %s: %s" % (reqFile, e)
+        os.remove(reqFile)
+
+    return requests
+
+
+def _writeScheduleRequest(projPath, protocol):
+    """ Add a request to the scheduler queue of the project.
+    The file is written with a temporary name and then renamed
+    to prevent the scheduler from reading it partially.
+    """
+    queuePath = getSchedulerPath(projPath, SCHEDULER_QUEUE)
+    makePath(queuePath)
+    reqFile = join(queuePath, '%s.json' % protocol.strId())
+    tmpFile = reqFile + '.tmp'
+
+    with open(tmpFile, 'w') as f:
+        json.dump({'protId': protocol.getObjId(),
+                   'dbPath': protocol.getDbPath()}, f)
+    os.rename(tmpFile, reqFile)
+
 
 # ******************************************************************
 # *         Internal utility functions
@@ -255,7 +322,12 @@ def _run(command, wait, stdin=None, stdout=None, stderr=None):
 # ******************************************************************
 
 def _stopLocal(protocol):
-    
+
+    if protocol.isScheduled():
+        # There is no process to stop (the pid is not set), the project
+        # scheduler drops the runs that are not longer scheduled
+        return
+
     if protocol.useQueue() and not protocol.isScheduled():
         jobId = protocol.getJobId()        
         host = protocol.getHostConfig()
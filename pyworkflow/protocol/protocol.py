@@ -338,6 +338,8 @@ class Protocol(Step):
         # This will be used at project load time to check if
         # we need to update the protocol with the data from run.db
         self.lastUpdateTimeStamp = String()
+        # Revision of the run.db changes already copied to the project
+        self.lastUpdateRevision = Integer(0)
 
         # For non-parallel protocols mpi=1 and threads=1
         self.allowMpi = hasattr(self, 'numberOfMpi')
@@ -715,11 +717,27 @@ class Protocol(Step):
         if not self.mapper is None:
             if len(objs) == 0:
                 self.mapper.store(self)
+                self._registerChange()
             else:
                 for obj in objs:
                     self.mapper.store(obj)
+                self._registerChange(*[self.__getAttributeName(obj)
+                                       for obj in objs])
             self.mapper.commit()
 
+    def __getAttributeName(self, obj):
+        """ Return the name of obj as attribute of the protocol or
+        an empty string if it is not a direct attribute. """
+        name = obj.getLastName()
+        return name if getattr(self, name, None) is obj else ''
+
+    def _registerChange(self, *names):
+        """ Register in the mapper which attributes have changed (any
+        of them if no names are passed or a name is empty). This allows
+        the project to update only those attributes from the run.db.
+        """
+        self.mapper.insertChange(names)
+
     def _insertChild(self, key, child):
         """ Insert a new child not stored previously.
         If stored previously, _store should be used.
@@ -729,6 +747,7 @@ class Protocol(Step):
             setattr(self, key, child)
             if self.hasObjId():
                 self.mapper.insertChild(self, key, child)
+                self._registerChange(key)
         except Exception as ex:
             print("Error with child '%s', value=%s, type=%s"
                   % (key, child, type(child)))
@@ -737,6 +756,7 @@ class Protocol(Step):
     def _deleteChild(self, key, child):
         """ Delete a child from the mapper. """
         self.mapper.delete(child)
+        self._registerChange()
 
     def _insertAllSteps(self):
         """ Define all the steps that will be executed. """
@@ -1033,6 +1053,7 @@ class Protocol(Step):
 
         self._outputs.clear()
         self.mapper.store(self._outputs)
+        self._registerChange()
 
     def findAttributeName(self, attr):
         for attrName, attr in self.iterOutputEM():
@@ -1047,6 +1068,7 @@ class Protocol(Step):
         if attrName in self._outputs:
             self._outputs.remove(attrName)
         self.mapper.store(self._outputs)
+        self._registerChange()
         self.mapper.commit()
 
     def __copyRelations(self, other):
@@ -1106,6 +1128,7 @@ class Protocol(Step):
 
         self.mapper.insertRelation(relName, self, parentObj, childObj,
                                    parentExt, childExt)
+        self._registerChange()
 
     def makePathsAndClean(self):
         """ Create the necessary path or clean
@@ -1121,6 +1144,7 @@ class Protocol(Step):
             # Delete the relations created by this protocol
             # (delete this in both project and protocol db)
             self.mapper.deleteRelations(self)
+            self._registerChange()
         # Create workingDir, extra and tmp paths
         pwutils.makePath(*paths)
 
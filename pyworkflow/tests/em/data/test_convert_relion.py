@@ -148,6 +148,76 @@ class TestConversions(BaseTest):
                       'rlnNrOfSignificantSamples', 'rlnMaxValueProbDistribution']
         self.assertEqual(goldLabels, [md.label2Str(l) for l in mdAll.getActiveLabels()])
         self.assertEqual(4700, mdAll.size())
+
+    def test_starReader(self):
+        """ Compare the numpy STAR reader with the Xmipp metadata. """
+        fnStar = self.getFile('relion_it020_data')
+        mdAll = md.MetaData(fnStar)
+        table = relion.readStarTable(fnStar)
+
+        self.assertEqual(mdAll.size(), len(table))
+        self.assertEqual([md.label2Str(l) for l in mdAll.getActiveLabels()],
+                         table.getColumnNames())
+
+        for row, starRow in zip(md.iterRows(mdAll),
+                                relion.iterStarRows(fnStar)):
+            for label in mdAll.getActiveLabels():
+                value = row.getValue(label)
+                if isinstance(value, float):
+                    self.assertAlmostEqual(value, starRow.getValue(label),
+                                           places=4)
+                else:
+                    self.assertEqual(value, starRow.getValue(label))
+
+        # Write the table and read it back
+        fnOut = self.getOutputPath('particles_it020.star')
+        relion.star.writeStar(fnOut, table)
+        table2 = relion.star.readStar(fnOut, table.getName())
+        self.assertEqual(len(table), len(table2))
+        self.assertTrue(numpy.allclose(table.getColumn('rlnDefocusU'),
+                                       table2.getColumn('rlnDefocusU')))
+        self.assertEqual(mdAll.size(), md.MetaData(fnOut).size())
+
+    def test_particlesTable(self):
+        """ Compare the columnar conversion of particles with the
+        conversion row by row (used when the row hooks are passed).
+        """
+        def _noHook(img, row):
+            pass
+
+        fnStar = self.getFile('relion_it020_data')
+        partSets = []
+        for hooks in [{}, {'postprocessImageRow': _noHook}]:
+            fnSqlite = self.getOutputPath('particles_it020_%d.sqlite'
+                                          % len(partSets))
+            partSet = SetOfParticles(filename=fnSqlite)
+            partSet.setSamplingRate(3.5)
+            relion.readSetOfParticles(fnStar, partSet,
+                                      alignType=ALIGN_PROJ, **hooks)
+            partSet.write()
+            partSets.append(partSet)
+
+        partSet, partSetRows = partSets
+        self.assertEqual(partSetRows.getSize(), partSet.getSize())
+        for p1, p2 in zip(partSet, partSetRows):
+            self.assertTrue(p1.equalAttributes(p2, verbose=True))
+
+        table = relion.setOfImagesToTable(partSet, relion.particleToRow,
+                                          'Particles')
+        tableRows = relion.setOfImagesToTable(partSet, relion.particleToRow,
+                                              'Particles',
+                                              postprocessImageRow=_noHook)
+        self.assertEqual(sorted(tableRows.getColumnNames()),
+                         sorted(table.getColumnNames()))
+        for colName in tableRows.getColumnNames():
+            values = table.getColumn(colName)
+            valuesRows = tableRows.getColumn(colName)
+            if values.dtype.kind == 'f':
+                self.assertTrue(numpy.allclose(values, valuesRows),
+                                colName)
+            else:
+                self.assertEqual(valuesRows.tolist(), values.tolist(),
+                                 colName)
         
 
 class TestConvertBinaryFiles(BaseTest):
@@ -653,6 +723,28 @@ class TestReconstruct(TestConvertAnglesBase):
             
             self.assertTrue(numpy.allclose(aMatrix, b.getMatrix(), rtol=1e-2))
 
+    def test_geometryFromMatrices(self):
+        """ Compare the conversion of several matrices at once with
+        the conversion of each matrix.
+        """
+        numpy.random.seed(0)
+        shifts = numpy.random.uniform(-10, 10, (20, 3))
+        angles = numpy.random.uniform(-180, 180, (20, 3))
+        angles[0] = [0, 0, 30]  # tilt 0 has many equivalent angles
+
+        for inverseTransform in [False, True]:
+            matrices = relion.matricesFromGeometry(shifts, angles,
+                                                   inverseTransform)
+            shifts2, angles2 = relion.geometryFromMatrices(matrices,
+                                                           inverseTransform)
+            for i, matrix in enumerate(matrices):
+                self.assertTrue(numpy.allclose(
+                    matrix, relion.matrixFromGeometry(shifts[i], angles[i],
+                                                      inverseTransform)))
+                s, a = relion.geometryFromMatrix(matrix, inverseTransform)
+                self.assertTrue(numpy.allclose(s, shifts2[i]))
+                self.assertTrue(numpy.allclose(a, angles2[i]))
+
  #* newrot = rot;
  #* newtilt = tilt + 180;
  #* newpsi = -(180 + psi);
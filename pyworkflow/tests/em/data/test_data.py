@@ -4,11 +4,15 @@ Created on May 20, 2013
 @author: laura
 '''
 
+import json
 from glob import iglob
+from itertools import izip
+import numpy as np
 from pyworkflow.tests import *
 from pyworkflow.em.packages.xmipp3.convert import *
 import pyworkflow.em.metadata as md
 from pyworkflow.em.convert import ImageHandler, DT_FLOAT
+import pyworkflow.em.mrc as mrc
 
 
 
@@ -196,6 +200,47 @@ class TestImageHandler(unittest.TestCase):
         else:
             pwutils.cleanPath(outFn)
 
+    def test_mrcStack(self):
+        """ Check the numpy access to .mrcs stacks. """
+        stackFn = join(self.outputPath, 'stack.mrcs')
+        data = np.random.normal(size=(10, 32, 48)).astype(np.float32)
+
+        mrcOut = mrc.createMrcFile(stackFn, (48, 32, 1, 10))
+        for i in range(10):
+            mrcOut.setImage(i + 1, data[i])
+        mrcOut.updateStats()
+        mrcOut.close()
+
+        ih = ImageHandler()
+        self.assertEqual(ih.getDimensions(stackFn), (48, 32, 1, 10))
+        self.assertEqual(ih.getDimensions(stackFn + ':mrc'), (48, 32, 10, 1))
+
+        mrcIn = mrc.MrcFile(stackFn)
+        self.assertTrue(np.allclose(mrcIn.getData(), data))
+        self.assertAlmostEqual(mrcIn.getHeader()['dmean'], data.mean(),
+                               places=4)
+
+        avg = ih.computeAverage(stackFn).getData()
+        self.assertTrue(np.allclose(avg, data.mean(axis=0), atol=1e-5))
+
+        invFn = join(self.outputPath, 'stack_inverted.mrcs')
+        ih.invertStack(stackFn, invFn)
+        self.assertTrue(np.allclose(mrc.MrcFile(invFn).getData(), -data))
+
+        subsetFn = join(self.outputPath, 'stack_subset.mrcs')
+        ih.convertStack(stackFn, subsetFn, 3, 5)
+        self.assertEqual(ih.getDimensions(subsetFn), (48, 32, 1, 3))
+        self.assertTrue(np.allclose(mrc.MrcFile(subsetFn).getData(),
+                                    data[2:5]))
+
+        # Only one of the bounds
+        ih.convertStack(stackFn, subsetFn, firstImg=8)
+        self.assertTrue(np.allclose(mrc.MrcFile(subsetFn).getData(),
+                                    data[7:]))
+        ih.convertStack(stackFn, subsetFn, lastImg=2)
+        self.assertTrue(np.allclose(mrc.MrcFile(subsetFn).getData(),
+                                    data[:2]))
+
 
 class TestSetOfMicrographs(BaseTest):
 
@@ -511,9 +556,63 @@ class TestSetOfClasses2D(BaseTest):
             self.assertEqual(cls.getSize(), sizes[i])
         clsSet.clear() # Close db connection and clean data
 
+    def test_singleTable(self):
+        """ Store the same classes with a table for each class and with
+        a single table, and check that both layouts are read equally.
+        """
+        def _createClasses(singleTable):
+            fn = self.getOutputPath('classes_single%s.sqlite' % singleTable)
+            clsSet = SetOfClasses2D(filename=fn, singleTable=singleTable)
+            for ref in [1, 2, 3]:
+                clsSet.append(Class2D(objId=ref))
+            for i in range(30):
+                cls = clsSet[i % 3 + 1]
+                cls.enableAppend()
+                img = Particle(objId=i + 1)
+                img.setEnabled(i != 4)
+                cls.append(img)
+                cls.write()
+                clsSet.update(cls)
+            cls = clsSet[3]
+            cls.setEnabled(False)
+            clsSet.update(cls)
+            clsSet.write()
+            clsSet.close()
+            return SetOfClasses2D(filename=fn)
+
+        tablesSet = _createClasses(False)
+        singleSet = _createClasses(True)
+        self.assertFalse(tablesSet.hasSingleTable())
+        self.assertTrue(singleSet.hasSingleTable())
+
+        def _ids(clsSet, iterDisabled):
+            return [(cls.getObjId(), [img.getObjId() for img in items])
+                    for cls, items in
+                    clsSet.iterClassesWithItems(iterDisabled=iterDisabled)]
+
+        self.assertEqual([(1, [1, 4, 7, 10, 13, 16, 19, 22, 25, 28]),
+                          (2, [2, 8, 11, 14, 17, 20, 23, 26, 29])],
+                         _ids(singleSet, False))
+        for iterDisabled in [False, True]:
+            self.assertEqual(_ids(tablesSet, iterDisabled),
+                             _ids(singleSet, iterDisabled))
+            self.assertEqual(
+                [img.getObjId() for img in
+                 tablesSet.iterClassItems(iterDisabled=iterDisabled)],
+                [img.getObjId() for img in
+                 singleSet.iterClassItems(iterDisabled=iterDisabled)])
+        for cls in singleSet:
+            self.assertEqual(10, cls.getSize())
+        tablesSet.close()
+        singleSet.close()
+
 
 class TestTransform(BaseTest):
 
+    @classmethod
+    def setUpClass(cls):
+        setupTestOutput(cls)
+
     def test_scale(self):
         """ Check Scale storage in transformation class
         """
@@ -564,8 +663,39 @@ class TestTransform(BaseTest):
         
         p2 = p.clone()
         m3 = p2.getTransform().getMatrix()
-        self.assertTrue(np.allclose(m, m3, rtol=1e-2)) 
-        
+        self.assertTrue(np.allclose(m, m3, rtol=1e-2))
+
+    def test_storage(self):
+        """ Check that matrices are stored as binary data, that old
+        sets with json values can be read and the bulk accessor.
+        """
+        dbName = self.getOutputPath('particles_matrix.sqlite')
+        matrices = np.random.rand(10, 4, 4)
+        partSet = SetOfParticles(filename=dbName)
+        for m in matrices:
+            p = Particle()
+            p.setTransform(Transform(m))
+            partSet.append(p)
+        partSet.write()
+
+        # Store the first one in json as done in previous versions
+        db = partSet._getMapper().db
+        col = db._columnsMapping['_transform._matrix']
+        db.executeCommand("SELECT typeof(%s) FROM Objects" % col)
+        self.assertEqual(['blob'], list(set(r[0] for r in db.cursor)))
+        db.executeCommand("UPDATE Objects SET %s=? WHERE id=1" % col,
+                          (json.dumps(matrices[0].tolist()),))
+        db.commit()
+        partSet.close()
+
+        partSet = SetOfParticles(filename=dbName)
+        for m, p in izip(matrices, partSet):
+            self.assertTrue(np.allclose(m, p.getTransform().getMatrix()))
+        self.assertTrue(np.allclose(matrices, partSet.getMatrices()))
+        self.assertTrue(np.allclose(matrices[5:],
+                                    partSet.getMatrices(where='id>5')))
+        partSet.close()
+
     
 class TestCopyItems(BaseTest):
 
@@ -24,8 +24,9 @@
 import time
 import os
 
-from pyworkflow.em.protocol.monitors.protocol_monitor_ctf import CTF_LOG_SQLITE
-from pyworkflow.tests import BaseTest, setupTestProject
+from pyworkflow.em.protocol.monitors.protocol_monitor_ctf import (
+    CTF_LOG_SQLITE, MonitorCTF)
+from pyworkflow.tests import BaseTest, setupTestProject, setupTestOutput
 from pyworkflow.em.protocol import ProtCreateStreamData, ProtMonitorSystem
 from pyworkflow.em.packages.grigoriefflab import ProtCTFFind
 from pyworkflow.protocol import getProtocolFromDb
@@ -110,3 +111,33 @@ class TestCtfStream(BaseTest):
 
         baseFn = protMonitor._getPath(CTF_LOG_SQLITE)
         self.assertTrue(os.path.isfile(baseFn))
+
+
+class TestMonitorCTFLog(BaseTest):
+    @classmethod
+    def setUpClass(cls):
+        setupTestOutput(cls)
+
+    def test_insertRows(self):
+        """ Rows that can not be stored are reported once and skipped. """
+        monitor = MonitorCTF(None, workingDir=self.getOutputPath(),
+                             maxDefocus=40000, minDefocus=1000,
+                             astigmatism=2000)
+        warnings = []
+        monitor.warning = warnings.append
+        monitor.initLoop()
+
+        def _row(ctfId, micPath):
+            return (ctfId, 20000., 19000., 1000., 1.05, 4., 0.5, micPath,
+                    'psd.mrc', '')
+
+        monitor._insertRows([_row(1, 'mic1.mrc'), _row(2, object()),
+                             _row(3, 'mic3.mrc')])
+        self.assertEqual(1, len(warnings))
+        self.assertEqual([1, 3], monitor.getData()['idValues'])
+        self.assertEqual(3, monitor._lastCtfId)
+
+        # Skipped rows are not stored again in the next steps
+        monitor._insertRows([_row(4, 'mic4.mrc')])
+        self.assertEqual(1, len(warnings))
+        self.assertEqual([1, 3, 4], monitor.getData()['idValues'])
@@ -27,16 +27,25 @@
 
 import os
 import os.path
+import time
+import multiprocessing
+import threading
 import unittest
+import numpy as np
 from pyworkflow.mapper import *
 from pyworkflow.object import *
 from pyworkflow.config import *
-from pyworkflow.em.data import Acquisition, SetOfImages, Image
+from pyworkflow.em.data import (Acquisition, SetOfImages, Image,
+                               SetOfParticles, Particle, CTFModel,
+                               SetOfClasses2D, Transform)
 from pyworkflow.tests import *
 import pyworkflow.dataset as ds
 import pyworkflow.utils as pwutils
 from pyworkflow.mapper.sqlite import SqliteFlatMapper
-from pyworkflow.mapper.sqlite_db import SqliteDb
+from pyworkflow.mapper.sqlite_shards import SqliteShardedMapper
+from pyworkflow.mapper.snapshot import SnapshotMapper
+from pyworkflow.mapper.sqlite_db import SqliteDb, ConnectionPool
+from pyworkflow.mapper.query import Attr
 
 
 
@@ -130,7 +139,7 @@ class TestSqliteMapper(BaseTest):
         
         # Save changes to file
         mapper.commit()
-        self.assertEqual(1, mapper.db.getVersion())
+        self.assertEqual(2, mapper.db.getVersion())
 
         # Intentionally keep gold.sqlite as version 0 to check
         # backward compatibility
@@ -146,8 +155,8 @@ class TestSqliteMapper(BaseTest):
         
         # Reading test
         mapper2 = SqliteMapper(fnGoldCopy, globals())
-        print "Checking that Relations table is updated and version to 1"
-        self.assertEqual(1, mapper2.db.getVersion())
+        print "Checking that Relations table is updated and version to 2"
+        self.assertEqual(2, mapper2.db.getVersion())
         # Check that the new column is properly added after updated to version 1
         colNamesGold += [u'object_parent_extended', u'object_child_extended']
         colNames = [col[1] for col in mapper2.db.getTableColumns('Relations')]
@@ -225,6 +234,156 @@ class TestSqliteMapper(BaseTest):
         # set to None and the _extended property cleanned
         self.assertIsNone(p2.get())
 
+    def test_selectRowsByClass(self):
+        """ Check that rows of objects and their attributes are
+        selected without building the objects. """
+        fn = self.getOutputPath("rows.sqlite")
+        pwutils.cleanPath(fn)
+        print ">>> Using db: ", fn
+
+        mapper = SqliteMapper(fn, globals())
+        complexList = []
+        for i in range(3):
+            c = Complex(imag=i, real=i + 1)
+            mapper.insert(c)
+            complexList.append(c)
+        p = Pointer(complexList[0], extended='real')
+        mapper.insert(p)
+        mapper.commit()
+
+        objRows, childRows = mapper.selectRowsByClass('Complex')
+        self.assertEqual([c.getObjId() for c in complexList],
+                         [row['id'] for row in objRows])
+        for c in complexList:
+            values = dict((row['name'].split('.')[-1], row['value'])
+                          for row in childRows[c.getObjId()])
+            self.assertEqual({'real': str(c.real), 'imag': str(c.imag)},
+                             values)
+
+        # Pointed id and extended, in the children of the pointer
+        objRows, childRows = mapper.selectRowsByClass('Pointer')
+        self.assertEqual(str(complexList[0].getObjId()), objRows[0]['value'])
+        self.assertEqual('real', childRows[p.getObjId()][0]['value'])
+        mapper.close()
+
+    def test_changes(self):
+        """ Check the log of changes used to update only the
+        modified objects. """
+        fn = self.getOutputPath("changes.sqlite")
+        pwutils.cleanPath(fn)
+        print ">>> Using db: ", fn
+
+        mapper = SqliteMapper(fn, globals())
+        self.assertEqual(0, mapper.getRevision())
+        self.assertEqual([], mapper.selectChanges(0))
+
+        rev1 = mapper.insertChange(['real'])
+        rev2 = mapper.insertChange(['imag', 'real'])
+        mapper.commit()
+        self.assertTrue(rev1 < rev2)
+        self.assertEqual(rev2, mapper.getRevision())
+        self.assertEqual(['real', 'imag', 'real'], mapper.selectChanges(0))
+        self.assertEqual(['imag', 'real'], mapper.selectChanges(rev1))
+        self.assertEqual([''], mapper.selectChanges(mapper.insertChange() - 1))
+
+        # Only the last changes are kept
+        for _ in range(mapper.db.CHANGES_SIZE):
+            mapper.insertChange(['real'])
+        mapper.commit()
+        self.assertIsNone(mapper.selectChanges(rev2))
+        self.assertEqual(['real'],
+                         mapper.selectChanges(mapper.getRevision() - 1))
+        mapper.close()
+
+    def test_connectionPool(self):
+        """ Check that connections are shared, reused and closed
+        when there are too many open. """
+        pool = ConnectionPool(maxSize=2, cacheSize=4)
+
+        def _openDb(name, reuse=True):
+            db = SqliteDb()
+            db.POOL = pool
+            db._reuseConnections = reuse
+            db._createConnection(self.getOutputPath(name), timeout=1000)
+            return db
+
+        db1, db2 = _openDb('pool1.sqlite'), _openDb('pool1.sqlite')
+        self.assertIs(db1.connection, db2.connection)
+        db2.executeCommand('PRAGMA cache_size')
+        self.assertEqual(-4096, db2.cursor.fetchone()[0])
+        # The connection is still used by db2
+        db1.close()
+        db2.executeCommand('SELECT 1')
+        db2.close()
+        # Not used, but kept open for reuse
+        db3 = _openDb('pool1.sqlite')
+        self.assertIs(db2.connection, db3.connection)
+        db3.close()
+        self.assertEqual({'hits': 2, 'misses': 1, 'evictions': 0,
+                          'open': 1, 'used': 0}, pool.getStats())
+
+        # Not shared connections are closed
+        _openDb('pool2.sqlite', reuse=False).close()
+        self.assertEqual(1, pool.getStats()['open'])
+
+        # The least recently used connections are closed
+        for i in range(2, 6):
+            _openDb('pool%d.sqlite' % i).close()
+        stats = pool.getStats()
+        self.assertEqual(2, stats['open'])
+        self.assertEqual(3, stats['evictions'])
+        pool.clear()
+        self.assertEqual(0, pool.getStats()['open'])
+
+        # Uncommitted changes are discarded when an idle connection is
+        # kept, so it does not lock the db for other writers
+        db1 = _openDb('pool6.sqlite')
+        db1.executeCommand('CREATE TABLE t (v INTEGER)')
+        db1.commit()
+        db1.executeCommand('INSERT INTO t VALUES (1)')
+        db1.close()
+        db2 = _openDb('pool6.sqlite', reuse=False)
+        db2.executeCommand('PRAGMA busy_timeout=100')
+        db2.executeCommand('INSERT INTO t VALUES (2)')
+        db2.commit()
+        db2.executeCommand('SELECT v FROM t')
+        self.assertEqual([2], [r[0] for r in db2.cursor.fetchall()])
+        db2.close()
+        pool.clear()
+
+        # A file replaced while its connection is used gets a new shared
+        # connection, the old one is closed when released
+        db1 = _openDb('pool7.sqlite')
+        db1.executeCommand('CREATE TABLE t (v INTEGER)')
+        db1.commit()
+        pwutils.cleanPath(self.getOutputPath('pool7.sqlite'))
+        db2, db3 = _openDb('pool7.sqlite'), _openDb('pool7.sqlite')
+        self.assertIsNot(db1.connection, db2.connection)
+        self.assertIs(db2.connection, db3.connection)
+        db1.close()
+        self.assertEqual(1, pool.getStats()['open'])
+        db2.close()
+        db3.close()
+        pool.clear()
+
+        # Private connections of a thread are not shared nor registered
+        db1 = _openDb('pool8.sqlite')
+        privateDbs = []
+
+        def _openPrivate():
+            pool.setPrivate()
+            privateDbs.append(_openDb('pool8.sqlite'))
+
+        thread = threading.Thread(target=_openPrivate)
+        thread.start()
+        thread.join()
+        self.assertIsNot(db1.connection, privateDbs[0].connection)
+        self.assertIs(db1.connection, _openDb('pool8.sqlite').connection)
+        self.assertEqual(1, pool.getStats()['open'])
+        privateDbs[0].close()
+        db1.close()
+        pool.clear()
+
     def test_removeFromLists(self):
         """ Check that lists are properly stored after removing some elements. """
         fn = self.getOutputPath("lists.sqlite")
@@ -377,6 +536,689 @@ class TestSqliteFlatMapper(BaseTest):
         items = [obj.clone() for obj in objSet]
         self.assertEqual(len(items), 0)
 
+    def test_appendMany(self):
+        dbName = self.getOutputPath('images_many.sqlite')
+        print ">>> test_appendMany: dbName = '%s'" % dbName
+        n = 25
+
+        def _iterImages():
+            img = Image()  # reuse the same instance for all items
+            for i in range(n):
+                img.setObjId(None)
+                img.setLocation(i+1, 'images.stk')
+                yield img
+
+        imgSet = SetOfImages(filename=dbName)
+        imgSet.appendMany(_iterImages(), batchSize=10)
+        imgSet.write()
+        self.assertEqual(n, imgSet.getSize())
+        imgSet.close()
+
+        imgSet = SetOfImages(filename=dbName)
+        self.assertEqual(n, imgSet.getSize())
+        for i, img in enumerate(imgSet):
+            self.assertEqual(i+1, img.getObjId())
+            self.assertEqual((i+1, 'images.stk'), img.getLocation())
+
+    def test_indexes(self):
+        dbName = self.getOutputPath('particles_indexes.sqlite')
+        print ">>> test_indexes: dbName = '%s'" % dbName
+        partSet = SetOfParticles(filename=dbName)
+        for i in range(10):
+            part = Particle()
+            part.setMicId(i % 3 + 1)
+            partSet.append(part)
+        partSet.write()
+
+        db = partSet._getMapper().db
+        self.assertEqual(SetOfParticles.INDEXES, db.getIndexes())
+        # Internal properties should not be loaded as Set attributes
+        partSet.loadAllProperties()
+        self.assertEqual(4, len(list(partSet.iterItems(where='_micId=1'))))
+        # Databases without the indexes get them on the next write, but
+        # not when reading, which would commit the pending changes
+        db.deleteProperty(db.INDEXES_PROPERTY)
+        partSet.write()
+        partSet.close()
+        partSet = SetOfParticles(filename=dbName)
+        db = partSet._getMapper().db
+        partSet.append(Particle())
+        self.assertEqual(4, len(list(partSet.iterItems(where='_micId=1'))))
+        db.connection.rollback()
+        self.assertEqual(10, partSet._getMapper().count())
+        self.assertEqual([], db.getIndexes())
+        partSet.append(Particle())
+        partSet.write()
+        self.assertEqual(SetOfParticles.INDEXES, db.getIndexes())
+        partSet.close()
+
+    def test_columnArrays(self):
+        dbName = self.getOutputPath('particles_columns.sqlite')
+        print ">>> test_columnArrays: dbName = '%s'" % dbName
+        partSet = SetOfParticles(filename=dbName)
+        for i in range(10):
+            part = Particle()
+            part.setMicId(i % 3 + 1)
+            part.setLocation(i+1, 'particles.stk')
+            part._flag = Boolean(i % 2 == 0 if i % 3 else None)
+            partSet.append(part)
+        partSet.write()
+
+        arrays = partSet.getColumnArrays(['id', '_micId', '_index'],
+                                         where='_micId=2',
+                                         orderBy='id', direction='DESC')
+        self.assertEqual([8, 5, 2], arrays['id'].tolist())
+        self.assertEqual([2, 2, 2], arrays['_micId'].tolist())
+        self.assertEqual(arrays['id'].tolist(), arrays['_index'].tolist())
+
+        # NULL booleans are kept as None, the same as in the items
+        flags = partSet.getColumnArrays(['_flag'])['_flag'].tolist()
+        self.assertEqual([p._flag.get() for p in partSet], flags)
+        self.assertIn(None, flags)
+        partSet.close()
+
+    def test_columnStats(self):
+        dbName = self.getOutputPath('particles_stats.sqlite')
+        print ">>> test_columnStats: dbName = '%s'" % dbName
+        partSet = SetOfParticles(filename=dbName)
+        for i in range(10):
+            part = Particle()
+            part.setMicId(i % 3 + 1)
+            partSet.append(part)
+        partSet.write()
+
+        stats = partSet.getColumnStats('_micId', bins=3)
+        self.assertEqual(10, stats['count'])
+        self.assertEqual((1, 3), (stats['min'], stats['max']))
+        self.assertAlmostEqual(1.9, stats['mean'])
+        self.assertEqual([4, 3, 3], stats['histogram'])
+        self.assertEqual(4, len(stats['edges']))
+        # The second time the stats are read from the Properties table
+        self.assertTrue(any(k.startswith('db.stats._micId')
+                            for k in partSet._getMapper().db.getPropertyKeys()))
+        self.assertEqual(stats, partSet.getColumnStats('_micId', bins=3))
+
+        # Appending or updating items should invalidate the cached stats
+        part = Particle()
+        part.setMicId(7)
+        partSet.append(part)
+        partSet.write()
+        self.assertEqual(7, partSet.getColumnStats('_micId')['max'])
+        part = partSet[1]
+        part.setMicId(0)
+        partSet.update(part)
+        partSet.write()
+        self.assertEqual(0, partSet.getColumnStats('_micId')['min'])
+
+        # Reading the stats should not commit the pending appends
+        part = Particle()
+        part.setMicId(9)
+        partSet.append(part)
+        self.assertEqual(9, partSet.getColumnStats('_micId')['max'])
+        partSet._getMapper().db.connection.rollback()
+        self.assertEqual(11, partSet._getMapper().count())
+        self.assertEqual(7, partSet.getColumnStats('_micId')['max'])
+        partSet.close()
+
+        # Deleting an item that is not the last one without the mapper
+        # (e.g. by an older version) keeps the max id, but not the count
+        self.assertEqual(11, SetOfParticles(
+            filename=dbName).getColumnStats('_micId')['count'])
+        otherSet = SetOfParticles(filename=dbName)
+        otherSet._getMapper().db.deleteObject(2)
+        otherSet.write()
+        otherSet.close()
+        self.assertEqual(10, SetOfParticles(
+            filename=dbName).getColumnStats('_micId')['count'])
+
+    def test_readNewItems(self):
+        dbName = self.getOutputPath('particles_stream.sqlite')
+        print ">>> test_readNewItems: dbName = '%s'" % dbName
+        partSet = SetOfParticles(filename=dbName)
+        for i in [1, 2, 3, 5]:
+            partSet.append(Particle(objId=i))
+        partSet.write()
+
+        readSet = SetOfParticles(filename=dbName)
+        items, allRead = readSet.readNewItems(lastId=2, lastCount=2)
+        self.assertEqual([3, 5], [p.getObjId() for p in items])
+        self.assertFalse(allRead)
+
+        # An item inserted with a lower id should force a full read
+        partSet.append(Particle(objId=4))
+        partSet.write()
+        items, allRead = readSet.readNewItems(lastId=5, lastCount=4)
+        self.assertEqual([1, 2, 3, 4, 5], [p.getObjId() for p in items])
+        self.assertTrue(allRead)
+        readSet.close()
+        partSet.close()
+
+    def test_getPage(self):
+        dbName = self.getOutputPath('particles_pages.sqlite')
+        print ">>> test_getPage: dbName = '%s'" % dbName
+        partSet = SetOfParticles(filename=dbName)
+        for i in range(100):
+            p = Particle()
+            p.setMicId(i % 7 if i % 10 else None)  # Some NULL values
+            partSet.append(p)
+        partSet.write()
+
+        allParts = [(p.getMicId(), p.getObjId()) for p in partSet]
+
+        for direction in ['ASC', 'DESC']:
+            pages, token = [], None
+            while True:
+                items, token = partSet.getPage(15, token, orderBy='_micId',
+                                               direction=direction)
+                pages.extend((p.getMicId(), p.getObjId()) for p in items)
+                if token is None:
+                    break
+            self.assertEqual(sorted(allParts, reverse=(direction == 'DESC')),
+                             pages)
+
+        # The token can not be used with a different order
+        items, token = partSet.getPage(10, orderBy='_micId')
+        self.assertRaises(Exception, partSet.getPage, 10, token, orderBy='id')
+        partSet.close()
+
+        # Order by a BLOB column, the token should encode its values
+        dbName = self.getOutputPath('particles_pages_blob.sqlite')
+        partSet = SetOfParticles(filename=dbName)
+        for i in range(20):
+            p = Particle()
+            p.setTransform(Transform())
+            p.getTransform().getMatrix()[0, 3] = i % 4
+            partSet.append(p)
+        partSet.write()
+
+        orderBy = '_transform._matrix'
+        allIds = [p.getObjId() for p in partSet.iterItems(orderBy=orderBy)]
+        pageIds, token = [], None
+        while True:
+            items, token = partSet.getPage(6, token, orderBy=orderBy)
+            pageIds.extend(p.getObjId() for p in items)
+            if token is None:
+                break
+        self.assertEqual(allIds, pageIds)
+        partSet.close()
+
+    def test_shardedSet(self):
+        for shardBy in ['id', '_micId']:
+            dbName = self.getOutputPath('particles_%s.shards' % shardBy)
+            print ">>> test_shardedSet: dbName = '%s'" % dbName
+            pwutils.cleanPattern(dbName.replace('.shards', '*'))
+            SqliteShardedMapper.createManifest(dbName, shardBy=shardBy,
+                                               shardSize=30, numShards=4)
+            partSet = SetOfParticles(filename=dbName)
+            for i in range(100):
+                p = Particle(location=(i / 3 + 1, 'stack%d.mrcs' % (i % 3)))
+                p.setMicId(i % 7)
+                partSet.append(p)
+            partSet.write()
+            partSet.close()
+
+            partSet = SetOfParticles(filename=dbName)
+            self.assertEqual(100, partSet.getSize())
+            self.assertEqual(4, partSet[40].getMicId())
+            self.assertEqual(range(1, 101), [p.getObjId() for p in partSet])
+            # The manifest and the shard files
+            self.assertEqual(5, len(Set.getFiles(partSet)))
+            self.assertEqual(set(['stack0.mrcs', 'stack1.mrcs',
+                                  'stack2.mrcs']), partSet.getFiles())
+            # Items of all shards are merged in the requested order
+            parts = [(p.getMicId(), p.getObjId())
+                     for p in partSet.iterItems(orderBy=['_micId', 'id'])]
+            self.assertEqual(sorted(parts), parts)
+            self.assertEqual(15, len(list(partSet.iterItems(
+                where='_micId=0'))))
+            self.assertEqual(100, partSet.getColumnStats('_micId')['count'])
+            partSet.close()
+
+    def test_snapshot(self):
+        dbName = self.getOutputPath('particles_snapshot.sqlite')
+        print ">>> test_snapshot: dbName = '%s'" % dbName
+        pwutils.cleanPath(dbName, SnapshotMapper.getSnapshotPath(dbName))
+        partSet = SetOfParticles(filename=dbName)
+        for i in range(100):
+            p = Particle()
+            p.setMicId(i % 7 if i % 10 else None)  # Some NULL values
+            partSet.append(p)
+        partSet.write()
+
+        def _read(partSet):
+            return ([(p.getObjId(), p.getMicId()) for p in partSet],
+                    [p.getObjId() for p in partSet.iterItems(
+                        orderBy='_micId', direction='DESC')],
+                    partSet.aggregate(['COUNT', 'MAX'], '_micId', ['_micId']),
+                    partSet.getColumnStats('_micId', bins=3)['histogram'],
+                    partSet[50].getMicId(), partSet.getSize())
+
+        expected = _read(partSet)
+        partSet.exportSnapshot()
+        self.assertTrue(SnapshotMapper.hasSnapshot(dbName))
+        partSet = SetOfParticles(filename=dbName)
+        self.assertTrue(isinstance(partSet._getMapper(), SnapshotMapper))
+        self.assertEqual(expected, _read(partSet))
+        snapshotFiles = Set.getFiles(partSet) - set([dbName])
+        self.assertEqual(set(SnapshotMapper.getSnapshotFiles(dbName)),
+                         snapshotFiles)
+        self.assertTrue(os.path.join(SnapshotMapper.getSnapshotPath(dbName),
+                                     'schema.json') in snapshotFiles)
+        # Selections with a where are done in the sqlite file
+        self.assertEqual(14, len(list(partSet.iterItems(where='_micId=1'))))
+
+        # Any change removes the snapshot
+        partSet.append(Particle())
+        partSet.write()
+        self.assertFalse(SnapshotMapper.hasSnapshot(dbName))
+        self.assertEqual(101, partSet.getSize())
+        partSet.close()
+
+    def test_snapshotAlignment(self):
+        """ Matrix values of the alignment are stored as binary data. """
+        dbName = self.getOutputPath('particles_snapshot_align.sqlite')
+        print ">>> test_snapshotAlignment: dbName = '%s'" % dbName
+        snapshotPath = SnapshotMapper.getSnapshotPath(dbName)
+        pwutils.cleanPath(dbName, snapshotPath)
+        partSet = SetOfParticles(filename=dbName)
+        partSet.setAlignment2D()
+        for i in range(20):
+            p = Particle()
+            p.setMicId(i % 3)
+            matrix = np.eye(4)
+            matrix[0, 3], matrix[1, 3] = i, -i
+            p.setTransform(Transform(matrix))
+            partSet.append(p)
+        partSet.write()
+
+        def _read(partSet):
+            return ([(p.getObjId(), p.getTransform().getMatrixAsList())
+                     for p in partSet],
+                    partSet.getMatrices().tolist(),
+                    [p.getObjId() for p in partSet.iterItems(
+                        orderBy='_transform._matrix', direction='DESC')],
+                    partSet.aggregate(['COUNT'], '_micId', ['_micId']))
+
+        expected = _read(partSet)
+        partSet.exportSnapshot()
+        self.assertTrue(SnapshotMapper.hasSnapshot(dbName))
+        self.assertFalse(os.path.exists(snapshotPath + '.tmp'))
+        partSet = SetOfParticles(filename=dbName)
+        self.assertTrue(isinstance(partSet._getMapper(), SnapshotMapper))
+        self.assertEqual(expected, _read(partSet))
+        partSet.close()
+
+    def test_prefetch(self):
+        dbName = self.getOutputPath('particles_prefetch.sqlite')
+        print ">>> test_prefetch: dbName = '%s'" % dbName
+        partSet = SetOfParticles(filename=dbName)
+        for i in range(500):
+            p = Particle()
+            p.setMicId(i % 7)
+            partSet.append(p)
+        partSet.write()
+
+        for kwargs in [{}, {'orderBy': '_micId', 'direction': 'DESC'},
+                       {'where': '_micId=3'}]:
+            expected = [(p.getObjId(), p.getMicId())
+                        for p in partSet.iterItems(**kwargs)]
+            parts = list(partSet.iterItems(prefetch=30, **kwargs))
+            self.assertEqual(expected, [(p.getObjId(), p.getMicId())
+                                        for p in parts])
+            # Each item is a different object
+            self.assertEqual(len(parts), len(set(map(id, parts))))
+
+        # The set can be used while iterating and the loop can be left
+        for p in partSet.iterItems(prefetch=10):
+            self.assertEqual(p.getMicId(), partSet[p.getObjId()].getMicId())
+            if p.getObjId() == 100:
+                break
+        # Errors in the reading thread are raised by the iterator
+        self.assertRaises(Exception, list,
+                          partSet.iterItems(prefetch=10, where='_none=1'))
+        partSet.close()
+
+        # Items of a class do not share the connection of the other
+        # classes in the same file, whose changes are not committed
+        classesFn = self.getOutputPath('classes_prefetch.sqlite')
+        pwutils.cleanPath(classesFn)
+        classSets = [SetOfParticles(filename=classesFn, prefix=prefix)
+                     for prefix in ['Class001', 'Class002']]
+        for classSet in classSets:
+            classSet.append(Particle())
+            classSet.write()
+        classSets[0].append(Particle())
+        self.assertEqual([1], [p.getObjId() for p in
+                               classSets[1].iterItems(prefetch=10)])
+        classSets[0].write()
+        self.assertEqual(2, classSets[0]._getMapper().count())
+        for classSet in classSets:
+            classSet.close()
+
+    def test_replacedAttributes(self):
+        dbName = self.getOutputPath('particles_replaced.sqlite')
+        print ">>> test_replacedAttributes: dbName = '%s'" % dbName
+        partSet = SetOfParticles(filename=dbName)
+        for i in range(10):
+            p = Particle()
+            p.setMicId(i)
+            p.setCTF(CTFModel(defocusU=i * 10., defocusV=i * 10.,
+                              defocusAngle=0))
+            partSet.append(p)
+        partSet.write()
+
+        # Attributes replaced in the iterated item are filled next rows
+        for i, p in enumerate(partSet):
+            self.assertEqual((i, i * 10.),
+                             (p.getMicId(), p.getCTF().getDefocusU()))
+            p.setCTF(CTFModel())
+        # Also the nested ones, replaced between selections
+        p = partSet.getFirstItem()
+        p.getCTF()._defocusU = Float()
+        self.assertEqual([i * 10. for i in range(10)],
+                         [p.getCTF().getDefocusU() for p in partSet])
+        partSet.close()
+
+    def test_whereExpressions(self):
+        dbName = self.getOutputPath('particles_where.sqlite')
+        print ">>> test_whereExpressions: dbName = '%s'" % dbName
+        partSet = SetOfParticles(filename=dbName)
+        for i in range(100):
+            p = Particle()
+            p.setMicId(i % 7 if i % 10 else None)  # Some NULL values
+            p.setCTF(CTFModel(defocusU=10000 + 100 * i, defocusV=10000,
+                              defocusAngle=0))
+            partSet.append(p)
+        partSet.write()
+
+        micId, defocusU = Attr('_micId'), Attr('_ctfModel._defocusU')
+        sql, params = (defocusU.between(1, 2) & micId.isIn([3, 4])).compile(
+            lambda label: label)
+        self.assertEqual('(_ctfModel._defocusU BETWEEN ? AND ?) AND '
+                         '(_micId IN (?,?))', sql)
+        self.assertEqual([1, 2, 3, 4], params)
+
+        parts = [(p.getObjId(), p.getMicId(), p.getCTF().getDefocusU())
+                 for p in partSet]
+
+        def _check(where, condition):
+            self.assertEqual([pid for pid, m, d in parts if condition(m, d)],
+                             [p.getObjId() for p in
+                              partSet.iterItems(where=where)])
+
+        _check(defocusU < 12000, lambda m, d: d < 12000)
+        _check(defocusU.between(12000, 13000) | (micId == 3),
+               lambda m, d: 12000 <= d <= 13000 or m == 3)
+        _check(micId.isIn([1, 2]) & ~(defocusU > 15000),
+               lambda m, d: m in [1, 2] and not d > 15000)
+        _check(micId == None, lambda m, d: m is None)
+        _check(micId.notIn([]), lambda m, d: True)
+        # Other selections also accept expressions
+        arrays = partSet.getColumnArrays(['id'], where=micId >= 5)
+        self.assertEqual([pid for pid, m, d in parts if m >= 5],
+                         list(arrays['id']))
+        self.assertEqual([pid for pid, m, d in parts if m == 2 and pid > 50],
+                         [p.getObjId() for p in
+                          partSet.iterItems(where=micId == 2, sinceId=50)])
+        partSet.close()
+
+    def test_appendFromSets(self):
+        def createSet(name, ids, withCtf=True):
+            dbName = self.getOutputPath(name)
+            pwutils.cleanPath(dbName)
+            partSet = SetOfParticles(filename=dbName)
+            for i in ids:
+                p = Particle()
+                p.setObjId(i)
+                p.setMicId(i % 7)
+                if withCtf:
+                    p.setCTF(CTFModel(defocusU=i * 10., defocusV=i * 10.,
+                                      defocusAngle=0.))
+                partSet.append(p)
+            partSet.write()
+            return partSet
+
+        fullSet = createSet('full_set.sqlite', range(1, 101))
+        subSet = createSet('sub_set.sqlite', range(1, 101, 3), withCtf=False)
+        print ">>> test_appendFromSets: dbName = '%s'" % fullSet.getFileName()
+
+        for difference in [False, True]:
+            outSet = SetOfParticles(
+                filename=self.getOutputPath('out_%s.sqlite' % difference))
+            outSet.appendFromSets([fullSet], subset=subSet,
+                                  difference=difference)
+            expected = fullSet.getIdSet() - subSet.getIdSet() if difference \
+                else subSet.getIdSet()
+            self.assertEqual(len(expected), outSet.getSize())
+            self.assertEqual(expected, outSet.getIdSet())
+            # All attributes are taken from the full set
+            for p in outSet:
+                self.assertAlmostEqual(p.getObjId() * 10.,
+                                       p.getCTF().getDefocusU())
+            outSet.close()
+
+        # Union of sets with different columns, keeping common attributes
+        unionSet = SetOfParticles(filename=self.getOutputPath('union.sqlite'))
+        unionSet.setSamplingRate(2.)
+        unionSet.appendFromSets([fullSet, subSet], template=subSet[1],
+                                renumber=True)
+        self.assertEqual(len(fullSet) + len(subSet), unionSet.getSize())
+        # The sampling rate of the set is set in the items
+        self.assertEqual(set([2.]),
+                         set(p.getSamplingRate() for p in unionSet))
+        self.assertEqual(range(1, unionSet.getSize() + 1),
+                         [p.getObjId() for p in unionSet])
+        self.assertEqual([p.getMicId() for p in fullSet] +
+                         [p.getMicId() for p in subSet],
+                         [p.getMicId() for p in unionSet])
+        for p in unionSet:
+            self.assertFalse(p.hasCTF())
+        unionSet.close()
+        fullSet.close()
+        subSet.close()
+
+    def test_copyItemsFrom(self):
+        dbName = self.getOutputPath('input_set.sqlite')
+        pwutils.cleanPath(dbName)
+        print ">>> test_copyItemsFrom: dbName = '%s'" % dbName
+        inputSet = SetOfParticles(filename=dbName)
+        inputSet.setDim((32, 32, 1))
+        inputSet.setSamplingRate(1.)
+        for i in range(1, 51):
+            p = Particle()
+            p.setMicId(i % 5)
+            p.setCTF(CTFModel(defocusU=i * 10., defocusV=i * 10.,
+                              defocusAngle=0.))
+            p.setEnabled(i != 10)
+            if i % 10:
+                p.setAcquisition(Acquisition(voltage=300.,
+                                             magnification=50000.))
+            inputSet.append(p)
+        inputSet.write()
+
+        def _getValues(partSet):
+            return [(p.getObjId(), p.getMicId(), p.getCTF().getDefocusU(),
+                     p.getCTF().getDefocusV(), p.getSamplingRate(),
+                     p.getAcquisition().getVoltage()) for p in partSet]
+
+        # The copy done in the database should be the same
+        # than the one done cloning the items, including the
+        # values set in the items by the output set
+        outputs = []
+        for i, callback in enumerate([None, lambda item, row: None]):
+            outSet = SetOfParticles(
+                filename=self.getOutputPath('output_%d.sqlite' % i))
+            outSet.setSamplingRate(2.)
+            outSet.setAcquisition(Acquisition(voltage=200.,
+                                              magnification=60000.))
+            outSet.copyItemsFrom(inputSet, where='_micId=0',
+                                 updateColumns={'_ctfModel._defocusV': 1.},
+                                 updateItemCallback=callback)
+            self.assertEqual((32, 32, 1), outSet.getDim())
+            outputs.append(_getValues(outSet))
+            outSet.close()
+
+        self.assertEqual([(i, 0, i * 10., 1., 2., 300. if i % 10 else 200.)
+                          for i in range(5, 51, 5) if i != 10], outputs[0])
+        self.assertEqual(outputs[0], outputs[1])
+
+        outSet = SetOfParticles(filename=self.getOutputPath('output_all.sqlite'))
+        outSet.copyItemsFrom(inputSet, copyDisabled=True)
+        self.assertEqual(inputSet.getSize(), outSet.getSize())
+        self.assertFalse(outSet[10].isEnabled())
+        outSet.close()
+        inputSet.close()
+
+    def test_classifyItems(self):
+        dbName = self.getOutputPath('classify_input.sqlite')
+        pwutils.cleanPath(dbName)
+        print ">>> test_classifyItems: dbName = '%s'" % dbName
+        inputSet = SetOfParticles(filename=dbName)
+        inputSet.setDim((32, 32, 1))
+        for i in range(1, 31):
+            p = Particle()
+            p.setMicId(i)
+            p.setClassId(i % 3 + 1)
+            p.setEnabled(i != 7)
+            inputSet.append(p)
+        inputSet.write()
+
+        def _classify(suffix, singleTable, callback):
+            classesFn = self.getOutputPath('classes_%s.sqlite' % suffix)
+            pwutils.cleanPath(classesFn)
+            classes = SetOfClasses2D(filename=classesFn,
+                                     singleTable=singleTable)
+            classes.setImages(inputSet)
+            classes.classifyItems(updateItemCallback=callback)
+            classes.write()
+            values = [(cls.getObjId(), cls.getSize(), cls.getDim(),
+                       [(p.getObjId(), p.getMicId()) for p in items])
+                      for cls, items in classes.iterClassesWithItems()]
+            classes.close()
+            return values
+
+        # Items copied in the database should be the same than the
+        # ones cloned when a callback is passed
+        for singleTable in [False, True]:
+            expected = _classify('python', singleTable, lambda p, r: None)
+            self.assertEqual([10, 9, 10], [v[1] for v in expected])
+            self.assertEqual(expected, _classify('sql', singleTable, None))
+        inputSet.close()
+
+    def test_walConcurrency(self):
+        """ Stress test with one process writing a set in streaming
+        and several processes reading it at the same time in WAL mode.
+        """
+        dbName = self.getOutputPath('particles_wal.sqlite')
+        print ">>> test_walConcurrency: dbName = '%s'" % dbName
+        pwutils.cleanPath(dbName)
+        os.environ['SCIPION_SQLITE_WAL'] = '1'
+
+        try:
+            ready, done = multiprocessing.Event(), multiprocessing.Event()
+            results = multiprocessing.Queue()
+            writer = multiprocessing.Process(target=_walWriter,
+                                             args=(dbName, 50, 200, ready,
+                                                   done, results))
+            writer.start()
+            ready.wait(60)
+            readers = [multiprocessing.Process(target=_walReader,
+                                               args=(dbName, done, results))
+                       for _ in range(4)]
+            for r in readers:
+                r.start()
+            for p in [writer] + readers:
+                p.join(300)
+
+            outputs = [results.get(timeout=10) for _ in range(5)]
+            errors = [out for out in outputs if isinstance(out, str)]
+            self.assertEqual([], errors)
+            for name, value in outputs:
+                print "    %s: %s" % (name, value)
+
+            partSet = SetOfParticles(filename=dbName)
+            self.assertEqual('wal', partSet._getMapper().db.getJournalMode())
+            self.assertEqual(50 * 200, partSet.getSize())
+            partSet.close()
+            # The checkpoint on close leaves all data in the db file
+            walFile = dbName + '-wal'
+            self.assertTrue(not os.path.exists(walFile) or
+                            os.path.getsize(walFile) == 0)
+        finally:
+            del os.environ['SCIPION_SQLITE_WAL']
+
+
+    def test_walSharedConnection(self):
+        """ Closing one of the mappers that share a connection (classes
+        in the same file) should not discard the changes of the others.
+        """
+        dbName = self.getOutputPath('classes_wal.sqlite')
+        print ">>> test_walSharedConnection: dbName = '%s'" % dbName
+
+        def _insertAndClose():
+            pwutils.cleanPath(dbName)
+            mapper1 = SqliteFlatMapper(dbName, globals(), 'Class001')
+            mapper2 = SqliteFlatMapper(dbName, globals(), 'Class002')
+            self.assertIs(mapper1.db.connection, mapper2.db.connection)
+            for i in range(2):
+                mapper1.insert(Particle(location=(i + 1, 'p.stk')))
+            mapper2.close()
+            mapper1.commit()
+            mapper1.close()
+            mapper = SqliteFlatMapper(dbName, globals(), 'Class001')
+            result = mapper.db.getJournalMode(), mapper.count()
+            mapper.close()
+            return result
+
+        self.assertEqual(('delete', 2), _insertAndClose())
+        os.environ['SCIPION_SQLITE_WAL'] = '1'
+        try:
+            self.assertEqual(('wal', 2), _insertAndClose())
+        finally:
+            del os.environ['SCIPION_SQLITE_WAL']
+
+
+def _walWriter(dbName, batches, batchSize, ready, done, results):
+    """ Append items to a set committing after each batch. """
+    try:
+        partSet = SetOfParticles(filename=dbName)
+        maxCommit = 0
+        for b in range(batches):
+            for i in range(batchSize):
+                p = Particle()
+                p.setMicId(b)
+                partSet.append(p)
+            t0 = time.time()
+            partSet.write()
+            maxCommit = max(maxCommit, time.time() - t0)
+            ready.set()
+        partSet.close()
+        results.put(('max commit secs', maxCommit))
+    except Exception as ex:
+        results.put('writer: %s' % ex)
+    finally:
+        ready.set()
+        done.set()
+
+
+def _walReader(dbName, done, results):
+    """ Read the set until the writer is done, checking that each read
+    returns all the committed items.
+    """
+    try:
+        reads, lastSize = 0, 0
+        while not done.is_set():
+            partSet = SetOfParticles(filename=dbName)
+            ids = [p.getObjId() for p in partSet]
+            partSet.close()
+            if ids != range(1, len(ids) + 1) or len(ids) < lastSize:
+                raise Exception("inconsistent read of %d items" % len(ids))
+            lastSize = len(ids)
+            reads += 1
+        results.put(('reads', reads))
+    except Exception as ex:
+        results.put('reader: %s' % ex)
+
 
 class TestXmlMapper(BaseTest):
     
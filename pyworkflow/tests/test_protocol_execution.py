@@ -29,8 +29,14 @@ from pyworkflow.em import *
 from tests import *
 from pyworkflow.mapper import SqliteMapper
 from pyworkflow.utils import dateStr
-from pyworkflow.protocol.constants import MODE_RESUME, STATUS_FINISHED
-from pyworkflow.protocol.executor import StepExecutor
+from collections import OrderedDict
+import pyworkflow.utils as pwutils
+import pyworkflow.protocol as pwprot
+from pyworkflow.protocol import Step
+from pyworkflow.protocol.constants import (MODE_RESUME, STATUS_FINISHED,
+                                           STATUS_RUNNING)
+from pyworkflow.protocol.executor import (StepExecutor, ThreadStepExecutor,
+                                          StepsGraph)
 
     
 #Protocol for tests, runs in resume mode, and sleeps for??
@@ -87,3 +93,235 @@ class TestProtocolExecution(BaseTest):
         prot2 = mapper2.selectById(prot.getObjId())
         
         self.assertEqual(prot.endTime.get(), prot2.endTime.get())
+
+    def test_StepsGraph(self):
+        """ Check that steps are ready only after its prerequisites. """
+        steps = [Step(), Step(), Step()]
+        steps[1].addPrerequisites(1)
+        steps[2].addPrerequisites(1, 2)
+        graph = StepsGraph(steps)
+
+        ready = graph.getReady(3)
+        self.assertEqual([steps[0]], ready)
+        self.assertTrue(graph.hasPending())
+        steps[0].setStatus(STATUS_FINISHED)
+        graph.setDone(steps[0])
+        self.assertEqual([steps[1]], graph.getReady(3))
+        steps[1].setStatus(STATUS_FINISHED)
+        graph.setDone(steps[1])
+        self.assertEqual([steps[2]], graph.getReady(3))
+
+    def test_ThreadStepExecutor(self):
+        """ Run many trivial steps with dependencies in parallel. """
+        n = 100
+        steps = [Step()]
+        for i in range(n):
+            step = Step()
+            step.addPrerequisites(1)
+            steps.append(step)
+
+        executor = ThreadStepExecutor(None, 4)
+        executor.runSteps(steps, lambda s: True, lambda s: True, lambda: None)
+        self.assertTrue(all(s.isFinished() for s in steps))
+
+
+class TestProjectUpdate(BaseTest):
+
+    @classmethod
+    def setUpClass(cls):
+        setupTestProject(cls)
+
+    def _countFullLoads(self):
+        """ Count the calls to getProtocolFromDb, used by the project
+        to load the whole protocol from its run.db. """
+        getProtocolFromDb = pwprot.getProtocolFromDb
+        self.fullLoads = 0
+
+        def _getProtocolFromDb(*args, **kwargs):
+            self.fullLoads += 1
+            return getProtocolFromDb(*args, **kwargs)
+
+        pwprot.getProtocolFromDb = _getProtocolFromDb
+        self.addCleanup(setattr, pwprot, 'getProtocolFromDb',
+                        getProtocolFromDb)
+
+    def test_updateProtocol(self):
+        """ Check that the project only copies the changed attributes
+        from the run.db, and that the whole protocol is loaded when
+        the run.db is created again. """
+        proj = self.proj
+        prot = proj.newProtocol(ProtImportMicrographs)
+        proj._setupProtocol(prot)
+        prot.makePathsAndClean()
+        proj._copyProtocolDb(prot)
+        self._countFullLoads()
+
+        def _runStatus(status):
+            """ Change the status as done when running the protocol. """
+            runMapper = proj.createMapper(prot.getDbPath())
+            runProt = runMapper.selectById(prot.getObjId())
+            runProt.setMapper(runMapper)
+            runProt.setStatus(status)
+            runProt._store(runProt.status)
+            revision = runMapper.getRevision()
+            runMapper.close()
+            return revision
+
+        def _update():
+            proj._updateProtocol(prot, skipUpdatedProtocols=False)
+            return prot.getStatus(), prot.lastUpdateRevision.get()
+
+        # The first update loads the whole protocol
+        rev = _runStatus(STATUS_RUNNING)
+        self.assertEqual((STATUS_RUNNING, rev), _update())
+        self.assertEqual(1, self.fullLoads)
+        # Next ones only copy the changes
+        rev = _runStatus(STATUS_FINISHED)
+        self.assertEqual((STATUS_FINISHED, rev), _update())
+        self.assertEqual((STATUS_FINISHED, rev), _update())
+        self.assertEqual(1, self.fullLoads)
+
+        # The revisions of a new run.db are not related to the old ones
+        proj._copyProtocolDb(prot)
+        self.assertEqual(0, prot.lastUpdateRevision.get())
+        rev = _runStatus(STATUS_RUNNING)
+        self.assertEqual((STATUS_RUNNING, rev), _update())
+        self.assertEqual(2, self.fullLoads)
+
+
+class TestRunsSummary(BaseTest):
+
+    @classmethod
+    def setUpClass(cls):
+        setupTestProject(cls)
+
+    def _createRuns(self):
+        """ Store a run with an output, and two runs using it as input
+        with a Pointer and with a PointerList. """
+        proj = self.proj
+        protImport = proj.newProtocol(ProtImportMicrographs,
+                                      objLabel='import')
+        proj._setupProtocol(protImport)
+        protImport.makePathsAndClean()
+        micSet = protImport._createSetOfMicrographs()
+        micSet.setSamplingRate(1.)
+        mic = Micrograph()
+        mic.setFileName('mic.mrc')
+        micSet.append(mic)
+        micSet.write()
+        protImport._defineOutputs(outputMicrographs=micSet)
+        protImport.setStatus(STATUS_FINISHED)
+        proj._storeProtocol(protImport)
+
+        protSubset = proj.newProtocol(ProtSubSet)
+        protSubset.inputFullSet.set(protImport)
+        protSubset.inputFullSet.setExtended('outputMicrographs')
+        proj.saveProtocol(protSubset)
+
+        protUnion = proj.newProtocol(ProtUnionSet)
+        protUnion.inputSets.append(Pointer(protImport,
+                                           extended='outputMicrographs'))
+        protUnion.inputSets.append(Pointer(micSet))
+        proj.saveProtocol(protUnion)
+
+        return protImport, protSubset, protUnion
+
+    def test_summaries(self):
+        """ Compare the summaries with the full protocols. """
+        proj = self.proj
+        runs = self._createRuns()
+        summaries = dict((s.getObjId(), s) for s in proj.getRunsSummary())
+
+        for run in runs:
+            prot = proj.getProtocol(run.getObjId())
+            summary = summaries[run.getObjId()]
+            self.assertEqual(prot.getClassName(), summary.getClassName())
+            self.assertEqual(prot.getRunName(), summary.getRunName())
+            self.assertEqual(prot.getStatus(), summary.getStatus())
+            self.assertEqual([(k, a.getObjValue().getObjId(),
+                               a.getExtended() or None)
+                              for k, a in prot.iterInputAttributes()],
+                             list(summary.iterInputs()))
+            self.assertEqual([(k, a.getObjId(), a.getClassName())
+                              for k, a in prot.iterOutputAttributes(EMObject)],
+                             list(summary.iterOutputs()))
+        # The PointerList inputs are returned with the list name
+        protUnion = summaries[runs[2].getObjId()]
+        self.assertEqual(['inputSets', 'inputSets'],
+                         [k for k, _, _ in protUnion.iterInputs()])
+
+    def test_getRuns(self):
+        """ Check that refreshing the runs only builds again the ones
+        that changed, and the ones using them as input. """
+        proj = self.proj
+        protImport, protSubset, protUnion = self._createRuns()
+        ids = [p.getObjId() for p in protImport, protSubset, protUnion]
+
+        def _getRuns():
+            return dict((r.getObjId(), r) for r in proj.getRuns())
+
+        runs = _getRuns()
+        newRuns = _getRuns()
+        self.assertTrue(all(runs[i] is newRuns[i] for i in runs))
+
+        prot = runs[ids[1]]
+        prot.setObjLabel('subset')
+        proj._storeProtocol(prot)
+        newRuns = _getRuns()
+        self.assertEqual('subset', newRuns[ids[1]].getObjLabel())
+        self.assertFalse(runs[ids[1]] is newRuns[ids[1]])
+        self.assertTrue(runs[ids[0]] is newRuns[ids[0]])
+        self.assertTrue(runs[ids[2]] is newRuns[ids[2]])
+
+        # Runs using a changed one are also built again
+        runs = newRuns
+        prot = runs[ids[0]]
+        prot.setObjComment('changed')
+        proj._storeProtocol(prot)
+        newRuns = _getRuns()
+        self.assertTrue(all(runs[i] is not newRuns[i] for i in ids))
+        pointer = newRuns[ids[2]].inputSets[0]
+        self.assertTrue(pointer.get() is
+                        newRuns[ids[0]].outputMicrographs)
+
+
+class TestStreamItems(BaseTest):
+    """ Check the reading of new items of streaming input sets. """
+    @classmethod
+    def setUpClass(cls):
+        setupTestOutput(cls)
+
+    def test_loadSet(self):
+        micFn = self.getOutputPath('stream_mics.sqlite')
+        pwutils.cleanPath(micFn)
+        micSet = SetOfMicrographs(filename=micFn)
+
+        def _append(*names):
+            for name in names:
+                mic = Micrograph()
+                mic.setMicName(name)
+                micSet.append(mic)
+            micSet.write()
+
+        prot = EMProtocol()
+        prot.micDict = OrderedDict()
+
+        def _load():
+            micDict, _ = prot._loadSet(micSet, SetOfMicrographs,
+                                       lambda mic: mic.getMicName())
+            return micDict.keys()
+
+        _append('a', 'b')
+        self.assertEqual(['a', 'b'], _load())
+        # Items not used by the protocol are returned again
+        prot.micDict['a'] = None
+        _append('c')
+        self.assertEqual(['b', 'c'], _load())
+        prot.micDict['b'] = prot.micDict['c'] = None
+        self.assertEqual([], _load())
+        # Only the new rows are read
+        _append('d')
+        items, allRead, _ = prot._loadStreamItems(micSet, SetOfMicrographs)
+        self.assertEqual((['d'], False),
+                         ([mic.getMicName() for mic in items], allRead))
+        micSet.close()
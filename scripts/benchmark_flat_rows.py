@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# **************************************************************************
+# *
+# * Authors:     agent (agent@local)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+"""
+Measure the cost of building objects from the rows of a flat set.
+A set of particles with CTF and alignment is created and then read:
+  - fetching only the rows from sqlite
+  - filling the items with setAttributeValue for each column (as done
+    before the setters plan was used by the SqliteFlatMapper)
+  - iterating the set with the SqliteFlatMapper
+The difference with the rows fetch is the per-row cost of the mapper.
+"""
+
+import os
+import argparse
+import tempfile
+
+import pyworkflow.utils as pwutils
+from pyworkflow.em.data import SetOfParticles
+from benchmark_sets import createParticles, timeIt
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the creation of items from set rows.")
+    parser.add_argument('-n', type=int, default=1000000,
+                        help='Number of rows (default: 1000000).')
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+                        help='Number of runs of each case, the best time '
+                             'is used (default: 3).')
+    args = parser.parse_args()
+    n = args.n
+    r = args.repeat
+
+    workingDir = tempfile.mkdtemp(prefix='benchmark_rows_')
+    setFn = os.path.join(workingDir, 'particles.sqlite')
+
+    try:
+        createParticles(setFn, n, withTransform=True)
+        partSet = SetOfParticles(filename=setFn)
+        mapper = partSet._getMapper()
+        first = partSet.getFirstItem()
+        columns = [(c, str(label)) for c, label in
+                   enumerate(mapper.db.getColumnLabels(), 5)]
+
+        def _rows():
+            for _ in mapper.db.selectAll():
+                pass
+
+        def _setAttributeValue():
+            for row in mapper.db.selectAll():
+                for c, label in columns:
+                    first.setAttributeValue(label, row[c])
+
+        def _iterate():
+            for _ in partSet:
+                pass
+
+        tRows = timeIt('rows', n, _rows, r)
+        tOld = timeIt('setAttributeValue', n, _setAttributeValue, r) - tRows
+        tNew = timeIt('iterate', n, _iterate, r) - tRows
+        print("Per-row cost without fetch: setAttributeValue %0.2f usecs, "
+              "mapper %0.2f usecs" % (tOld * 1e6 / n, tNew * 1e6 / n))
+        partSet.close()
+    finally:
+        pwutils.cleanPath(workingDir)
+
+
+if __name__ == '__main__':
+    main()
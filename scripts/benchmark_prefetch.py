@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# **************************************************************************
+# *
+# * Authors:     agent (agent@local)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+"""
+Compare the iteration of a set of particles with and without prefetch
+(see Set.iterItems) when some I/O is done for each item. For each
+particle a line is written to a text file and, to simulate slower
+storage or image processing outside Python, the loop waits the
+given microseconds. The prefetch only helps when the work per item
+releases the GIL (file I/O, external programs), since the items are
+built in a Python thread.
+"""
+
+import os
+import time
+import argparse
+import tempfile
+
+import pyworkflow.utils as pwutils
+from pyworkflow.em.data import SetOfParticles
+from benchmark_sets import createParticles, timeIt
+
+
+def consume(items, outFn, ioSecs):
+    """ Write a line for each item, waiting ioSecs after each one. """
+    with open(outFn, 'w') as f:
+        for p in items:
+            index, fn = p.getLocation()
+            f.write("%06d@%s %d %f\n" % (index, fn, p.getMicId(),
+                                         p.getCTF().getDefocusU()))
+            if ioSecs:
+                time.sleep(ioSecs)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the iteration of sets with prefetch.")
+    parser.add_argument('-n', type=int, default=100000,
+                        help='Number of items (default: 100000).')
+    parser.add_argument('--io-usecs', type=int, nargs='+',
+                        default=[0, 100, 500],
+                        help='Microseconds of simulated I/O per item '
+                             '(default: 0 100 500).')
+    parser.add_argument('--prefetch', type=int, nargs='+',
+                        default=[100, 1000],
+                        help='Prefetch sizes to compare (default: 100 1000).')
+    args = parser.parse_args()
+    n = args.n
+
+    workingDir = tempfile.mkdtemp(prefix='benchmark_prefetch_')
+    setFn = os.path.join(workingDir, 'particles.sqlite')
+    outFn = os.path.join(workingDir, 'particles.txt')
+
+    try:
+        createParticles(setFn, n)
+        partSet = SetOfParticles(filename=setFn)
+
+        for usecs in args.io_usecs:
+            print("I/O per item: %d usecs" % usecs)
+            ioSecs = usecs * 1e-6
+            timeIt('iterate', n,
+                   lambda: consume(partSet.iterItems(), outFn, ioSecs))
+            for prefetch in args.prefetch:
+                items = partSet.iterItems(prefetch=prefetch)
+                timeIt('iterate prefetch=%d' % prefetch, n,
+                       lambda: consume(items, outFn, ioSecs))
+        partSet.close()
+    finally:
+        pwutils.cleanPath(workingDir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,312 @@
+#!/usr/bin/env python
+# **************************************************************************
+# *
+# * Authors:     agent (agent@local)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+"""
+Measure the time of the most common operations on sets stored with
+the sqlite mappers (SetOfParticles, SetOfCoordinates and SetOfClasses2D)
+using synthetic sets of different sizes.
+The results can be written in JSON format (one record per operation)
+to compare the throughput between different versions.
+The functions to create particles and time them are also used by the
+other benchmark scripts.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import subprocess
+from datetime import datetime
+
+import numpy as np
+
+import pyworkflow.utils as pwutils
+from pyworkflow.em.data import (SetOfParticles, Particle, CTFModel,
+                                Acquisition, SetOfCoordinates, Coordinate,
+                                SetOfClasses2D, Class2D, Transform)
+
+
+MICS = 100  # Number of micrographs used to group the items
+CLASSES = 50  # Number of classes for SetOfClasses2D
+
+
+class Benchmark():
+    """ Run the operations over the sets and keep the results. """
+    def __init__(self, workingDir, label=None):
+        self.workingDir = workingDir
+        self.results = []
+        self.info = {'label': label,
+                     'commit': getCommit(),
+                     'timestamp': datetime.now().isoformat(),
+                     'python': sys.version.split()[0]}
+
+    def getPath(self, *paths):
+        return os.path.join(self.workingDir, *paths)
+
+    def time(self, setName, size, operation, func, *args):
+        """ Run func(*args) and store its elapsed time.
+        Return the value returned by func.
+        """
+        t0 = time.time()
+        result = func(*args)
+        elapsed = time.time() - t0
+        record = dict(self.info)
+        record.update({'set': setName,
+                       'size': size,
+                       'operation': operation,
+                       'seconds': elapsed,
+                       'itemsPerSec': size / elapsed if elapsed else None})
+        self.results.append(record)
+        print("%-18s %9d  %-22s %9.3f secs  %12.1f items/sec"
+              % (setName, size, operation, elapsed,
+                 record['itemsPerSec'] or 0))
+        sys.stdout.flush()
+        return result
+
+    def run(self, setName, size):
+        runFunc = {'SetOfParticles': self.runParticles,
+                   'SetOfCoordinates': self.runCoordinates,
+                   'SetOfClasses2D': self.runClasses2D}[setName]
+        runFunc(size)
+
+    def _runCommon(self, setName, SetClass, setFn, size, createItem,
+                   where, orderBy, groupBy):
+        """ Operations shared by all flat sets. """
+        t = lambda op, func, *args: self.time(setName, size, op, func, *args)
+
+        def _append(useMany):
+            pwutils.cleanPath(setFn)
+            newSet = SetClass(filename=setFn)
+            if useMany:
+                newSet.appendMany(createItem(i) for i in xrange(size))
+            else:
+                for i in xrange(size):
+                    newSet.append(createItem(i))
+            return newSet
+
+        t('append', _append, False).close()
+        newSet = t('appendMany', _append, True)
+        t('commit', newSet.write)
+        newSet.close()
+
+        loadedSet = SetClass(filename=setFn)
+        t('iterate', lambda: sum(1 for _ in loadedSet))
+        t('where', lambda: sum(1 for _ in loadedSet.iterItems(where=where)))
+        t('orderBy', lambda: sum(1 for _ in loadedSet.iterItems(
+            orderBy=orderBy, direction='DESC')))
+        t('getIdSet', loadedSet.getIdSet)
+        t('aggregate', loadedSet.aggregate, ['COUNT'], groupBy, [groupBy])
+
+        copyFn = self.getPath('copy_%s' % os.path.basename(setFn))
+        pwutils.cleanPath(copyFn)
+        copySet = SetClass(filename=copyFn)
+        t('copyItems', copySet.copyItems, loadedSet)
+        copySet.write()
+        copySet.close()
+        loadedSet.close()
+
+        # Reopen the set and add 10% more items
+        def _reopen():
+            appendSet = SetClass(filename=setFn)
+            appendSet.loadAllProperties()
+            appendSet.enableAppend()
+            for i in xrange(max(size / 10, 1)):
+                appendSet.append(createItem(i))
+            appendSet.write()
+            appendSet.close()
+
+        t('enableAppend', _reopen)
+        pwutils.cleanPath(copyFn)
+
+    def runParticles(self, size):
+        acq = Acquisition(magnification=60000, voltage=300,
+                          sphericalAberration=2., amplitudeContrast=0.07)
+
+        def _createParticle(i):
+            p = Particle()
+            p.setLocation(i % 1000 + 1, 'stack%04d.mrcs' % (i / 1000))
+            p.setMicId(i % MICS + 1)
+            p.setAcquisition(acq)
+            p.setCTF(CTFModel(defocusU=random.uniform(10000, 30000),
+                              defocusV=random.uniform(10000, 30000),
+                              defocusAngle=random.uniform(0, 180)))
+            p.setClassId(i % CLASSES + 1)
+            return p
+
+        self._runCommon('SetOfParticles', SetOfParticles,
+                        self.getPath('particles.sqlite'), size,
+                        _createParticle, where='_micId=1',
+                        orderBy='_ctfModel._defocusU', groupBy='_micId')
+
+    def runCoordinates(self, size):
+        def _createCoordinate(i):
+            c = Coordinate()
+            c.setPosition(random.randint(0, 4096), random.randint(0, 4096))
+            c.setMicId(i % MICS + 1)
+            return c
+
+        self._runCommon('SetOfCoordinates', SetOfCoordinates,
+                        self.getPath('coordinates.sqlite'), size,
+                        _createCoordinate, where='_micId=1',
+                        orderBy='_x', groupBy='_micId')
+
+    def runClasses2D(self, size):
+        """ Classify size particles into CLASSES classes. """
+        setName = 'SetOfClasses2D'
+        t = lambda op, func, *args: self.time(setName, size, op, func, *args)
+        partFn = self.getPath('particles.sqlite')
+
+        if not os.path.exists(partFn) or SetOfParticles(
+                filename=partFn).getSize() < size:
+            self.runParticles(size)
+
+        partSet = SetOfParticles(filename=partFn)
+        classesFn = self.getPath('classes2D.sqlite')
+        pwutils.cleanPath(classesFn)
+
+        def _append():
+            classes = SetOfClasses2D(filename=classesFn)
+            classes.setImages(partSet)
+            clsDict = {}
+            for i in range(CLASSES):
+                cls = Class2D()
+                cls.setObjId(i + 1)
+                classes.append(cls)
+                clsDict[i + 1] = cls
+            for p in partSet.iterItems(where='id BETWEEN 1 AND %d' % size):
+                clsDict[p.getClassId()].append(p)
+            for cls in clsDict.itervalues():
+                classes.update(cls)
+            return classes
+
+        classes = t('append', _append)
+        t('commit', classes.write)
+        classes.close()
+
+        loadedClasses = SetOfClasses2D(filename=classesFn)
+        t('iterate', lambda: sum(len(list(cls)) for cls in loadedClasses))
+        t('iterClassItems',
+          lambda: sum(1 for _ in loadedClasses.iterClassItems()))
+        t('aggregate', lambda: [cls.aggregate(['COUNT'], '_micId', ['_micId'])
+                                for cls in loadedClasses])
+        loadedClasses.close()
+        partSet.close()
+
+
+def getCommit():
+    """ Return the current git commit of Scipion (if available). """
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                       cwd=os.environ.get('SCIPION_HOME', '.'),
+                                       stderr=subprocess.PIPE).strip()
+    except Exception:
+        return None
+
+
+def iterParticles(ids, withTransform=False):
+    """ Yield a particle with CTF (and alignment if withTransform)
+    for each id. The same particle is used for all ids, so it should
+    be stored before getting the next one (as done by Set.appendMany).
+    """
+    p = Particle()
+    p.setCTF(CTFModel(defocusU=10000, defocusV=12000, defocusAngle=45))
+    if withTransform:
+        p.setTransform(Transform(np.eye(4)))
+
+    for i in ids:
+        p.setObjId(i)
+        p.setLocation((i - 1) % 1000 + 1, 'stack%04d.mrcs' % ((i - 1) / 1000))
+        p.setMicId(i % MICS + 1)
+        p.getCTF().setDefocusU(10000 + (i * 7919) % 20000)
+        yield p
+
+
+def createParticles(setFn, n, withTransform=False):
+    """ Create a set of n particles (see iterParticles) in setFn. """
+    pwutils.cleanPath(setFn)
+    partSet = SetOfParticles(filename=setFn)
+    partSet.appendMany(iterParticles(xrange(1, n + 1), withTransform))
+    partSet.write()
+    partSet.close()
+
+
+def timeIt(label, n, func, repeat=1):
+    """ Run func several times and print the best time, also per item.
+    Return the best time.
+    """
+    times = []
+    for _ in range(repeat):
+        t0 = time.time()
+        func()
+        times.append(time.time() - t0)
+    elapsed = min(times)
+    print("%-22s %8.2f secs  %8.2f usecs/item" % (label, elapsed,
+                                                  elapsed * 1e6 / n))
+    sys.stdout.flush()
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the sqlite mappers with synthetic sets.")
+    add = parser.add_argument  # shortcut
+    add('--sizes', type=int, nargs='+', default=[10000, 100000, 1000000],
+        help='Number of items of the generated sets '
+             '(default: 10000 100000 1000000).')
+    add('--sets', nargs='+',
+        default=['SetOfParticles', 'SetOfCoordinates', 'SetOfClasses2D'],
+        choices=['SetOfParticles', 'SetOfCoordinates', 'SetOfClasses2D'],
+        help='Type of sets to benchmark (default: all).')
+    add('--output', metavar='JSON_FILE',
+        help='Write the results to this file in JSON format.')
+    add('--label', help='Label to identify this run in the results '
+                        '(e.g. the release name).')
+    add('--workingDir', help='Directory where to create the sets '
+                             '(default: a temporary one).')
+    args = parser.parse_args()
+
+    workingDir = args.workingDir or tempfile.mkdtemp(prefix='benchmark_sets_')
+    pwutils.makePath(workingDir)
+    benchmark = Benchmark(workingDir, args.label)
+
+    try:
+        for size in args.sizes:
+            for setName in args.sets:
+                benchmark.run(setName, size)
+    finally:
+        if args.workingDir is None:
+            pwutils.cleanPath(workingDir)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(benchmark.results, f, indent=2)
+        print("Results written to: %s" % args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+# **************************************************************************
+# *
+# * Authors:     agent (agent@local)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+"""
+Measure a set of particles stored in several sqlite files (shards).
+The set is written by several processes at the same time, each one
+appending a range of ids that goes to its own shards, and then it is
+read as a single set:
+  - getSize, random access by id and iteration in id order
+  - iteration sorted by another attribute (merge of all shards)
+Use -j 1 to compare the writing time with a single process.
+"""
+
+import os
+import argparse
+import tempfile
+import multiprocessing
+
+import pyworkflow.utils as pwutils
+from pyworkflow.em.data import SetOfParticles
+from pyworkflow.mapper.sqlite_shards import SqliteShardedMapper
+from benchmark_sets import iterParticles, timeIt
+
+
+def appendRange(setFn, first, last):
+    """ Append the particles with ids from first to last (included). """
+    partSet = SetOfParticles(filename=setFn)
+    partSet.appendMany(iterParticles(xrange(first, last + 1)))
+    # Properties are written only once by the main process
+    partSet.write(properties=False)
+    partSet.close()
+
+
+def createSet(setFn, n, shardSize, jobs):
+    """ Create the set with the shards written by several processes,
+    each process receives whole shards so they never write the same file.
+    """
+    SqliteShardedMapper.createManifest(setFn, shardSize=shardSize)
+    numShards = (n + shardSize - 1) // shardSize
+    ranges = [(s * shardSize + 1, min(n, (s + 1) * shardSize))
+              for s in range(numShards)]
+    pool = multiprocessing.Pool(jobs)
+    results = [pool.apply_async(appendRange, (setFn,) + r) for r in ranges]
+    for r in results:
+        r.get()
+    pool.close()
+    pool.join()
+
+    partSet = SetOfParticles(filename=setFn)
+    partSet.write()
+    partSet.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark a set of particles split in several files.")
+    parser.add_argument('-n', type=int, default=5000000,
+                        help='Number of rows (default: 5000000).')
+    parser.add_argument('--shard-size', type=int, default=500000,
+                        help='Number of rows of each shard '
+                             '(default: 500000).')
+    parser.add_argument('-j', type=int, default=multiprocessing.cpu_count(),
+                        help='Number of writing processes '
+                             '(default: number of cpus).')
+    parser.add_argument('--dir', default=None,
+                        help='Directory where to create the set, it '
+                             'should be in a local disk.')
+    args = parser.parse_args()
+    n = args.n
+
+    workingDir = tempfile.mkdtemp(prefix='benchmark_shards_', dir=args.dir)
+    setFn = os.path.join(workingDir, 'particles.shards')
+
+    try:
+        timeIt('write (%d jobs)' % args.j, n,
+               lambda: createSet(setFn, n, args.shard_size, args.j))
+        partSet = SetOfParticles(filename=setFn)
+        print("Shards: %d" % len(partSet._getMapper().getShardFiles()))
+
+        def _size():
+            assert SetOfParticles(filename=setFn).getSize() == n
+
+        def _getItems():
+            for i in xrange(1, n + 1, max(1, n // 1000)):
+                partSet[i]
+
+        def _iterate():
+            for _ in partSet:
+                pass
+
+        def _iterateSorted():
+            for _ in partSet.iterItems(orderBy='_ctfModel._defocusU'):
+                pass
+
+        timeIt('getSize', n, _size)
+        timeIt('getitem (1000)', 1000, _getItems)
+        timeIt('iterate', n, _iterate)
+        timeIt('iterate by defocusU', n, _iterateSorted)
+        partSet.close()
+    finally:
+        pwutils.cleanPath(workingDir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# **************************************************************************
+# *
+# * Authors:     agent (agent@local)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+"""
+Measure the overhead of the steps executors by running a large
+number of trivial steps. The steps graph is similar to the one of
+streaming protocols: one initial step, many independent steps
+(e.g. one per micrograph) and a final step depending on all of them.
+"""
+
+import time
+import argparse
+
+from pyworkflow.protocol.protocol import Step
+from pyworkflow.protocol.executor import StepExecutor, ThreadStepExecutor
+
+
+def createSteps(n):
+    """ Create n trivial steps: first, n-2 depending on the first
+    and the last one depending on all the others.
+    """
+    steps = [Step()]
+
+    for i in range(n - 2):
+        step = Step()
+        step.addPrerequisites(1)
+        steps.append(step)
+
+    lastStep = Step()
+    lastStep.addPrerequisites(*range(2, n))
+    steps.append(lastStep)
+
+    for i, step in enumerate(steps):
+        step.setIndex(i + 1)
+
+    return steps
+
+
+def runExecutor(executor, steps):
+    """ Run all steps and return the elapsed seconds. """
+    def _callback(step):
+        return True
+
+    t0 = time.time()
+    executor.runSteps(steps, _callback, _callback, lambda: None)
+    elapsed = time.time() - t0
+
+    if not all(s.isFinished() for s in steps):
+        raise Exception("Not all steps were finished!!!")
+
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the execution of many trivial steps.")
+    add = parser.add_argument  # shortcut
+    add('-n', type=int, default=50000,
+        help='Number of steps to run (default: 50000).')
+    add('--threads', type=int, default=4,
+        help='Number of threads for the ThreadStepExecutor (default: 4).')
+    args = parser.parse_args()
+
+    executors = [('StepExecutor', StepExecutor(None)),
+                 ('ThreadStepExecutor(%d)' % args.threads,
+                  ThreadStepExecutor(None, args.threads))]
+
+    for name, executor in executors:
+        steps = createSteps(args.n)
+        elapsed = runExecutor(executor, steps)
+        print("%-24s %8d steps  %8.2f secs  %10.1f steps/sec"
+              % (name, args.n, elapsed, args.n / elapsed))
+
+
+if __name__ == '__main__':
+    main()
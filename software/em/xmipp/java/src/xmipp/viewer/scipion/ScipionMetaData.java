@@ -10,6 +10,9 @@ import ij.ImagePlus;
 
 import java.io.File;
 import java.io.IOException;
+import java.nio.ByteBuffer;
+import java.nio.ByteOrder;
+import java.nio.DoubleBuffer;
 import java.sql.Connection;
 import java.sql.DriverManager;
 import java.sql.PreparedStatement;
@@ -210,7 +213,7 @@ public class ScipionMetaData extends MetaData {
                             value = rs.getFloat(alias);
                             break;
                         default:
-                            value = rs.getString(alias);
+                            value = getStringValue(rs, alias);
                     }
                     emo.values.put(column, value);
                 }
@@ -588,6 +591,33 @@ public class ScipionMetaData extends MetaData {
         return "String";
     }
 
+    /**
+     * Read a column value as string. Matrix values are stored as the
+     * binary data of 16 little-endian doubles, they are converted to
+     * the json text used in previous versions.
+     */
+    protected static String getStringValue(ResultSet rs, String alias) throws SQLException {
+        Object value = rs.getObject(alias);
+        if (value instanceof byte[])
+            return matrixToString((byte[]) value);
+        return (value == null) ? null : value.toString();
+    }
+
+    protected static String matrixToString(byte[] data) {
+        DoubleBuffer values = ByteBuffer.wrap(data).order(ByteOrder.LITTLE_ENDIAN).asDoubleBuffer();
+        StringBuilder sb = new StringBuilder("[");
+        for (int i = 0; i < 4; i++) {
+            sb.append(i == 0 ? "[" : ", [");
+            for (int j = 0; j < 4; j++) {
+                if (j > 0)
+                    sb.append(", ");
+                sb.append(values.get(i * 4 + j));
+            }
+            sb.append("]");
+        }
+        return sb.append("]").toString();
+    }
+
     public static int getTypeMapping(String type) {
         if (type.equals("Integer")) {
             return MetaData.LABEL_INT;
@@ -865,7 +895,7 @@ public class ScipionMetaData extends MetaData {
                                 value = rs.getFloat(alias);
                                 break;
                             case MetaData.LABEL_STRING:
-                                value = rs.getString(alias);
+                                value = getStringValue(rs, alias);
                                 if (indexci != null) {
                                         fnIndex = rs.getInt(indexci.comment);
                                         if (fnIndex > 0) 
@@ -875,7 +905,7 @@ public class ScipionMetaData extends MetaData {
                                 break;
                             default:
 
-                                value = rs.getString(alias);
+                                value = getStringValue(rs, alias);
                         }
                         emo.values.put(column, value);
                     }